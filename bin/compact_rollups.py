@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compute the month and year roll-up keys of the months and years touched by
+# the ingestion, once or in the background every few seconds.
+
+from lib.helpers import get_redis_connection, REDIS_RETRIES
+from potiron.potiron_rollup import compact_rollups, mark_all_rollups
+import argparse
+import potiron.potiron as potiron
+import redis
+import sys
+import time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the month and year roll-up keys of the standard data.')
+    parser.add_argument('-u', '--unix', type=str, required=True, help='Unix socket to connect to redis-server')
+    parser.add_argument('-c', '--console', action='store_false', help='DO NOT log output also to console')
+    parser.add_argument('--all', action='store_true', help='Compute the roll-ups of all the months and years already stored, including the data stored before the roll-ups were maintained')
+    parser.add_argument('--interval', type=int, help='Keep running in the background, computing the pending roll-ups every N seconds (default: compute them once)')
+    parser.add_argument('--redis_retries', type=int, default=REDIS_RETRIES, help=f'Number of retries when redis is busy loading its data (default: {REDIS_RETRIES})')
+    args = parser.parse_args()
+    potiron.logconsole = args.console
+    red = get_redis_connection(unix_socket_path=args.unix, retries=args.redis_retries)
+    try:
+        if red.hget('PARAMETERS', 'format') != 'standard':
+            sys.exit('The roll-ups are only available with the standard format storage.')
+        if args.all:
+            mark_all_rollups(red)
+        while True:
+            computed = compact_rollups(red)
+            if computed:
+                potiron.infomsg(f"{computed} month and year roll-ups computed.")
+            if args.interval is None:
+                break
+            time.sleep(args.interval)
+    except redis.ConnectionError as e:
+        sys.exit(f"Could not connect to redis. {e}")
+    except KeyboardInterrupt:
+        pass
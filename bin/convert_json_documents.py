@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Convert existing json documents into another format (typically the columnar
+# npz format), stored in the usual year/month/day tree of an output directory.
+
+from bin.parse_pcap_files import fetch_files
+from pathlib import Path
+from potiron.potiron import create_dir, get_json_format, JsonDocument, JSON_FORMATS, read_json_document
+import argparse
+import os
+import sys
+
+
+def convert_document(inputfile, rootdir, json_format):
+    if get_json_format(inputfile) == json_format:
+        return f"{inputfile} is already in {json_format} format."
+    with JsonDocument(rootdir, os.path.basename(inputfile), json_format) as document:
+        for packet in read_json_document(inputfile):
+            document.write(packet)
+    return f"{inputfile} converted into {document.filename}."
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert json documents into another format.')
+    parser.add_argument('-i', '--input', type=str, nargs='+', required=True, help='Json documents, or directories containing json documents, to convert')
+    parser.add_argument('-o', '--outputdir', type=str, required=True, help='Output directory where the converted documents are stored')
+    parser.add_argument('-f', '--format', choices=JSON_FORMATS, default='npz', help='Format of the converted documents (default: npz)')
+    parser.add_argument('--remove', action='store_true', help='Remove each json document once converted')
+    args = parser.parse_args()
+    extensions = tuple(f'.{json_format}' for json_format in JSON_FORMATS)
+    files = []
+    for arg in args.input:
+        if os.path.isdir(arg):
+            files.extend(fetch_files(Path(arg), extensions))
+        elif os.path.isfile(arg):
+            files.append(arg)
+        else:
+            sys.exit(f"The filename {arg} was not found")
+    create_dir(args.outputdir)
+    for inputfile in files:
+        try:
+            print(convert_document(inputfile, args.outputdir, args.format))
+        except (OSError, ValueError) as e:
+            print(f"Error while converting {inputfile}: {e}", file=sys.stderr)
+            continue
+        if args.remove and get_json_format(inputfile) != args.format:
+            os.remove(inputfile)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Export in csv the approximate number of distinct values of the fields
+# counted in HyperLogLog keys at ingestion (see parse_pcap_files.py --hll),
+# for days, months or years.
+
+from lib.helpers import get_redis_connection
+from potiron.potiron import count_distinct, fresh_rollups
+import argparse
+import csv
+import re
+import sys
+
+_period_format = re.compile(r'^\d{4}(\d{2}){0,2}$')
+
+
+def export_distinct_counts(red, sensorname, periods, fields, per_protocol, output):
+    protocols = sorted(red.smembers('PROTOCOLS')) if red.hget('PARAMETERS', 'ck') == 'True' else None
+    fresh = fresh_rollups(red)
+    writer = csv.writer(output)
+    writer.writerow(('period', 'field', 'protocol', 'distinct'))
+    for period in periods:
+        for field in fields:
+            if per_protocol and protocols:
+                for protocol in protocols:
+                    writer.writerow((period, field, protocol, count_distinct(red, sensorname, period, field, [protocol], fresh)))
+            writer.writerow((period, field, 'all', count_distinct(red, sensorname, period, field, protocols, fresh)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the approximate number of distinct values of the fields counted at ingestion.')
+    parser.add_argument('-u', '--unix', type=str, required=True, help='Unix socket to connect to redis-server')
+    parser.add_argument('-s', '--source', type=str, required=True, help='Sensor name of the captures')
+    parser.add_argument('-d', '--dates', type=str, nargs='+', required=True, help='Days (YYYYMMDD), months (YYYYMM) or years (YYYY) to export')
+    parser.add_argument('-f', '--fields', type=str, nargs='+', help='Fields to export (default: all the fields whose distinct values are counted)')
+    parser.add_argument('-p', '--per_protocol', action='store_true', help='Also export the distinct values of each protocol, with combined keys')
+    parser.add_argument('-o', '--output', type=str, help='Output csv file (default: standard output)')
+    args = parser.parse_args()
+    red = get_redis_connection(unix_socket_path=args.unix)
+    counted = (red.hget('PARAMETERS', 'hll') or '').split()
+    if not counted:
+        sys.exit('The distinct values of the fields are not counted in this redis instance.')
+    fields = args.fields or counted
+    if any(field not in counted for field in fields):
+        sys.exit(f"The distinct values are only counted for the following fields: {', '.join(counted)}.")
+    if any(_period_format.match(date) is None for date in args.dates):
+        sys.exit('The dates should be given as YYYYMMDD, YYYYMM or YYYY.')
+    if args.output is None:
+        export_distinct_counts(red, args.source, args.dates, fields, args.per_protocol, sys.stdout)
+    else:
+        with open(args.output, 'wt', newline='') as output:
+            export_distinct_counts(red, args.source, args.dates, fields, args.per_protocol, output)
@@ -18,12 +18,15 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from glob import glob
+from lib.helpers import get_redis_connection, get_socket_path, REDIS_BACKENDS, REDIS_RETRIES
 from pathlib import Path
-from potiron.potiron import check_program, create_dir
-from potiron.potiron_parameters import fetch_parameters
+from potiron.potiron import check_program, create_dir, CHUNK_SIZE, DEFAULTBULKBUFFER, FLUSH_KEYS, FLUSH_PACKETS, FLUSH_SECONDS, json_fields, JSON_FORMAT, JSON_FORMATS, parse_topk, SHARD_MIN_SIZE, SHARDS, TSHARK_TIMEOUT
+from potiron.potiron_parameters import extract_json_fields, fetch_parameters
+from potiron.potiron_time import get_timezone, LOCAL_TIMEZONE, parse_buckets, timezone_name
 from potiron.potiron_tshark import standard_process
 from potiron.potiron_isn_tshark import isn_process
 from potiron.potiron_layer2_tshark import layer2_process
+from potiron.potiron_multi_tshark import multi_process
 import argparse
 import datetime
 import os
@@ -33,6 +36,11 @@ import sys
 
 
 _function_mapping = {'0': 'standard_process', '1': 'isn_process', '2': 'layer2_process'}
+_engines = ('tshark', 'native')
+_formats = ('standard', 'isn', 'layer2')
+# Fields whose distinct values can be counted in HyperLogLog keys
+distinct_fields = extract_json_fields(json_fields)
+capture_extensions = ('cap', 'cap.gz', 'cap.zst', 'cap.lz4')
 
 
 def define_tshark_filter(tsharkfilter):
@@ -55,6 +63,30 @@ def fetch_files(directory: Path, formats):
     return to_return
 
 
+# Drop the files already imported, checking them all against the FILES set in
+# a single round trip, and sort the remaining ones by decreasing size, so the
+# largest captures are dispatched first instead of keeping one worker busy
+# alone at the end of the import.
+# With other redis instances, the files are dropped once imported in all of them.
+def schedule_files(red, files, others=()):
+    files = list(dict.fromkeys(files))
+    status = [_imported(instance, files) for instance in (red, *others)]
+    to_process = []
+    for filename, *imported in zip(files, *status):
+        if all(imported):
+            print(f'Filename {filename} was already imported ... skip ...')
+            continue
+        to_process.append(filename)
+    return sorted(to_process, key=os.path.getsize, reverse=True)
+
+
+def _imported(red, files):
+    p = red.pipeline(transaction=False)
+    for filename in files:
+        p.sismember('FILES', os.path.basename(filename))
+    return p.execute()
+
+
 def _get_function_score(isn, layer2):
     score = 0
     format = 'standard'
@@ -67,77 +99,189 @@ def _get_function_score(isn, layer2):
     return str(score), format
 
 
-if __name__ == '__main__':
-    # If tshark is not installed, exit and raise the error
-    if not check_program('tshark'):
-        raise OSError("The program tshark is not installed")
-    # FIXME Put in config file
-
-    # Parameters parser
-    parser = argparse.ArgumentParser(description="Start the tool tshark and store packets data in redis.")
-    parser.add_argument("-i", "--input", type=str, nargs='+', required=True, help="Pcap or compressed pcap filename")
+def define_parser(description, input_help):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("-i", "--input", type=str, nargs='+', required=True, help=input_help)
     parser.add_argument("-c", "--console", action='store_false', help="DO NOT log output also to console")
     parser.add_argument("-ff", "--fieldfilter", nargs='+',help='Parameters to filter fields to display (ex: "tcp.srcport udp.srcport")')
     parser.add_argument("-o", "--outputdir", type=str, nargs=1, help="Output directory where the json documents will be stored")
     parser.add_argument("-tf", "--tsharkfilter", type=str, nargs='+', help='Tshark Filter (with wireshark/tshark synthax. ex: "ip.proto == 6")')
-    parser.add_argument('-u','--unix', type=str, nargs=1, required=True, help='Unix socket to connect to redis-server')
+    parser.add_argument('-u','--unix', type=str, nargs=1, help='Unix socket to connect to redis-server')
     parser.add_argument('-ck', '--combined_keys', action='store_true', help='Set if combined keys should be used')
     parser.add_argument('-ej', '--enable_json', action='store_true', help='Enable storage into json files')
+    parser.add_argument('--json_format', choices=JSON_FORMATS, default=JSON_FORMAT, help=f'Format of the json documents: a json array of packets, one packet per line (possibly gzip compressed), or a columnar numpy archive (default: {JSON_FORMAT})')
     parser.add_argument('--isn', action='store_true', help='Store ISN values of packets instead of storing the standard format of data.')
     parser.add_argument('-l2', '--layer2', action='store_true', help='Store Layer2 values of packets instead of storing the standard format of data.')
-    args = parser.parse_args()
-    logconsole = args.console
-    usocket = args.unix[0]
+    parser.add_argument('--formats', choices=_formats, nargs='+', help='Formats of data stored at once, reading the captures only once, each in the redis backend named after it (instead of -u, --isn and -l2)')
+    parser.add_argument('--engine', choices=_engines, default='tshark', help='Engine used to decode the packets: tshark, or the native decoder of classic pcap files which only supports the default tshark filters (default: tshark)')
+    parser.add_argument('--counters', action='store_true', help='Also write next to each json document a sidecar file with the counters of the capture, replayed instead of the document when it is imported again (only available with the standard format storage, with json files)')
+    parser.add_argument('--buckets', nargs='+', default=[], help='Sub-day buckets whose values are counted in addition to the days, as width[:retention] with the width in minutes or hours dividing a day and the retention after the end of a bucket in minutes, hours or days (ex: "1h:30d 5m:2d", only available with the standard format storage)')
+    parser.add_argument('--hll', nargs='+', default=[], choices=distinct_fields, metavar='FIELD', help=f'Fields whose distinct values of each day are counted in HyperLogLog keys, merged for the months and years when they are queried (choose in: {", ".join(distinct_fields)}, only available with the standard format storage)')
+    parser.add_argument('--topk', nargs='+', default=[], metavar='FIELD:SIZE', help='Fields whose sorted sets only keep the given number of values with the highest counts, as approximate counts never underestimated (ex: "ipsrc:1000 ipdst:1000", only available with the standard format storage)')
+    parser.add_argument('--vectorized', action='store_true', help='Count the values of the packets by chunks with NumPy instead of packet by packet (only available with the standard format storage, without json files)')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help=f'Number of packets counted at once with --vectorized (default: {CHUNK_SIZE})')
+    parser.add_argument('--flush_packets', type=int, default=FLUSH_PACKETS, help=f'Push the partial counters to redis every N packets (default: {FLUSH_PACKETS}, 0 to disable)')
+    parser.add_argument('--flush_keys', type=int, default=FLUSH_KEYS, help=f'Push the partial counters to redis once N distinct values are pending (default: {FLUSH_KEYS}, 0 to disable)')
+    parser.add_argument('--flush_seconds', type=int, default=FLUSH_SECONDS, help=f'Push the partial counters to redis every N seconds (default: {FLUSH_SECONDS}, 0 to disable)')
+    parser.add_argument('--batch_size', type=int, default=DEFAULTBULKBUFFER, help=f'Maximum number of commands sent to redis in one pipeline (default: {DEFAULTBULKBUFFER})')
+    parser.add_argument('--timezone', type=str, default=LOCAL_TIMEZONE, help=f'Timezone used to define the day of the packets, as a name of the tz database (ex: "UTC", "Europe/Luxembourg"), or "{LOCAL_TIMEZONE}" for the timezone of the host, stored under its name in the tz database (default: {LOCAL_TIMEZONE})')
+    parser.add_argument('--workers', type=int, help='Number of capture files processed in parallel (default: number of processors)')
+    parser.add_argument('--decompress', action='store_true', help='Decompress the gzip captures in a separate process piping the decompressed packets into the decoder, instead of decompressing them in the decoder process (the zstd and lz4 captures are always decompressed this way)')
+    parser.add_argument('--timeout', type=int, default=TSHARK_TIMEOUT, help=f'Kill tshark when it does not output anything during N seconds (default: {TSHARK_TIMEOUT}, 0 to disable)')
+    parser.add_argument('--shards', type=int, default=SHARDS, help=f'Split each large capture into N shards of packets processed in parallel, with the native engine and the standard or isn format (default: {SHARDS}, no split)')
+    parser.add_argument('--shard_min_size', type=int, default=SHARD_MIN_SIZE, help=f'Minimum size in MB of the captures split with --shards (default: {SHARD_MIN_SIZE})')
+    parser.add_argument('--redis_timeout', type=float, help='Timeout in seconds of the redis socket operations (default: no timeout)')
+    parser.add_argument('--redis_retries', type=int, default=REDIS_RETRIES, help=f'Number of retries when redis is busy loading its data (default: {REDIS_RETRIES})')
+    return parser
+
+
+# Check the arguments, connect to redis and check / store the parameters of
+# the ingestion. Returns the format of the data stored, the parameters of the
+# redis connection, and the redis connection itself.
+def prepare_ingestion(args):
+    _check_arguments(args)
     isn = args.isn
     layer2 = args.layer2
 
-    try:
-        _to_call, format = _get_function_score(isn, layer2)
-        _to_call = _function_mapping[_to_call]
-    except KeyError:
+    score, format = _get_function_score(isn, layer2)
+    if score not in _function_mapping:
         sys.exit(f"Invalid content option. \
         Please specify if you want to store either {', '.join(['isn', 'layer2'])} data (choose only one option), \
         or store data in standard format by using none of these parameters.")
+    if args.unix is None:
+        sys.exit("Please specify the unix socket of the redis instance with '-u', or the formats to store in the redis backends with '--formats'.")
 
+    redis_parameters, red = _connect(args, args.unix[0])
+    if format != 'standard' and args.fieldfilter is not None:
+        print("If you use '--isn' or --layer2 (alternatively -l2), the field filter parameter will be ignored.")
+    if args.vectorized and (format != 'standard' or args.enable_json):
+        print("The vectorized counting is only available with the standard format without json files, the '--vectorized' parameter will be ignored.")
+    if args.counters and (format != 'standard' or not args.enable_json):
+        print("The counters sidecar files are only available with the standard format with json files, the '--counters' parameter will be ignored.")
+    if args.shards > 1 and (args.engine != 'native' or format == 'layer2'):
+        print("The captures can only be split with the native engine, and not with the layer2 format whose replies depend on the preceding requests, the '--shards' parameter will be ignored.")
+        args.shards = 1
+    _store_parameters(args, format, red, args.outputdir[0] if args.enable_json else None)
+    return format, redis_parameters, red
+
+
+# Same as prepare_ingestion, for several formats stored at once in the redis
+# backends named after them (see lib/redis_backends.json), the json
+# documents of each format being stored in a subdirectory of the output
+# directory named after the format. Returns the parameters of the redis
+# connection and the redis connection of each format.
+def prepare_multi_ingestion(args):
+    _check_arguments(args)
+    if args.isn or args.layer2:
+        sys.exit("The formats to store are all given with '--formats', please do not use '--isn' or '--layer2' (alternatively -l2) with it.")
+    if args.unix is not None:
+        print("The redis instances are the redis backends of the formats, the '-u' parameter will be ignored.")
+    if args.shards > 1:
+        print("The captures are read once for all the formats, the '--shards' parameter will be ignored.")
+        args.shards = 1
+    backends = {}
+    for format in _formats:
+        if format not in args.formats:
+            continue
+        if format not in REDIS_BACKENDS:
+            sys.exit(f"There is no {format} redis backend in lib/redis_backends.json.")
+        redis_parameters, red = _connect(args, get_socket_path(format))
+        _store_parameters(args, format, red, os.path.join(args.outputdir[0], format) if args.enable_json else None)
+        backends[format] = (redis_parameters, red)
+    return backends
+
+
+def _check_arguments(args):
+    if args.workers is not None and args.workers < 1:
+        sys.exit("The number of workers should be at least 1.")
+    if args.shards < 1:
+        sys.exit("The number of shards should be at least 1.")
+    # If tshark is not installed, exit and raise the error
+    if args.engine == 'tshark' and not check_program('tshark'):
+        raise OSError("The program tshark is not installed")
+    if args.tsharkfilter is not None and args.engine == 'native':
+        sys.exit("The native engine only applies the default filters, please use tshark as engine to specify a tshark filter.")
+    if args.enable_json and args.outputdir is None:
+        sys.stderr.write("You should specify an output directory.\n")
+        sys.exit(1)
     try:
-        red = redis.Redis(unix_socket_path=usocket, decode_responses=True)
-    except redis.ConnectionError as e:
-        sys.exit(f"Could not connect to redis. {e}")
-    for arg in args.input:
-        if os.path.exists(arg) is False:
-            sys.stderr.write(f"The filename {arg} was not found\n")
-            sys.exit(1)
-    input_directory = [Path(arg) for arg in args.input]
-    files = [filename for directory in input_directory for filename in fetch_files(directory, ('cap',  'cap.gz'))]
+        get_timezone(args.timezone)
+    except Exception as e:
+        sys.exit(f"Invalid timezone {args.timezone}: {e}")
+    args.timezone = timezone_name(args.timezone)
+    if args.timezone == LOCAL_TIMEZONE:
+        sys.stderr.write("The name of the timezone of the host could not be found, the packets are counted with its local time. Use --timezone to define it explicitly.\n")
+    try:
+        parse_buckets(" ".join(args.buckets))
+        check_topk(args.topk)
+    except ValueError as e:
+        sys.exit(str(e))
 
-    fieldfilter = args.fieldfilter
 
-    if format != 'standard' and fieldfilter is not None:
-        print("If you use '--isn' or --layer2 (alternatively -l2), the field filter parameter will be ignored.")
-    elif format == 'standard' and fieldfilter is None:
-        fieldfilter = []
+# Check the bounded fields given as field:size
+def check_topk(topk):
+    fields = [field for field in parse_topk(" ".join(topk)) if field not in distinct_fields]
+    if fields:
+        raise ValueError(f"Invalid bounded fields: {', '.join(fields)}, choose in: {', '.join(distinct_fields)}.")
 
-    tsharkfilter = define_tshark_filter(args.tsharkfilter) if args.tsharkfilter is not None else ""
 
-    enable_json = args.enable_json
+def _connect(args, usocket):
+    redis_parameters = {'unix_socket_path': usocket, 'socket_timeout': args.redis_timeout, 'retries': args.redis_retries}
+    red = get_redis_connection(**redis_parameters)
+    try:
+        red.ping()
+    except redis.ConnectionError as e:
+        sys.exit(f"Could not connect to redis. {e}")
+    return redis_parameters, red
 
-    if not enable_json:
+
+def _store_parameters(args, format, red, rootdir):
+    if rootdir is None:
         rootdir = 'None'
     else:
-        if args.outputdir is None:
-            sys.stderr.write("You should specify an output directory.\n")
-            sys.exit(1)
-        rootdir = args.outputdir[0]
         create_dir(rootdir)
         if os.path.isdir(rootdir) is False:
             sys.stderr.write("The root directory is not a directory\n")
             sys.exit(1)
-
-    ck = args.combined_keys
-
+    tsharkfilter = define_tshark_filter(args.tsharkfilter) if args.tsharkfilter is not None else ""
     parameters = {'rootdir': rootdir, 'tshark_filter': tsharkfilter, 'red': red,
-                  'enable_json': str(enable_json), 'format': format,}
+                  'enable_json': str(args.enable_json), 'format': format, 'engine': args.engine,
+                  'timezone': args.timezone, 'tshark_timeout': str(args.timeout), 'decompress': str(args.decompress), 'json_format': args.json_format}
+    if format != 'layer2':
+        parameters.update({'shards': str(args.shards), 'shard_min_size': str(args.shard_min_size)})
     if format == 'standard':
-        parameters.update({'field_filter': fieldfilter, 'ck': str(ck)})
+        parameters.update({'field_filter': args.fieldfilter or [], 'ck': str(args.combined_keys), 'buckets': " ".join(args.buckets), 'hll': " ".join(args.hll), 'topk': " ".join(args.topk)})
+        parameters.update({key: str(getattr(args, key)) for key in ('vectorized', 'counters', 'chunk_size', 'flush_packets', 'flush_keys', 'flush_seconds', 'batch_size')})
+    # The instances filled before 'local' was resolved keep the timezone of
+    # the host they were filled on, which is assumed to be this one
+    if red.hget('PARAMETERS', 'timezone') == LOCAL_TIMEZONE:
+        red.hset('PARAMETERS', 'timezone', args.timezone)
     fetch_parameters(**parameters)
-    globals()[_to_call](red, files, logconsole)
+
+
+if __name__ == '__main__':
+    # FIXME Put in config file
+
+    # Parameters parser
+    parser = define_parser("Start the tool tshark and store packets data in redis.", "Pcap or compressed pcap filename")
+    args = parser.parse_args()
+    if args.formats:
+        backends = prepare_multi_ingestion(args)
+    else:
+        format, redis_parameters, red = prepare_ingestion(args)
+    for arg in args.input:
+        if os.path.exists(arg) is False:
+            sys.stderr.write(f"The filename {arg} was not found\n")
+            sys.exit(1)
+    input_directory = [Path(arg) for arg in args.input]
+    files = [filename for directory in input_directory for filename in fetch_files(directory, capture_extensions)]
+    if args.formats:
+        red, *others = (red for _, red in backends.values())
+        files = schedule_files(red, files, others)
+        if files:
+            multi_process({format: redis_parameters for format, (redis_parameters, _) in backends.items()}, files, args.console, args.workers,
+                          define_tshark_filter(args.tsharkfilter) if args.tsharkfilter is not None else "")
+    else:
+        files = schedule_files(red, files)
+        if files:
+            globals()[f"{format}_process"](redis_parameters, files, args.console, args.workers)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Continuous ingestion of the captures written in one or more directories:
+# the directories are polled, and each capture is sent to a pool of workers
+# kept alive for the whole run as soon as it is complete, i.e. once its size
+# and modification time did not change during --settle seconds.
+
+from bin.parse_pcap_files import capture_extensions, define_parser, prepare_ingestion, schedule_files
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from potiron.potiron_tshark import standard_setup, _init_worker as _standard_init_worker
+from potiron.potiron_isn_tshark import isn_setup, _init_worker as _isn_init_worker
+from potiron.potiron_layer2_tshark import layer2_setup, _init_worker as _layer2_init_worker
+import os
+import potiron.potiron as potiron
+import sys
+import time
+
+_setup_functions = {'standard': (standard_setup, _standard_init_worker),
+                    'isn': (isn_setup, _isn_init_worker),
+                    'layer2': (layer2_setup, _layer2_init_worker)}
+POLL_INTERVAL = 5
+SETTLE_TIME = 10
+
+
+# In-memory index of the watched directories: the content of a directory is
+# only listed again when its modification time changes, the captures already
+# seen are never considered twice, and the captures still being written are
+# stat'ed at each poll until their size and modification time are stable.
+class CaptureWatcher():
+    def __init__(self, directories, settle):
+        self.directories = directories
+        self.settle = settle
+        self.listings = {}
+        self.pending = {}
+        self.seen = set()
+
+    def poll(self):
+        now = time.monotonic()
+        for directory in self.directories:
+            self._scan(directory)
+        complete = []
+        for filename, (status, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                del self.pending[filename]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != status:
+                self.pending[filename] = (current, now)
+            elif now - since >= self.settle:
+                del self.pending[filename]
+                self.seen.add(filename)
+                complete.append(filename)
+        return complete
+
+    def _scan(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            self.listings.pop(directory, None)
+            return
+        listing = self.listings.get(directory)
+        if listing is None or listing[0] != mtime:
+            files, subdirectories = [], []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        subdirectories.append(entry.path)
+                    elif entry.is_file() and entry.name.endswith(capture_extensions):
+                        files.append(entry.path)
+            listing = self.listings[directory] = (mtime, files, subdirectories)
+            for filename in files:
+                if filename not in self.seen and filename not in self.pending:
+                    self.pending[filename] = (None, 0)
+        for subdirectory in listing[2]:
+            self._scan(subdirectory)
+
+
+def _log_results(futures, done):
+    for future in done:
+        filename = futures.pop(future)
+        try:
+            potiron.infomsg(future.result())
+        except Exception as e:
+            potiron.errormsg(f"Error while processing {filename}: {e}")
+
+
+if __name__ == '__main__':
+    parser = define_parser("Watch directories and store the data of the new captures in redis as soon as they are complete.",
+                           "Directories to watch")
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help=f'Seconds between two polls of the directories (default: {POLL_INTERVAL})')
+    parser.add_argument('--settle', type=float, default=SETTLE_TIME, help=f'Seconds during which the size and modification time of a capture should not change before it is processed (default: {SETTLE_TIME})')
+    args = parser.parse_args()
+    if args.formats:
+        sys.exit("The captures are only read once for several formats by parse_pcap_files.py, please use '-u' with the format to store.")
+    for directory in args.input:
+        if not os.path.isdir(directory):
+            sys.exit(f"{directory} is not a directory.")
+    format, redis_parameters, red = prepare_ingestion(args)
+    if format != 'layer2' and args.shards > 1:
+        print("The captures are processed as soon as they are complete, the '--shards' parameter will be ignored.")
+    setup, init_worker = _setup_functions[format]
+    red, to_process = setup(redis_parameters, args.console)
+    watcher = CaptureWatcher([os.path.abspath(directory) for directory in args.input], args.settle)
+    futures = {}
+    backlog = None
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(redis_parameters,)) as executor:
+        try:
+            while True:
+                start = time.monotonic()
+                complete = watcher.poll()
+                if complete:
+                    layouts = potiron.get_shard_layouts(red, complete)
+                    for filename in schedule_files(red, complete):
+                        if layouts.get(filename):
+                            potiron.errormsg(f"The import of {filename} was started in shards, it should be resumed with parse_pcap_files.py.")
+                            continue
+                        futures[executor.submit(to_process, filename)] = filename
+                current = (len(futures), len(watcher.pending))
+                if current != backlog:
+                    potiron.infomsg(f"Backlog: {current[0]} captures queued or in progress, {current[1]} captures still being written.")
+                    backlog = current
+                timeout = max(0, args.interval - (time.monotonic() - start))
+                if futures:
+                    done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                    _log_results(futures, done)
+                else:
+                    time.sleep(timeout)
+        except KeyboardInterrupt:
+            potiron.infomsg(f"Stopping, waiting for the {len(futures)} captures queued or in progress.")
+    _log_results(futures, list(futures))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Index the keys stored before the ingestion maintained the indexes read by
+# the graphs and exports, scanning the keyspace once.
+
+from lib.helpers import get_redis_connection, REDIS_RETRIES
+from potiron.potiron_index import rebuild_indexes
+import argparse
+import potiron.potiron as potiron
+import redis
+import sys
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the keys stored before the ingestion maintained the indexes.')
+    parser.add_argument('-u', '--unix', type=str, required=True, help='Unix socket to connect to redis-server')
+    parser.add_argument('-c', '--console', action='store_false', help='DO NOT log output also to console')
+    parser.add_argument('--batch_size', type=int, default=10000, help='Number of keys indexed per pipeline (default: 10000)')
+    parser.add_argument('--redis_retries', type=int, default=REDIS_RETRIES, help=f'Number of retries when redis is busy loading its data (default: {REDIS_RETRIES})')
+    args = parser.parse_args()
+    potiron.logconsole = args.console
+    red = get_redis_connection(unix_socket_path=args.unix, retries=args.redis_retries)
+    try:
+        potiron.infomsg(f"{rebuild_indexes(red, args.batch_size)} keys indexed.")
+    except redis.ConnectionError as e:
+        sys.exit(f"Could not connect to redis. {e}")
@@ -17,19 +17,20 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from bin.parse_pcap_files import fetch_files
+from bin.parse_pcap_files import check_topk, distinct_fields, fetch_files
+from lib.helpers import get_redis_connection, REDIS_RETRIES
 from pathlib import Path
+from potiron.potiron import COUNTERS_SUFFIX, get_counters_sidecar, JSON_FORMATS, read_counters_sidecar, read_json_document
 from potiron.potiron_redis import process_storage
+from potiron.potiron_time import parse_buckets
 import argparse
-import json
 import os
 import redis
 import sys
 
 
 def _pick_parameters(red, inputfile, ck):
-    with open(inputfile, 'rt', encoding='utf-8') as f:
-        packet = json.loads(f.read())[0]
+    packet = next(read_counters_sidecar(inputfile) if inputfile.endswith(COUNTERS_SUFFIX) else read_json_document(inputfile))
     format = packet['format']
     if format == 'standard':
         red.rpush('JSON_FIELDS', *packet['json_fields'])
@@ -44,12 +45,20 @@ if __name__ == '__main__':
     parser.add_argument("-c", "--console", action='store_false', help="DO NOT log output also to console")
     parser.add_argument('-u','--unix', type=str, nargs=1, required=True, help='Unix socket to connect to redis-server')
     parser.add_argument('-ck', '--combined_keys', action='store_true', help='Set if combined keys should be used')
+    parser.add_argument('--buckets', nargs='+', help='Sub-day buckets counted in addition to the days (see parse_pcap_files.py), replacing the buckets defined in the redis instance')
+    parser.add_argument('--hll', nargs='+', choices=distinct_fields, metavar='FIELD', help='Fields whose distinct values of each day are counted in HyperLogLog keys (see parse_pcap_files.py), replacing the fields defined in the redis instance')
+    parser.add_argument('--topk', nargs='+', metavar='FIELD:SIZE', help='Fields whose sorted sets only keep the given number of values with the highest counts (see parse_pcap_files.py), replacing the bounded fields defined in the redis instance')
+    parser.add_argument('--workers', type=int, help='Number of json files processed in parallel (default: number of processors)')
+    parser.add_argument('--redis_timeout', type=float, help='Timeout in seconds of the redis socket operations (default: no timeout)')
+    parser.add_argument('--redis_retries', type=int, default=REDIS_RETRIES, help=f'Number of retries when redis is busy loading its data (default: {REDIS_RETRIES})')
     args = parser.parse_args()
     logconsole = args.console
     ck = args.combined_keys
     usocket = args.unix[0]
+    redis_parameters = {'unix_socket_path': usocket, 'socket_timeout': args.redis_timeout, 'retries': args.redis_retries}
+    red = get_redis_connection(**redis_parameters)
     try:
-        red = redis.Redis(unix_socket_path=usocket, decode_responses=True)
+        red.ping()
     except redis.ConnectionError as e:
         sys.exit(f"Could not connect to redis. {e}")
     for arg in args.input:
@@ -57,7 +66,24 @@ if __name__ == '__main__':
             sys.stderr.write(f"The filename {arg} was not found\n")
             sys.exit(1)
     input_directory = [Path(arg) for arg in args.input]
-    files = [filename for directory in input_directory for filename in fetch_files(directory, ('.json',))]
-    if not red.keys("PARAMETERS"):
+    files = [filename for directory in input_directory for filename in fetch_files(directory, tuple(f'.{json_format}' for json_format in (*JSON_FORMATS, COUNTERS_SUFFIX)))]
+    # The documents with a counters sidecar are imported from their sidecar
+    sidecars = {filename for filename in files if filename.endswith(COUNTERS_SUFFIX)}
+    files = [filename for filename in files if filename in sidecars or get_counters_sidecar(filename) not in sidecars]
+    if not red.exists("PARAMETERS"):
         _pick_parameters(red, files[0], str(ck))
-    process_storage(red, files, ck, logconsole)
+    if args.buckets is not None:
+        try:
+            parse_buckets(" ".join(args.buckets))
+        except ValueError as e:
+            sys.exit(str(e))
+        red.hset('PARAMETERS', 'buckets', " ".join(args.buckets))
+    if args.hll is not None:
+        red.hset('PARAMETERS', 'hll', " ".join(args.hll))
+    if args.topk is not None:
+        try:
+            check_topk(args.topk)
+        except ValueError as e:
+            sys.exit(str(e))
+        red.hset('PARAMETERS', 'topk', " ".join(args.topk))
+    process_storage(redis_parameters, files, ck, logconsole, args.workers)
@@ -8,3 +8,7 @@ class PotironException(Exception):
 
 class MissingEnv(PotironException):
     pass
+
+
+class UnsupportedCapture(PotironException):
+    pass
@@ -3,8 +3,10 @@
 
 from .exceptions import MissingEnv
 from pathlib import Path
-from redis import StrictRedis
-from redis.exceptions import ConnectionError
+from redis import ConnectionPool, StrictRedis, UnixDomainSocketConnection
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import BusyLoadingError, ConnectionError
+from redis.retry import Retry
 import json
 import os
 
@@ -26,6 +28,12 @@ def _get_redis_backends():
 
 
 REDIS_BACKENDS = _get_redis_backends()
+# Default connection settings: no socket timeout, and 3 retries with an
+# exponential backoff when redis is loading its dataset. The commands failing
+# with a lost connection or a timeout are not sent again, as redis may have
+# applied them already: an interrupted ingestion is resumed from its journal.
+REDIS_SOCKET_TIMEOUT = None
+REDIS_RETRIES = 3
 
 
 def get_socket_path(name: str):
@@ -40,3 +48,16 @@ def check_running(name: str):
         return r.ping()
     except ConnectionError:
         return False
+
+
+# Open a pooled connection to the redis server listening on a unix socket.
+# The ingestion modules call it in the initializer of each worker of their
+# ProcessPoolExecutor, so every process owns its connections instead of
+# sharing the socket of a client created before the fork.
+def get_redis_connection(unix_socket_path, decode_responses=True, socket_timeout=REDIS_SOCKET_TIMEOUT,
+                         retries=REDIS_RETRIES, max_connections=None):
+    pool = ConnectionPool(connection_class=UnixDomainSocketConnection, path=unix_socket_path,
+                          decode_responses=decode_responses, socket_timeout=socket_timeout,
+                          socket_connect_timeout=socket_timeout, max_connections=max_connections,
+                          retry=Retry(ExponentialBackoff(), retries, supported_errors=(BusyLoadingError,)))
+    return StrictRedis(connection_pool=pool)
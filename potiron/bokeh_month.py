@@ -21,19 +21,20 @@ import redis
 import argparse
 import sys
 import os
-import calendar
 import potiron
+import potiron_query
 import export_csv_all_days_per_month
 from bokeh.plotting import figure, show, output_file, save
 from bokeh.models import Range1d,OpenURL,TapTool,HoverTool,BasicTickFormatter,PanTool, BoxZoomTool,ResetTool,SaveTool,WheelZoomTool,ColumnDataSource
 from bokeh.palettes import Category10_10 as palette
 from potiron_graph_annotation import plot_annotation, field2string, create_dict, def_legend
+from potiron_time import parse_buckets
 from PIL import Image
 
 
 class Bokeh_Month(object):
     
-    def __init__(self, red, source, field, date, fieldvalues, outputdir, logofile, links):
+    def __init__(self, red, source, field, date, fieldvalues, outputdir, logofile, links, bucket=None):
         self.plot_width = 1700
         self.plot_height = 900
         self.logo_y_scale = 13
@@ -45,6 +46,7 @@ class Bokeh_Month(object):
         self.outputdir = outputdir
         self.logofile = logofile
         self.links = links
+        self.bucket = bucket
     
     def set_date(self, date):
         self.date = date
@@ -72,6 +74,17 @@ class Bokeh_Month(object):
             return "{}{}_{}-{}_{}{}".format(self.outputdir,self.source,self.date[0:4],self.date[4:6],field_in_file_name,value_str)
 
 
+    # Scores of a value for each day of the month having a sorted set, or for
+    # each sub-day bucket of these days with a bucket width, read with a single
+    # pipeline (see potiron_query). The buckets are placed at their fraction
+    # of their day.
+    def value_scores(self, value, protocol=None):
+        if self.bucket is not None:
+            buckets, scores = potiron_query.bucket_series(self.red, self.source, self.field, [value], self.bucket, "{}01".format(self.date), "{}31".format(self.date), protocol)
+            return [int(bucket[6:8]) + (int(bucket[8:10]) * 60 + int(bucket[10:12])) / 1440 for bucket in buckets], scores[0].tolist(), scores.any()
+        days, scores = potiron_query.series(self.red, self.source, self.field, [value], "{}01".format(self.date), "{}31".format(self.date), protocol)
+        return [day[-2:] for day in days], scores[0].tolist(), scores.any()
+
     def process_file(self):
         potiron_path = potiron.potiron_path
         lentwo = False
@@ -119,7 +132,6 @@ class Bokeh_Month(object):
         p = figure(width=self.plot_width,height=self.plot_height,tools=TOOLS)
         # Definition of some variables which will be used and modified with the iterations
         at_least_one = False
-        days = calendar.monthrange(int(self.date[0:4]),int(self.date[4:6]))[1]
         maxVal = 0
         minVal = sys.maxsize
         maxDay = 0
@@ -134,21 +146,8 @@ class Bokeh_Month(object):
                 protocol = value[1]
                 if protocol == "*" or protocol == "all":
                     for prot in protocols:
-                        score=[]
-                        dayValue=[]
                         proto = prot.decode()
-                        exists = False
-                        keys = self.red.keys("{}:{}:{}*:{}".format(self.source,proto,self.date,self.field))
-                        for k in sorted(keys):
-                            redisKey = k.decode()
-                            day = redisKey.split(':')[2][-2:]
-                            countValue = self.red.zscore(redisKey, actual_field)
-                            if countValue is not None:
-                                exists = True
-                                score.append(countValue)
-                            else:
-                                score.append(0)
-                            dayValue.append(day)
+                        dayValue, score, exists = self.value_scores(actual_field, proto)
                         if exists:
                             at_least_one = True
                             # We define the color of the line, draw it
@@ -180,20 +179,7 @@ class Bokeh_Month(object):
                             actual_value = "{}-{}".format(actual_field, protocol)
                             actual_values.append(actual_value)
                 else:
-                    score=[]
-                    dayValue=[]
-                    exists = False
-                    keys = self.red.keys("{}:{}:{}*:{}".format(self.source,protocol,self.date,self.field))
-                    for k in sorted(keys):
-                        redisKey = k.decode()
-                        day = redisKey.split(':')[2][-2:]
-                        countValue = self.red.zscore(redisKey, actual_field)
-                        if countValue is not None:
-                            exists = True
-                            score.append(countValue)
-                        else:
-                            score.append(0)
-                        dayValue.append(day)
+                    dayValue, score, exists = self.value_scores(actual_field, protocol)
                     if exists: # If at least one occurrence for the current value of field has been found
                         at_least_one = True
                         # We define the color of the line, draw it
@@ -215,38 +201,8 @@ class Bokeh_Month(object):
                         actual_value = "{}-{}".format(actual_field, protocol)
                         actual_values.append(actual_value)
             else: # on the other case, we don't split informations for each protocol
-                score=[]
-                dayValue=[]
-                exists = False
-                # If combined keys are used, we must by the way take data from all the keys (i.e for each protocol)
-                if ck:
-                    for d in range(1,days+1): # For each day with data stored in redis
-                        exists_day = False
-                        day = format(d, '02d')
-                        countValue = 0
-                        keys = self.red.keys("{}:*:{}{}:{}".format(self.source,self.date,day,self.field))
-                        for k in keys:
-                            redisKey = k.decode()
-                            tmpscore = self.red.zscore(redisKey, actual_field)
-                            countValue += tmpscore if tmpscore is not None else 0
-                            exists_day = True
-                        if exists_day:
-                            if countValue > 0:
-                                exists = True
-                            score.append(countValue)
-                            dayValue.append(day)
-                else: # When combined keys are not used, we only need to read the scores for each day
-                    keys = self.red.keys("{}:{}*:{}".format(self.source,self.date,self.field))
-                    for k in sorted(keys):
-                        redisKey = k.decode()
-                        day = redisKey.split(':')[2][-2:]
-                        countValue = self.red.zscore(redisKey, actual_field)
-                        if countValue is not None:
-                            exists = True
-                            score.append(countValue)
-                        else:
-                            score.append(0)
-                        dayValue.append(day)
+                # If combined keys are used, the scores of all the protocols are summed
+                dayValue, score, exists = self.value_scores(actual_field)
                 if exists: # If at least one occurrence for the current value of field has been found
                     at_least_one = True
                     # We define the color of the line, draw it
@@ -282,17 +238,18 @@ class Bokeh_Month(object):
                     actual_value = "{}".format(actual_field)
                     actual_values.append(actual_value)
         if at_least_one: # If at least one value has been found in redis with our selection
-            if lentwo: # Defines the name of the files to call with a click on a point in the plot
+            # Defines the name of the files to call with a click on a point in the plot (the files of the days do not match the points of the buckets)
+            if lentwo and self.bucket is None:
                 taptool.callback = OpenURL(url="{}_{}_with-protocols_{}-{}-@protocol.html".format(self.source,
                                            field_in_file_name,self.date[0:4],self.date[4:6]))
-            else:
+            elif self.bucket is None:
                 taptool.callback = OpenURL(url="{}_{}_{}-{}-@x.html".format(self.source,
                                            field_in_file_name,self.date[0:4],self.date[4:6]))
             output_file("{}.html".format(namefile), title=namefile.split("/")[-1])
             # Definition of some parameters of the graph
             fieldvalues_string = plot_annotation(self.field, potiron_path, actual_values, field_string, field_data)
-            p.title.text = "Number of {} {}seen each day in {} {}".format(field_string, 
-                                      fieldvalues_string, potiron.year[self.date[4:6]], self.date[0:4])
+            p.title.text = "Number of {} {}seen each {} in {} {}".format(field_string, fieldvalues_string,
+                                      "day" if self.bucket is None else "{} bucket".format(self.bucket), potiron.year[self.date[4:6]], self.date[0:4])
             p.yaxis[0].formatter = BasicTickFormatter(use_scientific=False)
             p.xaxis.axis_label = "Days"
             p.yaxis.axis_label = "Count"
@@ -333,6 +290,7 @@ if __name__ == '__main__':
     parser.add_argument('-o','--outputdir', type=str, nargs=1, help='Destination path for the output file')
     parser.add_argument('--logo', type=str, nargs=1, help='Path of the logo file to display')
     parser.add_argument('--links', action='store_true', help='Used if you want to process the graphs usefull to have working links')
+    parser.add_argument('-b', '--bucket', type=str, nargs=1, help='Display one point per sub-day bucket of the given width (ex: "1h"), counted with the --buckets option of the import')
     args = parser.parse_args()
 
     if args.source is None: # Source sensor
@@ -386,6 +344,15 @@ if __name__ == '__main__':
     
     # If true, export_csv_all_days_per_month module will be called to generate the files pointed by each link
     links = args.links
-    
-    bokeh = Bokeh_Month(red, source, field, date, fieldvalues, outputdir, logofile, links)
+
+    if args.bucket is None: # Width of the sub-day buckets to display
+        bucket = None
+    else:
+        bucket = args.bucket[0]
+        buckets = red.hget('PARAMETERS', 'buckets')
+        if bucket not in parse_buckets(buckets.decode() if buckets else ""):
+            sys.stderr.write('The buckets of this width are not counted in this redis dataset.\n')
+            sys.exit(1)
+
+    bokeh = Bokeh_Month(red, source, field, date, fieldvalues, outputdir, logofile, links, bucket)
     bokeh.process_file()
@@ -21,12 +21,13 @@ import argparse
 import sys
 import os
 import potiron
-import calendar
+import potiron_query
 from datetime import datetime as dt
 from bokeh.plotting import figure, show, output_file, save
 from bokeh.models import Range1d,OpenURL,TapTool,HoverTool,BasicTickFormatter,PanTool, BoxZoomTool,ResetTool,SaveTool,WheelZoomTool,ColumnDataSource
 from bokeh.palettes import Category10_10 as palette
 from potiron_graph_annotation import plot_annotation, field2string, create_dict, def_legend
+from potiron_time import parse_buckets
 from PIL import Image
 
 potiron_path = potiron.potiron_path
@@ -34,6 +35,26 @@ plot_width = 1700
 plot_height = 900
 logo_y_scale = 13
 
+
+# Scores of a value for each month (read from the month roll-up keys when
+# they are up to date), for each day having a sorted set, or for each sub-day
+# bucket of these days with a bucket width, all read with a single pipeline
+# (see potiron_query)
+def value_scores(red, source, field, value, months, monthly, protocol=None, bucket=None):
+    if bucket is not None:
+        buckets, scores = potiron_query.bucket_series(red, source, field, [value], bucket, "{}01".format(months[0]), "{}31".format(months[-1]), protocol)
+        scores = scores[0]
+        dates = [dt.strptime(start, "%Y%m%d%H%M") for start in buckets]
+    elif monthly:
+        scores = potiron_query.matrix(red, source, field, [value], months, protocol)[0]
+        dates = [dt.strptime(month, "%Y%m") for month in months]
+    else:
+        days, scores = potiron_query.series(red, source, field, [value], "{}01".format(months[0]), "{}31".format(months[-1]), protocol)
+        scores = scores[0]
+        dates = [dt.strptime(day, "%Y%m%d") for day in days]
+    return dates, scores.tolist(), scores.any()
+
+
 def output_name(outputdir, source, date, field_in_file_name, fieldvalues):
     value_str = ""
     written = []
@@ -82,7 +103,9 @@ if __name__ == '__main__':
     parser.add_argument('-u','--unix', type=str, nargs=1, help='Unix socket to connect to redis-server.')
     parser.add_argument('-o','--outputdir', type=str, nargs=1, help='Destination path for the output file')
     parser.add_argument('--logo', type=str, nargs=1, help='Path of the logo file to display')
+    parser.add_argument('-m', '--monthly', action='store_true', help='Display one point per month, read from the month roll-up keys when they are up to date (see bin/compact_rollups.py) instead of the keys of each day')
 #    parser.add_argument('--links', action='store_true', help='Can be used if you want to process the graphs usefull to have working links')
+    parser.add_argument('-b', '--bucket', type=str, nargs=1, help='Display one point per sub-day bucket of the given width (ex: "1h"), counted with the --buckets option of the import')
     parser.add_argument('-tl', '--timeline', type=str, nargs=1, help='Used to define the duration of the sample to display')
     args = parser.parse_args()
     
@@ -150,6 +173,18 @@ if __name__ == '__main__':
         timeline = 6
     else:
         timeline = int(args.timeline[0])
+
+    if args.bucket is None: # Width of the sub-day buckets to display
+        bucket = None
+    else:
+        bucket = args.bucket[0]
+        buckets = red.hget('PARAMETERS', 'buckets')
+        if bucket not in parse_buckets(buckets.decode() if buckets else ""):
+            sys.stderr.write('The buckets of this width are not counted in this redis dataset.\n')
+            sys.exit(1)
+        if args.monthly:
+            sys.stderr.write('The buckets cannot be displayed with one point per month.\n')
+            sys.exit(1)
     
     # If true, export_csv_all_days_per_month module will be called to generate the files pointed by each link
 #    links = args.links
@@ -179,6 +214,8 @@ if __name__ == '__main__':
     # Definition of the protocols currently present in our dataset
     protocols = red.smembers('PROTOCOLS')
     tab_date = tab_date(date, timeline)
+    monthly = args.monthly
+    months = tab_date
     namefile = output_name(outputdir, source, tab_date, field_in_file_name, fieldvalues)
     
     if all_proto:
@@ -203,25 +240,8 @@ if __name__ == '__main__':
             protocol = value[1]
             if protocol == "*" or protocol == "all":
                 for prot in protocols:
-                    score = []
-                    dayValue = []
                     proto = prot.decode()
-                    exists = False
-                    for dateval in tab_date:
-                        keys = red.keys("{}:{}:{}*:{}".format(source, proto, dateval, field))
-                        year = dateval[0:4]
-                        month = dateval[4:6]
-                        for k in sorted(keys):
-                            redisKey = k.decode()
-                            day = redisKey.split(':')[2][-2:]
-                            countValue = red.zscore(redisKey, actual_field)
-                            if countValue is not None:
-                                exists = True
-                                score.append(countValue)
-                            else:
-                                score.append(0)
-                            dayval = "{}-{}-{}".format(year, month, day)
-                            dayValue.append(dt.strptime(dayval, "%Y-%m-%d"))
+                    dayValue, score, exists = value_scores(red, source, field, actual_field, months, monthly, proto, bucket)
                     if exists:
                         at_least_one = True
                         # We define the color of the line, draw it
@@ -244,24 +264,7 @@ if __name__ == '__main__':
                         actual_value = "{}-{}".format(actual_field, protocol)
                         actual_values.append(actual_value)
             else:
-                score=[]
-                dayValue=[]
-                exists = False
-                for dateval in tab_date:
-                    keys = red.keys("{}:{}:{}*:{}".format(source, protocol, dateval, field))
-                    year = dateval[0:4]
-                    month = dateval[4:6]
-                    for k in sorted(keys):
-                        redisKey = k.decode()
-                        day = redisKey.split(':')[2][-2:]
-                        countValue = red.zscore(redisKey, actual_field)
-                        if countValue is not None:
-                            exists = True
-                            score.append(countValue)
-                        else:
-                            score.append(0)
-                        dayval = "{}-{}-{}".format(year, month, day)
-                        dayValue.append(dt.strptime(dayval, "%Y-%m-%d"))
+                dayValue, score, exists = value_scores(red, source, field, actual_field, months, monthly, protocol, bucket)
                 if exists: # If at least one occurrence for the current value of field has been found
                     at_least_one = True
                     # We define the color of the line, draw it
@@ -278,47 +281,7 @@ if __name__ == '__main__':
                     actual_value = "{}-{}".format(actual_field, protocol)
                     actual_values.append(actual_value)
         else: # on the other case, we don't split informations for each protocol
-            score=[]
-            dayValue=[]
-            exists = False
-            # If combined keys are used, we must by the way take data from all the keys (i.e for each protocol)
-            if ck:
-                for m in tab_date:
-                    days = calendar.monthrange(int(m[0:4]),int(m[4:6]))[1]
-                    year = m[0:4]
-                    month = m[4:6]
-                    for d in range(1,days+1):
-                        exists_day = False
-                        day = format(d, '02d')
-                        countValue = 0
-                        keys = red.keys("{}:*:{}{}{}:{}".format(source,year,month,day,field))
-                        for k in keys:
-                            redisKey = k.decode()
-                            tmpscore = red.zscore(redisKey, actual_field)
-                            countValue += tmpscore if tmpscore is not None else 0
-                            exists_day = True
-                        if exists_day:
-                            if countValue > 0:
-                                exists = True
-                            score.append(countValue)
-                            dayval = "{}-{}-{}".format(year, month, day)
-                            dayValue.append(dt.strptime(dayval, "%Y-%m-%d"))
-            else: # When combined keys are not used, we only need to read the scores for each day
-                for dateval in tab_date:
-                    keys = red.keys("{}:{}*:{}".format(source,dateval,field))
-                    year = dateval[0:4]
-                    month = dateval[4:6]
-                    for k in sorted(keys):
-                        redisKey = k.decode()
-                        day = redisKey.split(':')[2][-2:]
-                        countValue = red.zscore(redisKey, actual_field)
-                        if countValue is not None:
-                            exists = True
-                            score.append(countValue)
-                        else:
-                            score.append(0)
-                        dayval = "{}-{}-{}".format(year, month, day)
-                        dayValue.append(dt.strptime(dayval, "%Y-%m-%d"))
+            dayValue, score, exists = value_scores(red, source, field, actual_field, months, monthly, None, bucket)
             if exists:
                 at_least_one = True
                 # We define the color of the line, draw it
@@ -346,7 +309,7 @@ if __name__ == '__main__':
     if at_least_one:
         output_file("{}.html".format(namefile), title=namefile.split("/")[-1])
         fieldvalues_string = plot_annotation(field, potiron_path, actual_values, field_string, field_data)
-        p.title.text = "Number of {} {}seen each day between {} {} and {} {}".format(field_string, fieldvalues_string, 
+        p.title.text = "Number of {} {}seen each {} between {} {} and {} {}".format(field_string, fieldvalues_string, "month" if monthly else "day" if bucket is None else "{} bucket".format(bucket),
                                   potiron.year[tab_date[0][4:6]], tab_date[0][0:4], potiron.year[tab_date[-1][4:6]], tab_date[-1][0:4])
         p.yaxis[0].formatter = BasicTickFormatter(use_scientific=False)
         p.xaxis.axis_label = "Date"
@@ -21,7 +21,7 @@ import argparse
 import sys
 import os
 import potiron
-import calendar
+import potiron_query
 from datetime import datetime as dt
 from bokeh.plotting import figure, show, output_file, save
 from bokeh.models import Range1d,OpenURL,TapTool,HoverTool,BasicTickFormatter,PanTool, BoxZoomTool,ResetTool,SaveTool,WheelZoomTool,ColumnDataSource
@@ -34,6 +34,21 @@ plot_width = 1700
 plot_height = 900
 logo_y_scale = 13
 
+
+# Scores of a value for each month (read from the month roll-up keys when
+# they are up to date) or for each day having a sorted set, all read with a
+# single pipeline (see potiron_query)
+def value_scores(red, source, field, value, months, monthly, protocol=None):
+    if monthly:
+        scores = potiron_query.matrix(red, source, field, [value], months, protocol)[0]
+        dates = [dt.strptime(month, "%Y%m") for month in months]
+    else:
+        days, scores = potiron_query.series(red, source, field, [value], "{}01".format(months[0]), "{}31".format(months[-1]), protocol)
+        scores = scores[0]
+        dates = [dt.strptime(day, "%Y%m%d") for day in days]
+    return dates, scores.tolist(), scores.any()
+
+
 def output_name(outputdir, source, date, field_in_file_name, fieldvalues):
     value_str = ""
     written = []
@@ -63,6 +78,7 @@ if __name__ == '__main__':
     parser.add_argument('-u','--unix', type=str, nargs=1, help='Unix socket to connect to redis-server.')
     parser.add_argument('-o','--outputdir', type=str, nargs=1, help='Destination path for the output file')
     parser.add_argument('--logo', type=str, nargs=1, help='Path of the logo file to display')
+    parser.add_argument('-m', '--monthly', action='store_true', help='Display one point per month, read from the month roll-up keys when they are up to date (see bin/compact_rollups.py) instead of the keys of each day')
 #    parser.add_argument('--links', action='store_true', help='Used if you want to process the graphs usefull to have working links')
     args = parser.parse_args()
     
@@ -153,6 +169,8 @@ if __name__ == '__main__':
     
     # Definition of the protocols currently present in our dataset
     protocols = red.smembers('PROTOCOLS')
+    monthly = args.monthly
+    months = ["{}{}".format(date, format(m, "02d")) for m in range(1, 13)]
     
     namefile = output_name(outputdir, source, date, field_in_file_name, fieldvalues)
     
@@ -178,23 +196,8 @@ if __name__ == '__main__':
             protocol = value[1]
             if protocol == "*" or protocol == "all":
                 for prot in protocols:
-                    score = []
-                    dayValue = []
                     proto = prot.decode()
-                    exists = False
-                    keys = red.keys("{}:{}:{}*:{}".format(source, proto, date, field))
-                    for k in sorted(keys):
-                        redisKey = k.decode()
-                        month = redisKey.split(':')[2][4:-2]
-                        day = redisKey.split(':')[2][-2:]
-                        countValue = red.zscore(redisKey, actual_field)
-                        if countValue is not None:
-                            exists = True
-                            score.append(countValue)
-                        else:
-                            score.append(0)
-                        dayval = "{}-{}-{}".format(date, month, day)
-                        dayValue.append(dt.strptime(dayval, "%Y-%m-%d"))
+                    dayValue, score, exists = value_scores(red, source, field, actual_field, months, monthly, proto)
                     if exists:
                         at_least_one = True
                         # We define the color of the line, draw it
@@ -217,22 +220,7 @@ if __name__ == '__main__':
                         actual_value = "{}-{}".format(actual_field, protocol)
                         actual_values.append(actual_value)
             else:
-                score=[]
-                dayValue=[]
-                exists = False
-                keys = red.keys("{}:{}:{}*:{}".format(source, protocol, date, field))
-                for k in sorted(keys):
-                    redisKey = k.decode()
-                    month = redisKey.split(':')[2][4:-2]
-                    day = redisKey.split(':')[2][-2:]
-                    countValue = red.zscore(redisKey, actual_field)
-                    if countValue is not None:
-                        exists = True
-                        score.append(countValue)
-                    else:
-                        score.append(0)
-                    dayval = "{}-{}-{}".format(date, month, day)
-                    dayValue.append(dt.strptime(dayval, "%Y-%m-%d"))
+                dayValue, score, exists = value_scores(red, source, field, actual_field, months, monthly, protocol)
                 if exists: # If at least one occurrence for the current value of field has been found
                     at_least_one = True
                     # We define the color of the line, draw it
@@ -249,44 +237,7 @@ if __name__ == '__main__':
                     actual_value = "{}-{}".format(actual_field, protocol)
                     actual_values.append(actual_value)
         else: # on the other case, we don't split informations for each protocol
-            score=[]
-            dayValue=[]
-            exists = False
-            # If combined keys are used, we must by the way take data from all the keys (i.e for each protocol)
-            if ck:
-                for m in range(1,13):
-                    days = calendar.monthrange(int(date),m)[1]
-                    month = format(m, '02d')
-                    for d in range(1,days+1):
-                        exists_day = False
-                        day = format(d, '02d')
-                        countValue = 0
-                        keys = red.keys("{}:*:{}{}{}:{}".format(source,date,month,day,field))
-                        for k in keys:
-                            redisKey = k.decode()
-                            tmpscore = red.zscore(redisKey, actual_field)
-                            countValue += tmpscore if tmpscore is not None else 0
-                            exists_day = True
-                        if exists_day:
-                            if countValue > 0:
-                                exists = True
-                            score.append(countValue)
-                            dayval = "{}-{}-{}".format(date, month, day)
-                            dayValue.append(dt.strptime(dayval, "%Y-%m-%d"))
-            else: # When combined keys are not used, we only need to read the scores for each day
-                keys = red.keys("{}:{}*:{}".format(source,date,field))
-                for k in sorted(keys):
-                    redisKey = k.decode()
-                    month = redisKey.split(':')[2][4:-2]
-                    day = redisKey.split(':')[2][-2:]
-                    countValue = red.zscore(redisKey, actual_field)
-                    if countValue is not None:
-                        exists = True
-                        score.append(countValue)
-                    else:
-                        score.append(0)
-                    dayval = "{}-{}-{}".format(date, month, day)
-                    dayValue.append(dt.strptime(dayval, "%Y-%m-%d"))
+            dayValue, score, exists = value_scores(red, source, field, actual_field, months, monthly)
             if exists:
                 at_least_one = True
                 # We define the color of the line, draw it
@@ -314,7 +265,7 @@ if __name__ == '__main__':
     if at_least_one:
         output_file("{}.html".format(namefile), title=namefile.split("/")[-1])
         fieldvalues_string = plot_annotation(field, potiron_path, actual_values, field_string, field_data)
-        p.title.text = "Number of {} {}seen each day in {}".format(field_string, fieldvalues_string, date)
+        p.title.text = "Number of {} {}seen each {} in {}".format(field_string, fieldvalues_string, "month" if monthly else "day", date)
         p.yaxis[0].formatter = BasicTickFormatter(use_scientific=False)
         p.xaxis.axis_label = "Date"
         p.yaxis.axis_label = "Count"
@@ -18,6 +18,7 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import potiron
 import redis
 import sys
 import os
@@ -59,8 +60,7 @@ if __name__ == '__main__':
     mat = {}
     mactab = []
     
-    for k in red.keys(redisKey):
-        key = k.decode()
+    for key in potiron.hash_keys(red, source, redisKey, date):
         ip = key.split('_')[1]
         mac = red.hget(key, 'rep_src_arp_mac')
         if mac is None:
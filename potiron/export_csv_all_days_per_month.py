@@ -23,6 +23,7 @@ import sys
 import os
 import calendar
 import potiron
+import potiron_query
 import bokeh_month
 from potiron_graph_annotation import field2string,bubble_annotation
 
@@ -30,7 +31,6 @@ from potiron_graph_annotation import field2string,bubble_annotation
 class Export_Csv(object):
     
     def __init__(self, red, source, date, field, limit, skip, outputdir, links, gen, logofile, ck, lentwo):
-        self.MAXVAL = sys.maxsize
         self.red = red
         self.source = source
         self.date = date
@@ -51,61 +51,14 @@ class Export_Csv(object):
         return data_part, date_part
     
     
-    # Store in a dictionary of scores the scores of each value tu display, for all the protocols (in case of combined keys)
-    def process_score(self, redisKey, score):
-        for v in self.red.zrevrangebyscore(redisKey,self.MAXVAL,0):
-            countValue = self.red.zscore(redisKey,v)
-            val = v.decode()
-            if val in self.skip: # If the current value has to be skipped, go to the next iteration of the loop
-                continue
-            if val in score: # If the current value is already present in the list of values, increment the score with the current score
-                score[val] += countValue
-            else: # On the other  case, add the value with its score in the list
-                score[val] = countValue
-             
-                
-    # Search the scores in the ranged list of values, and write them in the output .csv file
-    def process_file(self, redisKey, name, protocol, field_string):
-        l = 0
-        values = []
-        # For each value ranged in decreasing order
-        for v in self.red.zrevrangebyscore(redisKey,self.MAXVAL,0):
-            val = v.decode()
-            # If the current value is not one that should be skipped, increment the number of values to include in the chart
-            if val not in self.skip :
-                values.append(val)
-                l += 1
-            # When the limit value is reached, we don't need to increment anymore, we break the loop
-            if l >= self.limit:
-                break
-        # Write all the values and their scores into the csv datafile
+    # Write the top values and their scores into the csv datafile
+    def process_file(self, values, scores, name, protocol, field_string):
         with open("{}.csv".format(name),'w') as f:
             f.write("id,value\n")
-            for v in values:
+            for v, score in zip(values, scores):
                 val = bubble_annotation(self.field,field_string,v,potiron.potiron_path,protocol)
                 f.write("{}{},\n".format(v,val))
-                f.write("{}{},{}\n".format(v,val,self.red.zscore(redisKey,v)))
-        return values
-        
-                
-    # Sort the scores after the values for all protocols has been counted (in case of comined keys),
-    # and write the top values in the output datafile
-    def process_general_file(self, score, namefile, field_string):
-        res = list(sorted(score, key=score.__getitem__, reverse=True))
-        l = 0
-        values = []
-        for s in res:
-            if s not in self.skip:
-                values.append(s)
-                l+=1
-            if l >= self.limit:
-                break
-        with open("{}.csv".format(namefile), 'w') as f:
-            f.write("id,value\n")
-            for v in values :
-                val = bubble_annotation(self.field,field_string,v,potiron.potiron_path,None)
-                f.write("{}{},\n".format(v,val))
-                f.write("{}{},{}\n".format(v,val,int(score[v])))
+                f.write("{}{},{}\n".format(v,val,int(score)))
         return values
     
     
@@ -133,50 +86,44 @@ class Export_Csv(object):
         if self.links:
             bokeh = bokeh_month.Bokeh_Month(self.red, self.source, self.field, self.date, [], self.outputdir, self.logofile, False)
         days = calendar.monthrange(int(self.date[0:4]),int(self.date[4:6]))[1]
+        month_keys = {}
+        if self.ck:
+            keys = potiron.protocol_day_keys(self.red, self.source, self.field, self.date)
+        else:
+            keys = potiron.day_keys(self.red, self.source, self.field, self.date)
+        for redisKey in keys:
+            month_keys.setdefault(redisKey.split(':')[-2], []).append(redisKey)
         for d in range(1,days+1): # For each day of the month
             namefile_data, namefile_date = self.output_name(field_in_file_name,format(d, '02d'))
             day = format(d, '02d')
-            keys = self.red.keys("{}:*{}{}:{}".format(self.source,self.date,day,self.field))
+            keys = month_keys.get("{}{}".format(self.date,day), [])
             # While call from bokeh module, lentwo means that a value has the format 'value-protocol'
             # here, it comes from the '-p' (= '--without-protocol') parameter (USING THE PARAMETER SET THE VARIABLE TO FALSE)
             # on both cases, True means separate the protocols, and False means take the complete scores with all the protocols together
             if self.lentwo:
-                score = {}
-                for k in keys:
-                    redisKey = k.decode()
+                for redisKey in keys:
                     protocol = redisKey.split(':')[1]
                     namefile = "{}_with-protocols_{}_{}".format(namefile_data, namefile_date, protocol)
-                    val = self.process_file(redisKey, namefile, protocol, field_string) # we create and process the output datafile
-                    self.process_score(redisKey, score) # update the complete scores
+                    values, scores = potiron_query.topn(self.red, self.source, self.field, redisKey.split(':')[-2], self.limit, self.skip, protocol)
+                    val = self.process_file(values, scores, namefile, protocol, field_string) # we create and process the output datafile
                     if self.links: 
                         for v in val: # for each bubble in the chart, we create the bokeh plot corresponding to the value
                             self.generate_links('{}-all-protocols'.format(v), namefile, bokeh)
                 # the complete scores with protocols together are processed and the result in written in another datafile
                 general_namefile = "{}_with-protocols_{}".format(namefile_data, namefile_date)
-                res = self.process_general_file(score, general_namefile, field_string)
+                values, scores = potiron_query.topn(self.red, self.source, self.field, "{}{}".format(self.date,day), self.limit, self.skip)
+                res = self.process_file(values, scores, general_namefile, None, field_string)
                 if self.links:
                     for v in res: # for each bubble in the chart, we create the bokeh plot corresponding to the value
                         self.generate_links('{}-all-protocols'.format(v), namefile, bokeh)
-            else: # On the other case, we want to have the complete score for all the protocols together
-                if self.ck: # if combined keys are used anyway
-                    score = {}
-                    for k in keys: # we take the scores for each protocol
-                        redisKey = k.decode()
-                        self.process_score(redisKey, score)
-                    # the scores of each protocol are added together and wirtten in one unique datafile
-                    general_namefile = "{}_{}".format(namefile_data, namefile_date)
-                    res = self.process_general_file(score, general_namefile, field_string)
-                    if self.links:
-                        for v in res: # for each bubble in the chart, we create the bokeh plot corresponding to the value
-                            self.generate_links(v, general_namefile, bokeh)
-                else: # no combined keys
-                    # here is the basic case where each score comes from one key, and there is one key per day
-                    redisKey = k.decode()
-                    namefile = "{}_{}".format(namefile_data, namefile_date)
-                    val = self.process_file(redisKey, namefile, None, field_string)
-                    if self.links:
-                        for v in val: # for each bubble in the chart, we create the bokeh plot corresponding to the value
-                            self.generate_links(v, namefile, bokeh)
+            elif self.ck or keys: # On the other case, we want to have the complete score for all the protocols together
+                # if combined keys are used, the scores of all the protocols are summed
+                namefile = "{}_{}".format(namefile_data, namefile_date)
+                values, scores = potiron_query.topn(self.red, self.source, self.field, "{}{}".format(self.date,day), self.limit, self.skip)
+                val = self.process_file(values, scores, namefile, None, field_string)
+                if self.links:
+                    for v in val: # for each bubble in the chart, we create the bokeh plot corresponding to the value
+                        self.generate_links(v, namefile, bokeh)
                                 
         if self.gen:  # Generate all the html files to display the charts, from the datafiles, following the template
             name_string = '##NAME##'
@@ -22,13 +22,11 @@ import argparse
 import sys
 import os
 import potiron
+import potiron_query
 import bokeh_month
 from potiron_graph_annotation import field2string,bubble_annotation
 
 
-MAXVAL = sys.maxsize
-
-
 # Definition of the output file name
 def output_name(source, field, date, dest):
     data_part = "{}{}_{}".format(dest,source,field)
@@ -36,64 +34,17 @@ def output_name(source, field, date, dest):
     return data_part, date_part
 
 
-# Store in a disctionary of scores the scores of each value tu display, for all the protocols (in case of combined keys)
-def process_score(red, redisKey, score, skip):
-    for v in red.zrevrangebyscore(redisKey,MAXVAL,0):
-        countValue = red.zscore(redisKey,v)
-        val = v.decode()
-        if val in skip: # If the current value has to be skipped, go to the next iteration of the loop
-            continue
-        if val in score: # If the current value is already present in the list of values, increment the score with the current score
-            score[val] += countValue
-        else: # On the other  case, add the value with its score in the list
-            score[val] = countValue
-
-
-# Search the scores in the ranged list of values, and write them in the output .csv file
-def process_file(red, redisKey, name, field, protocol, field_string, skip, limit):
-    l = 0
-    values = []
-    # For each value ranged in decreasing order
-    for v in red.zrevrangebyscore(redisKey,MAXVAL,0):
-        val = v.decode()
-        # If the current value is not one that should be skipped, increment the number of values to include in the chart
-        if val not in skip :
-            values.append(val)
-            l += 1
-        # When the limit value is reached, we don't need to increment anymore, we break the loop
-        if l >= limit:
-            break
-    # Write all the values and their scores into the csv datafile
+# Write the top values and their scores into the csv datafile
+def process_file(values, scores, name, field, protocol, field_string):
     with open("{}.csv".format(name),'w') as f:
         f.write("id,value\n")
-        for v in values:
+        for v, score in zip(values, scores):
             val = bubble_annotation(field,field_string,v,potiron_path,protocol)
             f.write("{}{},\n".format(v,val))
-            f.write("{}{},{}\n".format(v,val,red.zscore(redisKey,v)))
+            f.write("{}{},{}\n".format(v,val,int(score)))
     return values
 
 
-# Sort the scores after the values for all protocols has been counted (in case of comined keys),
-# and write the top values in the output datafile
-def process_general_file(score, namefile, field, field_string, skip, limit):
-    res = list(sorted(score, key=score.__getitem__, reverse=True))
-    l = 0
-    values = []
-    for s in res:
-        if s not in skip:
-            values.append(s)
-            l+=1
-        if l >= limit:
-            break
-    with open("{}.csv".format(namefile), 'w') as f:
-        f.write("id,value\n")
-        for v in values :
-            val = bubble_annotation(field,field_string,v,potiron_path,None)
-            f.write("{}{},\n".format(v,val))
-            f.write("{}{},{}\n".format(v,val,int(score[v])))
-    return values
-           
-
 # Call the bokeh function to create a plot with the scores of the "field" "v" in the current month defined by "date"
 def generate_links(red, source, field, date, v, outputdir, logofile, namefile, wp, bokeh):
     n = namefile.split('/')
@@ -207,44 +158,31 @@ if links:
 # Definition of the strings containing the informations of the field, used in the legend and the file name
 field_string, field_in_file_name = field2string(field, potiron_path)
 namefile_data, namefile_date = output_name(source,field_in_file_name,date,outputdir)
-keys = red.keys("{}:*{}:{}".format(source,date,field))
+keys = potiron.protocol_day_keys(red, source, field, date) if ck else potiron.day_keys(red, source, field, date)
 if with_protocols: # variable is True, the parameter has not been called, so we process data for each protocol
-    score = {}
-    for k in keys:
-        redisKey = k.decode()
+    for redisKey in keys:
         protocol = redisKey.split(':')[1]
         namefile = "{}_with-protocols_{}_{}".format(namefile_data,namefile_date,protocol)
-        val = process_file(red, redisKey, namefile, field, protocol, field_string, skip, limit)  # we create and process the output datafile
-        process_score(red, redisKey, score, skip)  # update the complete scores
+        values, scores = potiron_query.topn(red, source, field, date, limit, skip, protocol) # Top values of the protocol
+        val = process_file(values, scores, namefile, field, protocol, field_string)  # we create and process the output datafile
         if links:
             for v in val: # for each bubble in the chart, we create the bokeh plot corresponding to the value
                 generate_links(red, source, field, date[0:6], '{}-all-protocols'.format(v), outputdir, logofile, namefile, with_protocols, bokeh)
     # the complete scores with protocols together are processed and the result in written in another datafile
     general_namefile = "{}_with-protocols_{}".format(namefile_data, namefile_date)
-    res = process_general_file(score, general_namefile, field, field_string, skip, limit)
+    values, scores = potiron_query.topn(red, source, field, date, limit, skip)
+    res = process_file(values, scores, general_namefile, field, None, field_string)
     if links:
         for v in res: # for each bubble in the chart, we create the bokeh plot corresponding to the value
             generate_links(red, source, field, date[0:6], '{}-all-protocols'.format(v), outputdir, logofile, namefile, with_protocols, bokeh)
-else: # On the other case, we want to have the complete score for all the protocols together
-    if ck: # if combined keys are used anyway
-        score = {}
-        for k in keys: # we take the scores for each protocol
-            redisKey = k.decode()
-            process_score(red, redisKey, score, skip)
-        # the scores of each protocol are added together and wirtten in one unique datafile
-        general_namefile = "{}_{}".format(namefile_data, namefile_date)
-        res = process_general_file(score, general_namefile, field, field_string, skip, limit)
-        if links:
-            for v in res: # for each bubble in the chart, we create the bokeh plot corresponding to the value
-                generate_links(red, source, field, date[0:6], v, outputdir, logofile, general_namefile, with_protocols, bokeh)
-    else: # no combined keys
-        # here is the basic case where each score comes from one key, and there is one key per day
-        redisKey = k.decode()
-        namefile = "{}_{}".format(namefile_data, namefile_date)
-        val = process_file(red, redisKey, namefile, field, None, field_string, skip, limit)
-        if links:
-            for v in val: # for each bubble in the chart, we create the bokeh plot corresponding to the value
-                generate_links(red, source, field, date[0:6], v, outputdir, logofile, namefile, with_protocols, bokeh)
+elif ck or keys: # On the other case, we want to have the complete score for all the protocols together
+    # if combined keys are used, the scores of all the protocols are summed
+    namefile = "{}_{}".format(namefile_data, namefile_date)
+    values, scores = potiron_query.topn(red, source, field, date, limit, skip)
+    val = process_file(values, scores, namefile, field, None, field_string)
+    if links:
+        for v in val: # for each bubble in the chart, we create the bokeh plot corresponding to the value
+            generate_links(red, source, field, date[0:6], v, outputdir, logofile, namefile, with_protocols, bokeh)
 if gen: # Generate all the html files to display the charts, from the datafiles, following the template
     name_string = '##NAME##'
     logo_string = '##LOGO##'
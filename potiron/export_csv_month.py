@@ -21,15 +21,12 @@ import redis
 import argparse
 import sys
 import os
-import calendar
 import potiron
+import potiron_query
 import bokeh_month
 from potiron_graph_annotation import field2string,bubble_annotation
 
 
-MAXVAL = sys.maxsize
-
-
 # Definition of the output file name
 def output_name(source, field, date, dest):
     data_part = "{}{}_{}".format(dest, source, field)
@@ -37,25 +34,6 @@ def output_name(source, field, date, dest):
     return data_part, date_part
 
 
-# Search the scores in the ranged list of values, and put them in the disctionary of scores
-def process_score(red, redisKey, score, general_score, skip):
-    # For each value ranged in decreasing order
-    for v in red.zrevrangebyscore(redisKey,MAXVAL,0):
-        countValue = red.zscore(redisKey,v)
-        val = v.decode()
-        if val in skip : # If the current value has to be skipped, go to the next iteration of the loop
-            continue
-        if val in score: # If the current value is already present in the list of values, increment the score with the current score
-            score[val]+=countValue
-        else: # On the other  case, add the value with its score in the list
-            score[val]=countValue
-        if general_score is not None:
-            if val in general_score: # same operations for the dictionary containing the values for all the protocols
-                general_score[val]+=countValue
-            else:
-                general_score[val]=countValue
-
-
 # Sort the scores for the entire month and write them with their corresponding values in the .csv file
 def process_file(score, name, prot, skip, limit):
     # Sort the complete list of values for the month by score
@@ -195,54 +173,32 @@ protocols = red.smembers("PROTOCOLS")
 # Definition of the strings containing the informations of the field, used in the legend and the file name
 field_string, field_in_file_name = field2string(field, potiron_path)
 namefile_data, namefile_date = output_name(source,field_in_file_name,date,outputdir)
-days = calendar.monthrange(int(date[0:4]),int(date[4:6]))[1]
 if with_protocols: # variable is True, the parameter has not been called, so we process data for each protocol
     at_least_one = False
-    general_score = {}
     for prot in protocols: 
         protocol = prot.decode()
-        score={}
-        exists = False
-        keys = red.keys("{}:{}:{}*:{}".format(source,protocol,date,field))
-        for k in sorted(keys): # For each day of the month
-            redisKey = k.decode()
-            exists = True
-            process_score(red, redisKey, score, general_score, skip)  # update the complete scores
-        if exists:
+        values, scores = potiron_query.topn(red, source, field, date, limit, skip, protocol) # Top values of the month
+        if len(values):
             at_least_one = True
             namefile = "{}_with-protocols_{}_{}".format(namefile_data,namefile_date,protocol)
-            val = process_file(score, namefile, protocol, skip, limit) # we create and process the output datafile
+            val = process_file(dict(zip(values, scores)), namefile, protocol, skip, limit) # we create and process the output datafile
             if links:
                 for v in val: # for each bubble in the chart, we create the bokeh plot corresponding to the value
                     generate_links(red, source, field, date, '{}-all-protocols'.format(v), outputdir, logofile, namefile, with_protocols, bokeh)
     if at_least_one:
         # the complete scores with protocols together are processed and the result in written in another datafile
         general_filename = "{}_with-protocols_{}".format(namefile_data, namefile_date)
-        res = process_file(general_score, general_filename, None, skip, limit)
+        values, scores = potiron_query.topn(red, source, field, date, limit, skip)
+        res = process_file(dict(zip(values, scores)), general_filename, None, skip, limit)
         if links:
             for v in res: # for each bubble in the chart, we create the bokeh plot corresponding to the value
                 generate_links(red, source, field, date, '{}-all-protocols'.format(v), outputdir, logofile, namefile, with_protocols, bokeh)
 else: # On the other case, we want to have the complete score for all the protocols together
-    score={}
-    exists = False
-    if ck: # if combined keys are used anyway
-        for prot in protocols: # we take the scores for each protocol
-            protocol = prot.decode()
-            keys = red.keys("{}:{}:{}*:{}".format(source,protocol,date,field))
-            for k in sorted(keys): # For each day of the month
-                redisKey = k.decode()
-                exists = True
-                process_score(red, redisKey, score, None, skip)
-    else: # no combined keys
-        keys = red.keys("{}:{}*:{}".format(source,date,field))
-        for k in sorted(keys): # For each day of the month
-            redisKey = k.decode()
-            if red.exists(redisKey):
-                exists = True
-                process_score(red, redisKey, score, None, skip)
-    if exists:
+    # if combined keys are used, the scores of all the protocols are summed
+    values, scores = potiron_query.topn(red, source, field, date, limit, skip)
+    if len(values):
         namefile = "{}_{}".format(namefile_data, namefile_date)
-        val = process_file(score, namefile, None, skip, limit)
+        val = process_file(dict(zip(values, scores)), namefile, None, skip, limit)
         if links:
             for v in val: # for each bubble in the chart, we create the bokeh plot corresponding to the value
                 generate_links(red, source, field, date, v, outputdir, logofile, namefile, with_protocols, bokeh)
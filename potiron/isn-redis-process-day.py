@@ -21,6 +21,7 @@ import sys
 import os
 import numpy as np
 import argparse
+import potiron
 import redis
 from bokeh.plotting import figure, show, output_file, save
 from bokeh.models import BasicTickFormatter, HoverTool, ColumnDataSource
@@ -115,7 +116,7 @@ if __name__ == '__main__':
         if args.port_filter is None:
             key = "{}*{}_{}".format(source,date,h)
             # If there is no key corresponding to a precise hour, go directly is the next hour
-            if len(red.keys("{}*".format(key))) == 0:
+            if not potiron.hash_keys(red, source, "{}*".format(key), date, hours * 3600, (hours + 1) * 3600):
                 continue
             minutes = 0
             # For each period of time corresponding to the timeline
@@ -130,8 +131,8 @@ if __name__ == '__main__':
                 while minutes < (timeline * nb):
                     m = format(minutes, '02d')
                     keys = "{}:{}*".format(key,m)
-                    for line in red.keys(keys):
-                        line = line.decode()
+                    start = hours * 3600 + minutes * 60
+                    for line in potiron.hash_keys(red, source, keys, date, start, start + 60):
                         y_input.append(red.hget(line,'tcpseq').decode())
                         w_input.append(red.hget(line,'tcpack').decode())
                         sport = line.split('_')[1][3:]
@@ -260,7 +261,7 @@ if __name__ == '__main__':
                     minutes = it_minutes
                     key = "{}*dst{}_{}_{}".format(source,port,date,h)
                     # If there is no key corresponding to a precise hour, go directly is the next hour
-                    if len(red.keys("{}*".format(key))) == 0:
+                    if not potiron.hash_keys(red, source, "{}*".format(key), date, hours * 3600, (hours + 1) * 3600):
                         continue
                     w_input = []
                     x_input = []
@@ -269,8 +270,8 @@ if __name__ == '__main__':
                     while minutes < (timeline * nb):
                         m = format(minutes, '02d')
                         keys = "{}:{}*".format(key,m)
-                        for line in red.keys(keys):
-                            line = line.decode()
+                        start = hours * 3600 + minutes * 60
+                        for line in potiron.hash_keys(red, source, keys, date, start, start + 60):
                             y_input.append(red.hget(line,'tcpseq').decode())
                             w_input.append(red.hget(line,'tcpack').decode())
                             x_input.append("{} {}".format(line.split("_")[3],line.split("_")[4]))
@@ -21,6 +21,7 @@ import sys
 import os
 import numpy as np
 import argparse
+import potiron
 import redis
 import datetime
 from bokeh.plotting import figure, show, output_file, save
@@ -166,8 +167,8 @@ if __name__ == '__main__':
         t = 0
         while t < timeline:
             redisKey = "{}{}_{}:{}*".format(key,date,h,m)
-            for line in red.keys(redisKey):
-                line = line.decode()
+            start = int(h) * 3600 + int(m) * 60
+            for line in potiron.hash_keys(red, source, redisKey, date, start, start + 60):
                 y_input.append(red.hget(line,'tcpseq').decode())
                 w_input.append(red.hget(line,'tcpack').decode())
                 sport = line.split('_')[1][3:]
@@ -290,8 +291,8 @@ if __name__ == '__main__':
             h,m = define_hour(hour)
             while t < timeline:
                 redisKey = "{}_{}_{}:{}*".format(key,date,h,m)
-                for line in red.keys(redisKey):
-                    line = line.decode()
+                start = int(h) * 3600 + int(m) * 60
+                for line in potiron.hash_keys(red, source, redisKey, date, start, start + 60):
                     x_input.append("{} {}".format(line.split("_")[3],line.split("_")[4]))
                     y_input.append(red.hget(line,'tcpseq').decode())
                     w_input.append(red.hget(line,'tcpack').decode())
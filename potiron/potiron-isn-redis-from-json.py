@@ -17,7 +17,6 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-import json
 import redis
 import sys
 import os
@@ -56,9 +55,7 @@ if red.sismember("FILES", fn):
     sys.exit(0)
 red.sadd("FILES", fn)
 
-f = open(filename, 'r')
-doc = json.load(f)
-f.close()
+doc = list(potiron.read_json_document(filename))
 
 # Record local dictionaries
 local_dicts = dict()
@@ -68,7 +65,7 @@ rev_dics = dict()
 
 item = doc[0]
 bpf = item['bpf']
-if red.keys('BPF'):
+if red.exists('BPF'):
     if not red.sismember('BPF', bpf):
         red.srem('FILES', fn)
         bpf_string = str(red.smembers('BPF'))
@@ -169,7 +169,7 @@ if __name__ == '__main__':
                 tsharkfilter += "{} ".format(f)
             bpf += " && {}".format(tsharkfilter[:-1])
             
-    if red.keys('BPF'):
+    if red.exists('BPF'):
         # Check is the current bpf is the same as the one previously used
         if not red.sismember('BPF', bpf):
             bpf_string = str(red.smembers('BPF'))
@@ -18,7 +18,6 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-import json
 import redis
 import sys
 import os
@@ -55,9 +54,7 @@ if __name__ == '__main__':
         sys.exit(0)
     red.sadd("FILES", fn)
     
-    f = open(filename, 'r')
-    doc = json.load(f)
-    f.close()
+    doc = list(potiron.read_json_document(filename))
     
     # Record local dictionaries
     local_dicts = dict()
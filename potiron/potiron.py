@@ -16,10 +16,25 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import defaultdict, deque
+from fnmatch import fnmatchcase
+from itertools import islice
+from operator import itemgetter
 import os
+import calendar
 import datetime
+import gzip
+import hashlib
+import heapq
+import json
+import numpy as np
+import signal
+import subprocess
 import syslog
 import sys
+import threading
+import time
+import zipfile
 
 # Common functions related to importer scripts
 
@@ -53,6 +68,116 @@ PROTO_TCP = 6
 PROTO_ICMP6 = 41
 PROTO_UNKNOWN = 254
 DEFAULTBULKBUFFER = 1000
+# Lua script applying many ZINCRBY server-side with a single command: for each
+# sorted set of KEYS, ARGV gives the number of its members to increment,
+# followed by these members each with its increment
+_BULK_ZINCRBY = """
+local index = 1
+for _, key in ipairs(KEYS) do
+    local last = index + 2 * tonumber(ARGV[index])
+    for i = index + 1, last, 2 do
+        redis.call('ZINCRBY', key, ARGV[i + 1], ARGV[i])
+    end
+    index = last + 1
+end
+return #KEYS
+"""
+_BULK_ZINCRBY_SHA = hashlib.sha1(_BULK_ZINCRBY.encode()).hexdigest()
+# Lua script merging a Space-Saving summary into the bounded sorted set of
+# KEYS[1], holding at most ARGV[1] members: ARGV[2] is the maximum count of
+# the values left out of the summary, followed by the values of the summary
+# each with its count. A value missing from the sorted set starts from its
+# lowest score when it is full (the maximum count of the values it left
+# out), and the values missing from the summary get its maximum count, then
+# only the highest scores are kept. The scores thus never underestimate the
+# counts, by at most the total count divided by the number of members kept.
+_TOPK_MERGE = """
+local key, size, bound = KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2])
+local floor = 0
+if redis.call('ZCARD', key) >= size then
+    floor = tonumber(redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')[2])
+end
+local merged = {}
+for i = 3, #ARGV, 2 do
+    merged[ARGV[i]] = true
+    if redis.call('ZSCORE', key, ARGV[i]) then
+        redis.call('ZINCRBY', key, ARGV[i + 1], ARGV[i])
+    else
+        redis.call('ZADD', key, floor + tonumber(ARGV[i + 1]), ARGV[i])
+    end
+end
+if bound > 0 then
+    for _, member in ipairs(redis.call('ZRANGE', key, 0, -1)) do
+        if not merged[member] then
+            redis.call('ZINCRBY', key, bound, member)
+        end
+    end
+end
+local excess = redis.call('ZCARD', key) - size
+if excess > 0 then
+    redis.call('ZREMRANGEBYRANK', key, 0, excess - 1)
+end
+return excess
+"""
+_TOPK_MERGE_SHA = hashlib.sha1(_TOPK_MERGE.encode()).hexdigest()
+# Lua script probing annotation dictionaries: KEYS holds pairs of a key
+# giving the identifier of a value in a dictionary (AR_) and the hash of the
+# annotations of the dictionary (TR_a_). For each pair, returns 0 when the
+# value is not in the dictionary, 1 when its annotation is missing, and the
+# annotation otherwise.
+_GET_ANNOTATIONS = """
+local out = {}
+for i = 1, #KEYS, 2 do
+    local idn = redis.call('GET', KEYS[i])
+    if idn then
+        out[#out + 1] = redis.call('HGET', KEYS[i + 1], idn) or 1
+    else
+        out[#out + 1] = 0
+    end
+end
+return out
+"""
+# Default flush policy of the standard ingestion: the partial counters are
+# pushed to redis every FLUSH_PACKETS packets, FLUSH_KEYS distinct values or
+# FLUSH_SECONDS seconds (0 disables a criterion), in pipelines of at most
+# DEFAULTBULKBUFFER commands
+FLUSH_PACKETS = 0
+FLUSH_KEYS = 500000
+FLUSH_SECONDS = 0
+# Number of tshark lines counted at once by the vectorized standard ingestion
+CHUNK_SIZE = 100000
+# Number of tshark stderr lines kept to be reported when tshark fails
+TSHARK_STDERR_LINES = 20
+# Seconds without any output after which tshark is killed (0 to disable)
+TSHARK_TIMEOUT = 0
+# Number of shards processed in parallel for each capture of at least
+# SHARD_MIN_SIZE MB, with the native engine (1 to disable)
+SHARDS = 1
+SHARD_MIN_SIZE = 256
+# Formats of the json documents: a json array of packets, one packet per line
+# (newline-delimited json), possibly gzip compressed, or a compressed numpy
+# archive with one typed array per field (columnar)
+JSON_FORMATS = ('json', 'ndjson', 'ndjson.gz', 'npz')
+JSON_FORMAT = 'json'
+JSON_COMPRESSION_LEVEL = 6
+# Number of packets of each block of typed arrays of the columnar documents
+COLUMNS_CHUNK_SIZE = 65536
+# Suffix of the sidecar files holding the counters of the json documents
+COUNTERS_SUFFIX = 'counters.gz'
+# Suffix of the HyperLogLog keys counting the distinct values of a field
+HLL_SUFFIX = 'hll'
+# Roll-ups of the months and years (see rollup_key): hash of the pending
+# roll-ups with their version, and set of the roll-ups already computed
+ROLLUPS_PENDING = 'ROLLUPS_PENDING'
+ROLLUPS_DONE = 'ROLLUPS_DONE'
+_rollup_names = {6: 'month', 4: 'year'}
+# Indexes of the keys maintained at ingestion, for the readers not to scan
+# the keyspace: set of the sensors, then for each sensor the set of its
+# protocols (with combined keys), the days of each field (see days_index)
+# and the isn or layer2 hashes of each day (see hashes_index)
+SENSORS = 'SENSORS'
+# Number of keys per SCAN command, for the datasets stored without indexes
+SCAN_COUNT = 1000
 
 # Object types that are included in the json documents
 TYPE_SOURCE = 1
@@ -92,8 +217,9 @@ def get_file_struct(rootdir, filename, suffix="json"):
             suffix = "." + suffix
 
         f = os.path.basename(filename)
-        f = f.replace('.cap.gz', '')
-        f = f.replace('.json', '')
+        for extension in ('.gz', '.zst', '.lz4', '.cap', '.json', '.ndjson', '.npz', '.counters'):
+            if f.endswith(extension):
+                f = f[:-len(extension)]
         prefix, sensorname, instance, date = f.split('-')
         obj = datetime.datetime.strptime(date, "%Y%m%d%H%M%S")
         out = obj.strftime("%Y/%m/%d")
@@ -146,6 +272,565 @@ def check_program(program):
     return False
 
 
+# Run a tshark command and yield its output lines as soon as tshark emits them,
+# so that parsing starts right away and memory stays flat whatever the size of
+# the capture. stderr is drained at the same time in a separate thread, which
+# prevents a chatty tshark from filling its pipe and hanging the worker.
+# Yield the lines output by tshark. A watchdog kills tshark when it does not
+# output anything for `timeout` seconds while its output is awaited, so a
+# stuck process can not keep a worker of the pool busy forever.
+def tshark_output(cmd, timeout=TSHARK_TIMEOUT):
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=bool(timeout))
+    errors = deque(maxlen=TSHARK_STDERR_LINES)
+    drain = threading.Thread(target=_drain_stream, args=(proc.stderr, errors), daemon=True)
+    drain.start()
+    state = {'waiting_since': None, 'killed': False}
+    if timeout:
+        stop = threading.Event()
+        watchdog = threading.Thread(target=_watch_process, args=(proc, timeout, state, stop), daemon=True)
+        watchdog.start()
+    complete = False
+    try:
+        readline = proc.stdout.readline
+        while True:
+            state['waiting_since'] = time.monotonic()
+            line = readline()
+            state['waiting_since'] = None
+            if not line:
+                break
+            yield line
+        complete = True
+    finally:
+        if timeout:
+            stop.set()
+            watchdog.join()
+        proc.stdout.close()
+        proc.wait()
+        drain.join()
+        if state['killed']:
+            errormsg("tshark killed after {} seconds without output: {}".format(timeout, cmd))
+        elif complete and proc.returncode:
+            errormsg("tshark exited with status {}: {}".format(proc.returncode, " ".join(errors)))
+
+
+def _watch_process(proc, timeout, state, stop):
+    while not stop.wait(min(timeout, 1)):
+        waiting_since = state['waiting_since']
+        if waiting_since is not None and time.monotonic() - waiting_since > timeout:
+            state['killed'] = True
+            # Kill the whole process group, not only the shell running tshark
+            os.killpg(proc.pid, signal.SIGKILL)
+            return
+
+
+def _drain_stream(stream, errors):
+    with stream:
+        for line in stream:
+            errors.append(line.decode(errors='replace').strip())
+
+
+# Push set members and counter increments to redis in pipelines of at most
+# batch_size commands, so a huge import never blocks redis with one giant
+# pipeline. Increments are additive, so flushing partial counters several
+# times gives the same result as a single flush at the end.
+# With a journal (see start_journal), each pipeline is a transaction which
+# also records the number of batches of the flush applied, and the last one
+# records the number of lines of the capture (position) whose data is in
+# redis, and commits the ingestion if requested. The same lines giving the
+# same batches, an interrupted flush is completed by skipping the batches
+# already applied.
+# The values of to_count are then added to their HyperLogLog keys (see
+# distinct_values), and the keys of to_expire are set to expire at the given
+# epoch timestamps.
+# The sorted sets of the fields in topk (see parse_topk) are bounded: their
+# increments are reduced to a summary merged with _TOPK_MERGE.
+# The months and years in rollups (see touched_rollups) are marked as pending
+# and the days of the sorted sets are indexed (see index_days) with the last
+# pipeline, once all the increments are applied.
+def flush_data(red, to_add, to_incr, batch_size=DEFAULTBULKBUFFER, journal=None, position=0, skip=0, commit=False, filename=None, to_expire=None, to_count=None, topk=None, rollups=()):
+    if journal is not None and not skip:
+        red.hset(journal, mapping={'flush_end': position, 'batches': 0})
+    p = red.pipeline(transaction=journal is not None)
+    batches = 0
+    for key, values in to_add.items():
+        add_to_set(p, key, *values)
+        if len(p) >= batch_size:
+            batches = _execute_batch(p, journal, batches, skip)
+    unbounded, summaries = _split_topk(to_incr, topk)
+    red.script_load(_BULK_ZINCRBY)
+    for keys, args in _increment_batches(unbounded, batch_size):
+        p.evalsha(_BULK_ZINCRBY_SHA, len(keys), *keys, *args)
+        batches = _execute_batch(p, journal, batches, skip)
+    if summaries:
+        red.script_load(_TOPK_MERGE)
+    for batch in _summary_batches(summaries, batch_size):
+        for key, size, bound, args in batch:
+            p.evalsha(_TOPK_MERGE_SHA, 1, key, size, bound, *args)
+        batches = _execute_batch(p, journal, batches, skip)
+    for batch in _distinct_batches(to_count or {}, batch_size):
+        for key, values in batch:
+            p.pfadd(key, *values)
+        batches = _execute_batch(p, journal, batches, skip)
+    for key, timestamp in (to_expire or {}).items():
+        p.expireat(key, timestamp)
+        if len(p) >= batch_size:
+            batches = _execute_batch(p, journal, batches, skip)
+    mark_rollups(p, rollups)
+    index_days(p, to_incr)
+    if journal is not None:
+        p.hset(journal, 'packets', position)
+        p.hdel(journal, 'flush_end', 'batches')
+        if commit:
+            commit_journal(p, journal, filename)
+    p.execute()
+
+
+# Add to a pipeline the commands applying all the increments of the sorted
+# sets in to_incr, with at most batch_size increments per command. The script
+# is loaded by the pipeline itself, before its first use. The increments of
+# the bounded sorted sets of the fields in topk are merged as summaries.
+def bulk_increment(p, to_incr, batch_size=DEFAULTBULKBUFFER, topk=None):
+    to_incr, summaries = _split_topk(to_incr, topk)
+    if to_incr:
+        p.script_load(_BULK_ZINCRBY)
+        for keys, args in _increment_batches(to_incr, batch_size):
+            p.evalsha(_BULK_ZINCRBY_SHA, len(keys), *keys, *args)
+    if summaries:
+        p.script_load(_TOPK_MERGE)
+        for key, size, bound, args in summaries:
+            p.evalsha(_TOPK_MERGE_SHA, 1, key, size, bound, *args)
+
+
+# Parse the bounded fields given as 'field:size' (ex: 'ipsrc:1000'), whose
+# sorted sets only keep the given number of values with the highest counts.
+# Returns the size of each field.
+def parse_topk(topk):
+    to_return = {}
+    for field_size in topk.split():
+        field, _, size = field_size.partition(':')
+        try:
+            size = int(size)
+        except ValueError:
+            raise ValueError(f"Invalid bounded field {field_size}, it should be defined as 'field:size' (ex: 'ipsrc:1000').")
+        if size < 1:
+            raise ValueError(f"Invalid bounded field {field_size}, its size should be at least 1.")
+        to_return[field] = size
+    return to_return
+
+
+# Split the increments between the sorted sets counted exactly and the
+# bounded ones, whose increments are reduced to a Space-Saving summary of
+# their size: the values with the highest increments, with the highest
+# increment of the values left out (0 when none is left out)
+def _split_topk(to_incr, topk):
+    if not topk:
+        return to_incr, []
+    exact, summaries = {}, []
+    for key, values in to_incr.items():
+        size = topk.get(key.rsplit(':', 1)[1])
+        if size is None:
+            exact[key] = values
+            continue
+        if len(values) > size:
+            *kept, (_, bound) = heapq.nlargest(size + 1, values.items(), key=itemgetter(1))
+        else:
+            kept, bound = values.items(), 0
+        summaries.append((key, size, bound, [arg for item in kept for arg in item]))
+    return exact, summaries
+
+
+# Split the summaries into batches of about batch_size values
+def _summary_batches(summaries, batch_size):
+    batch, count = [], 0
+    for summary in summaries:
+        batch.append(summary)
+        count += len(summary[3]) // 2
+        if count >= batch_size:
+            yield batch
+            batch, count = [], 0
+    if batch:
+        yield batch
+
+
+# Split the increments into the KEYS and ARGV of calls to the _BULK_ZINCRBY
+# script, each call applying batch_size increments (the last one possibly
+# fewer); the values of a key may be spread over consecutive calls
+def _increment_batches(to_incr, batch_size):
+    keys, args, count = [], [], 0
+    for key, values in to_incr.items():
+        items = list(values.items())
+        start = 0
+        while start < len(items):
+            chunk = items[start:start + batch_size - count]
+            keys.append(key)
+            args.append(len(chunk))
+            for value, amount in chunk:
+                args.extend((value, amount))
+            count += len(chunk)
+            start += len(chunk)
+            if count == batch_size:
+                yield keys, args
+                keys, args, count = [], [], 0
+    if keys:
+        yield keys, args
+
+
+# HyperLogLog keys counting the distinct values of the sorted sets of the
+# days (sensorname[:protocol]:YYYYMMDD:field) whose field is in fields,
+# named after them with the hll suffix, with the values to add to each one.
+# The sorted sets of the sub-day buckets are left out.
+def distinct_values(to_incr, fields):
+    to_count = {}
+    for key, values in to_incr.items():
+        _, period, field = key.rsplit(':', 2)
+        if field in fields and len(period) == 8:
+            to_count[f"{key}:{HLL_SUFFIX}"] = list(values)
+    return to_count
+
+
+# Add to a pipeline the commands adding the values of to_count to their
+# HyperLogLog keys, with at most batch_size values per command
+def bulk_distinct(p, to_count, batch_size=DEFAULTBULKBUFFER):
+    for batch in _distinct_batches(to_count, batch_size):
+        for key, values in batch:
+            p.pfadd(key, *values)
+
+
+# Split the values of the HyperLogLog keys into batches of batch_size values
+# (the last one possibly fewer), as (key, values) couples
+def _distinct_batches(to_count, batch_size):
+    batch, count = [], 0
+    for key, values in to_count.items():
+        start = 0
+        while start < len(values):
+            chunk = values[start:start + batch_size - count]
+            batch.append((key, chunk))
+            count += len(chunk)
+            start += len(chunk)
+            if count == batch_size:
+                yield batch
+                batch, count = [], 0
+    if batch:
+        yield batch
+
+
+# HyperLogLog keys counting the distinct values of a field during a day
+# (YYYYMMDD), a month (YYYYMM) or a year (YYYY): the keys of the month and
+# year roll-ups computed by the compaction when they are up to date (fresh,
+# see fresh_rollups), and the keys of the remaining days. With combined
+# keys, the keys of the protocols given are counted together.
+def distinct_keys(sensorname, period, field, protocols=None, fresh=()):
+    prefixes = [f"{sensorname}:{protocol}" for protocol in protocols] if protocols else [sensorname]
+    return [f"{key}:{HLL_SUFFIX}" for prefix in prefixes for key in covering_keys(prefix, field, *period_days(period), fresh)]
+
+
+# Approximate number of distinct values of a field during a day, a month or
+# a year (see distinct_keys). PFCOUNT merges the keys on the fly, so nothing
+# is written.
+def count_distinct(red, sensorname, period, field, protocols=None, fresh=None):
+    if fresh is None:
+        fresh = fresh_rollups(red) if len(period) < 8 else set()
+    return red.pfcount(*distinct_keys(sensorname, period, field, protocols, fresh))
+
+
+# Value read from redis as a string, whether the connection decodes the
+# responses or not
+def decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+# Name of the roll-up key of a field for a month (YYYYMM) or a year (YYYY),
+# aggregating the sorted sets of the days (sensorname[:protocol]:month:YYYYMM:field
+# or sensorname[:protocol]:year:YYYY:field). The month or year is not right
+# after the prefix, so the patterns of the day keys never match them.
+def rollup_key(prefix, period, field):
+    return f"{prefix}:{_rollup_names[len(period)]}:{period}:{field}"
+
+
+# Months and years (prefix:YYYYMM and prefix:YYYY) of the sorted sets of the
+# days in to_incr, whose roll-up keys have to be computed again
+def touched_rollups(to_incr):
+    touched = set()
+    for key in to_incr:
+        prefix, period, _ = key.rsplit(':', 2)
+        if len(period) == 8:
+            touched.update((f"{prefix}:{period[:6]}", f"{prefix}:{period[:4]}"))
+    return touched
+
+
+# Increment the version of the pending roll-ups, for the compactor (see
+# potiron_rollup) to only remove them once computed with their last version
+def mark_rollups(p, rollups):
+    for rollup in rollups:
+        p.hincrby(ROLLUPS_PENDING, rollup, 1)
+
+
+# Keys covering the days between start and end (YYYYMMDD, both included) for
+# a field: the roll-up keys of the years and months entirely covered, when
+# they are computed and up to date (fresh, see fresh_rollups), and the keys
+# of the remaining days
+def covering_keys(prefix, field, start, end, fresh):
+    keys = []
+    for year in range(int(start[:4]), int(end[:4]) + 1):
+        if f"{year}0101" >= start and f"{year}1231" <= end and f"{prefix}:{year}" in fresh:
+            keys.append(rollup_key(prefix, str(year), field))
+            continue
+        for month in range(1, 13):
+            month = f"{year}{month:02d}"
+            last = f"{month}{calendar.monthrange(year, int(month[4:]))[1]:02d}"
+            if last < start or f"{month}01" > end:
+                continue
+            if f"{month}01" >= start and last <= end and f"{prefix}:{month}" in fresh:
+                keys.append(rollup_key(prefix, month, field))
+                continue
+            first_day, last_day = max(start, f"{month}01"), min(end, last)
+            keys.extend(f"{prefix}:{month}{day:02d}:{field}" for day in range(int(first_day[6:]), int(last_day[6:]) + 1))
+    return keys
+
+
+# Roll-ups computed and not changed since (prefix:YYYYMM and prefix:YYYY)
+def fresh_rollups(red):
+    return set(map(decode, red.smembers(ROLLUPS_DONE))) - set(map(decode, red.hkeys(ROLLUPS_PENDING)))
+
+
+# First and last days of a day, month or year
+def period_days(period):
+    if len(period) == 8:
+        return period, period
+    if len(period) == 6:
+        return f"{period}01", f"{period}{calendar.monthrange(int(period[:4]), int(period[4:]))[1]:02d}"
+    return f"{period}0101", f"{period}1231"
+
+
+# Name of the index of the days (YYYYMMDD, scored as integers) having a
+# sorted set of a field, for a sensorname or sensorname:protocol prefix
+def days_index(prefix, field):
+    return f"DAYS:{prefix}:{field}"
+
+
+# Name of the index of the days of a sensor, scored by their value (YYYYMMDD)
+def sensor_days_index(sensorname):
+    return f"DAYS:{sensorname}"
+
+
+# Name of the index of the protocols of a sensor with combined keys
+def protocols_index(sensorname):
+    return f"PROTOCOLS:{sensorname}"
+
+
+# Name of the index of the isn or layer2 hashes of a sensor during a day
+# (YYYYMMDD), scored by their number of seconds since midnight
+def hashes_index(sensorname, day):
+    return f"HASHES:{sensorname}:{day}"
+
+
+# Add to a pipeline the commands indexing the sorted sets of the days in
+# to_incr, with their sensor and protocol. The sorted sets of the sub-day
+# buckets and the other sorted sets are left out.
+def index_days(p, to_incr):
+    days = defaultdict(set)
+    for key in to_incr:
+        parts = key.rsplit(':', 2)
+        if len(parts) == 3 and _is_day(parts[1]):
+            days[(parts[0], parts[2])].add(parts[1])
+    for (prefix, field), prefix_days in days.items():
+        p.zadd(days_index(prefix, field), {day: int(day) for day in prefix_days})
+    prefixes = {prefix for prefix, _ in days}
+    if prefixes:
+        p.sadd(SENSORS, *{prefix.split(':')[0] for prefix in prefixes})
+    for sensorname, protocol in (prefix.split(':', 1) for prefix in prefixes if ':' in prefix):
+        p.sadd(protocols_index(sensorname), protocol)
+
+
+# Add to a pipeline the commands indexing the isn or layer2 hashes of a
+# sensor, whose keys end with the day and time of their packet
+# (..._YYYY-MM-DD_HH:MM:SS.ffffff)
+def index_hashes(p, sensorname, keys):
+    indexes = defaultdict(dict)
+    for key in keys:
+        day, time = key.rsplit('_', 2)[1:]
+        hours, minutes, seconds = time.split(':')
+        indexes[hashes_index(sensorname, day.replace('-', ''))][key] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    for index, scores in indexes.items():
+        p.zadd(index, scores)
+    if indexes:
+        p.sadd(SENSORS, sensorname)
+
+
+# Register days (YYYYMMDD) of a sensor, with redis or a pipeline
+def add_days(red, sensorname, *days):
+    red.sadd(f"{sensorname}_DAYS", *days)
+    red.zadd(sensor_days_index(sensorname), {day: int(day) for day in days})
+
+
+# Add values to a set of to_add, with redis or a pipeline, the days of a
+# sensor ({sensorname}_DAYS) being indexed at the same time
+def add_to_set(red, key, *values):
+    if key.endswith('_DAYS'):
+        add_days(red, key[:-len('_DAYS')], *values)
+    else:
+        red.sadd(key, *values)
+
+
+# Days of a sensor starting with date (YYYY, YYYYMM or YYYYMMDD, all the
+# days when empty), in chronological order, from their set for the datasets
+# stored without indexes
+def sensor_days(red, sensorname, date=''):
+    days = red.zrangebyscore(sensor_days_index(sensorname), int(date.ljust(8, '0')), int(date.ljust(8, '9')))
+    if not days and not red.exists(sensor_days_index(sensorname)):
+        days = sorted(day for day in map(decode, red.smembers(f"{sensorname}_DAYS")) if day.startswith(date))
+    return list(map(decode, days))
+
+
+# First and latest days of a sensor, None without any day
+def first_day(red, sensorname):
+    return _edge_day(red, sensorname, red.zrange, 0)
+
+
+def latest_day(red, sensorname):
+    return _edge_day(red, sensorname, red.zrevrange, -1)
+
+
+def _edge_day(red, sensorname, zrange, position):
+    days = zrange(sensor_days_index(sensorname), 0, 0)
+    if not days:
+        days = sorted(map(decode, red.smembers(f"{sensorname}_DAYS")))[position:][:1]
+    return decode(days[0]) if days else None
+
+
+# Sensors of the dataset, from their days for the datasets stored without
+# indexes
+def sensor_names(red):
+    sensors = red.smembers(SENSORS)
+    if not sensors:
+        sensors = (key[:-len('_DAYS')] for key in map(decode, red.scan_iter(match='*_DAYS', count=SCAN_COUNT)))
+    return sorted(map(decode, sensors))
+
+
+# Protocols of a sensor with combined keys, or of all the sensors for the
+# datasets stored without indexes
+def sensor_protocols(red, sensorname):
+    protocols = red.smembers(protocols_index(sensorname)) or red.smembers('PROTOCOLS')
+    return sorted(map(decode, protocols))
+
+
+# Sorted sets of a field for the days of a prefix (sensorname or
+# sensorname:protocol) starting with date (YYYY, YYYYMM or YYYYMMDD, all
+# the days when empty), in chronological order. The keyspace is scanned for
+# the datasets stored without indexes.
+def day_keys(red, prefix, field, date=''):
+    index = days_index(prefix, field)
+    if red.exists(index):
+        days = red.zrangebyscore(index, int(date.ljust(8, '0')), int(date.ljust(8, '9')))
+        return [f"{prefix}:{decode(day)}:{field}" for day in days]
+    return _scan_day_keys(red, f"{prefix}:{date}*:{field}")
+
+
+# Sorted sets of a field for the days starting with date of all the
+# protocols of a sensor with combined keys
+def protocol_day_keys(red, sensorname, field, date=''):
+    protocols = red.smembers(protocols_index(sensorname))
+    if protocols:
+        return [key for protocol in sorted(map(decode, protocols)) for key in day_keys(red, f"{sensorname}:{protocol}", field, date)]
+    return _scan_day_keys(red, f"{sensorname}:*:{date}*:{field}")
+
+
+def _scan_day_keys(red, pattern):
+    keys = (decode(key) for key in red.scan_iter(match=pattern, count=SCAN_COUNT))
+    return sorted(key for key in keys if _is_day(key.rsplit(':', 2)[1]))
+
+
+def _is_day(period):
+    return len(period) == 8 and period.isdigit()
+
+
+# Isn or layer2 hashes of a sensor matching a glob-style pattern, during a
+# day (YYYYMMDD or YYYY-MM-DD) between start (included) and end (excluded),
+# in seconds since midnight. The keyspace is scanned for the datasets stored
+# without indexes.
+def hash_keys(red, sensorname, pattern, day, start=0, end=86400):
+    index = hashes_index(sensorname, day.replace('-', ''))
+    if red.exists(index):
+        keys = map(decode, red.zrangebyscore(index, start, f"({end}"))
+        return [key for key in keys if fnmatchcase(key, pattern)]
+    return [decode(key) for key in red.scan_iter(match=pattern, count=SCAN_COUNT)]
+
+
+def _execute_batch(p, journal, batches, skip):
+    if journal is None:
+        p.execute()
+    elif batches < skip:
+        p.reset()
+    else:
+        p.hset(journal, 'batches', batches + 1)
+        p.execute()
+    return batches + 1
+
+
+# Ingestion journal of a capture, or of a shard of capture, stored in a hash:
+# - started / committed: time the ingestion started / was completed
+# - packets: number of lines of the capture whose data is in redis
+# - flush_end / batches: with a flush in progress, the number of lines it
+#   covers, and the number of its batches already applied
+# - shards: for a capture split into shards, the shards definition
+def journal_key(filename, shard=None):
+    return f"JOURNAL:{filename}" if shard is None else f"JOURNAL:{filename}:{shard[0]}"
+
+
+# Start or resume an ingestion. Returns whether it is already committed, the
+# number of lines already flushed, with a flush in progress, the number of
+# lines it covers (None otherwise) and of batches already applied, and the
+# time the ingestion first started.
+def start_journal(red, journal):
+    red.hsetnx(journal, 'started', time.time())
+    committed, packets, flush_end, batches, started = red.hmget(journal, 'committed', 'packets', 'flush_end', 'batches', 'started')
+    return committed is not None, int(packets or 0), int(flush_end) if flush_end else None, int(batches or 0), float(started)
+
+
+# Return the captures (or shards) whose ingestion was interrupted during a
+# flush, which has to be completed with the same batches
+def interrupted_flushes(red):
+    journals = list(red.scan_iter(match='JOURNAL:*', count=1000))
+    p = red.pipeline(transaction=False)
+    for journal in journals:
+        p.hexists(journal, 'flush_end')
+    return [journal[len('JOURNAL:'):] for journal, interrupted in zip(journals, p.execute()) if interrupted]
+
+
+# Add the commands committing an ingestion to a pipeline, recording the
+# capture in the imported files for the journal of a whole capture
+def commit_journal(p, journal, filename=None):
+    p.hset(journal, 'committed', time.time())
+    if filename is not None:
+        p.sadd("FILES", filename)
+
+
+# Return the shards definition of the captures whose ingestion already
+# started: the list of their shards, or an empty list if not split
+def get_shard_layouts(red, files):
+    p = red.pipeline(transaction=False)
+    for inputfile in files:
+        p.hmget(journal_key(os.path.basename(inputfile)), 'started', 'shards')
+    layouts = {}
+    for inputfile, (started, shards) in zip(files, p.execute()):
+        if shards:
+            layouts[inputfile] = [tuple(shard) for shard in json.loads(shards)]
+        elif started:
+            layouts[inputfile] = []
+    return layouts
+
+
+# Record the shards definition of the captures split into shards, so an
+# interrupted ingestion is resumed with the same shards
+def set_shard_layouts(red, sharded_files):
+    p = red.pipeline(transaction=False)
+    for inputfile, shards in sharded_files.items():
+        journal = journal_key(os.path.basename(inputfile))
+        p.hsetnx(journal, 'started', time.time())
+        p.hset(journal, 'shards', json.dumps(shards))
+    p.execute()
+
+
 def get_sensor_name(doc):
     for obj in doc:
         if "type" in obj:
@@ -163,16 +848,326 @@ def define_protocols(path):
         return protocols
 
 
-# Save the output json file
-def store_packet(rootdir, pcapfilename, obj):
+# Save the output json file, or the part of it made by a shard of the capture
+def store_packet(rootdir, pcapfilename, obj, shard=None):
     if rootdir is not None:
         jsonfilename = create_file(rootdir, pcapfilename)
+        if shard is not None:
+            jsonfilename = f"{jsonfilename}.{shard[0]}"
         with open(jsonfilename, "wt", encoding='utf-8') as f:
             f.write(obj)
     else:
         sys.stdout.write(obj)
 
 
+# Json document of a capture, written packet by packet while the capture is
+# parsed instead of being dumped at once. The document is written in a
+# temporary file, renamed once complete, so an interrupted ingestion never
+# leaves a truncated document. Without rootdir, it is written on stdout.
+# The columnar documents keep the values of each field in a list, written as
+# typed arrays (see _encode_column) in the archive every COLUMNS_CHUNK_SIZE
+# packets, so their memory use does not depend on the size of the capture.
+class JsonDocument():
+    def __init__(self, rootdir, pcapfilename, json_format=JSON_FORMAT, shard=None):
+        self.json_format = json_format
+        self.packets = 0
+        if json_format == 'npz':
+            self._header = None
+            self._fields = None
+            self._columns = None
+            self._chunks = []
+        if rootdir is None:
+            self.filename = None
+            self._file = sys.stdout.buffer if json_format == 'npz' else sys.stdout
+            if json_format == 'npz':
+                self._archive = zipfile.ZipFile(self._file, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+            return
+        self.filename = create_file(rootdir, pcapfilename, json_format)
+        if shard is not None:
+            self.filename = f"{self.filename}.{shard[0]}"
+        self._tmpname = f"{self.filename}.tmp"
+        if json_format == 'npz':
+            self._file = open(self._tmpname, 'wb')
+            self._archive = zipfile.ZipFile(self._file, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        elif json_format == 'ndjson.gz':
+            self._file = gzip.open(self._tmpname, 'wt', encoding='utf-8', compresslevel=JSON_COMPRESSION_LEVEL)
+        else:
+            self._file = open(self._tmpname, 'wt', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.filename is not None:
+            if self.json_format == 'npz':
+                self._archive.close()
+            self._file.close()
+            os.remove(self._tmpname)
+
+    # The json arrays are written as json.dumps would write the list of packets
+    def write(self, packet):
+        if self.json_format == 'npz':
+            self._add_to_columns(packet)
+        elif self.json_format == 'json':
+            self._file.write(f"{', ' if self.packets else '['}{json.dumps(packet)}")
+        else:
+            self._file.write(f"{json.dumps(packet)}\n")
+        self.packets += 1
+
+    # The archive holds the first packet (header), the fields of the following
+    # packets (fields), the kinds of the columns of each chunk (chunks), and
+    # for each chunk and field, the values (c{field}_{chunk}) and the mask of
+    # the empty strings of integers, if any (e{field}_{chunk})
+    def close(self):
+        if self.json_format == 'npz':
+            if self._columns and self._columns[0]:
+                self._write_chunk()
+            for name, value in (('header', self._header), ('fields', self._fields or []), ('chunks', self._chunks)):
+                self._write_array(name, np.array(json.dumps(value)))
+            self._archive.close()
+        elif self.json_format == 'json':
+            self._file.write(']' if self.packets else '[]')
+        if self.filename is not None:
+            self._file.close()
+            os.replace(self._tmpname, self.filename)
+
+    # The first packet, describing the capture, is kept as it is, all the
+    # following ones should have the same fields
+    def _add_to_columns(self, packet):
+        if self._header is None:
+            self._header = packet
+            return
+        if self._fields is None:
+            self._fields = tuple(packet)
+            self._columns = tuple([] for _ in self._fields)
+        if len(packet) != len(self._fields):
+            raise ValueError(f"The packets of a columnar document should all have the fields {', '.join(self._fields)}.")
+        try:
+            for field, column in zip(self._fields, self._columns):
+                column.append(packet[field])
+        except KeyError as e:
+            raise ValueError(f"The packets of a columnar document should all have the fields {', '.join(self._fields)}.") from e
+        if len(self._columns[0]) >= COLUMNS_CHUNK_SIZE:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        chunk = len(self._chunks)
+        kinds = []
+        for index, column in enumerate(self._columns):
+            kind, values, empty = _encode_column(column)
+            kinds.append(kind)
+            self._write_array(f'c{index}_{chunk}', values)
+            if empty is not None:
+                self._write_array(f'e{index}_{chunk}', empty)
+            column.clear()
+        self._chunks.append(kinds)
+
+    # Arrays written as np.savez_compressed writes them
+    def _write_array(self, name, array):
+        with self._archive.open(f'{name}.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+
+# Store the values of a field in the most compact array: integers in an
+# int64 array, strings of integers (possibly empty) as well with the mask of
+# the empty ones, other strings in an array of strings, and anything else as
+# json strings. Returns the kind of column, the array, and the mask or None.
+def _encode_column(column):
+    if all(type(value) is int for value in column):
+        return 'int', np.array(column, dtype=np.int64), None
+    if not all(type(value) is str for value in column):
+        return 'json', np.array([json.dumps(value) for value in column]), None
+    values = np.array(column)
+    empty = values == ''
+    try:
+        integers = np.where(empty, '0', values).astype(np.int64)
+    except (ValueError, OverflowError):
+        return 'str', values, None
+    if not (np.where(empty, '', integers.astype(str)) == values).all():
+        return 'str', values, None
+    return 'intstr', integers, empty if empty.any() else None
+
+
+def _decode_column(kind, values, empty):
+    if kind == 'int':
+        return values.tolist()
+    if kind == 'json':
+        return [json.loads(value) for value in values.tolist()]
+    if kind == 'str':
+        return values.tolist()
+    values = values.astype(str)
+    if empty is not None:
+        values[empty] = ''
+    return values.tolist()
+
+
+# Iterate over the packets of a json document, the first one describing the
+# capture and the ingestion parameters. The newline-delimited documents are
+# read line by line, and the columnar ones field by field; the format is
+# guessed from the extension if not given.
+def read_json_document(filename, json_format=None):
+    if json_format is None:
+        json_format = get_json_format(filename)
+    if json_format == 'npz':
+        yield from _read_columnar_document(filename)
+        return
+    if json_format == 'json':
+        with open(filename, 'rt', encoding='utf-8') as f:
+            yield from json.loads(f.read())
+        return
+    opener = gzip.open if json_format == 'ndjson.gz' else open
+    with opener(filename, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _read_columnar_document(filename):
+    chunks = read_json_columns(filename)
+    yield next(chunks)
+    for columns in chunks:
+        names = list(columns)
+        for values in zip(*columns.values()):
+            yield dict(zip(names, values))
+
+
+# Iterate over the first packet of a columnar document, then the values of
+# each field of the following packets in a list, chunk by chunk (see
+# JsonDocument.close)
+def read_json_columns(filename):
+    with np.load(filename, allow_pickle=False) as arrays:
+        yield json.loads(str(arrays['header']))
+        fields = json.loads(str(arrays['fields']))
+        for chunk, kinds in enumerate(json.loads(str(arrays['chunks']))):
+            yield {field: _decode_column(kind, arrays[f'c{index}_{chunk}'], arrays[f'e{index}_{chunk}'] if f'e{index}_{chunk}' in arrays else None)
+                   for index, (field, kind) in enumerate(zip(fields, kinds))}
+
+
+def get_json_format(filename):
+    for json_format in sorted(JSON_FORMATS, key=len, reverse=True):
+        if filename.endswith(f".{json_format}"):
+            return json_format
+    return JSON_FORMAT
+
+
+# Gather the json documents made by the shards of a capture into the json
+# document of the capture, numbering the packets in the order of the capture.
+# The parts are kept, they are removed by complete_shards.
+def merge_json_shards(rootdir, pcapfilename, shards, json_format=JSON_FORMAT):
+    with JsonDocument(rootdir, pcapfilename, json_format) as document:
+        for partname in shard_parts(rootdir, pcapfilename, shards, json_format):
+            packets = read_json_document(partname, json_format)
+            first_packet = next(packets)
+            if not document.packets:
+                document.write(first_packet)
+            for packet in packets:
+                packet['packet_id'] = document.packets - 1
+                document.write(packet)
+
+
+# Names of the files written by the shards of a capture, for the json
+# document or the counters sidecar (suffix)
+def shard_parts(rootdir, pcapfilename, shards, suffix):
+    filename = create_file(rootdir, pcapfilename, suffix)
+    return [f"{filename}.{index}" for index in range(shards)]
+
+
+# Sidecar of the json document of a capture, holding the deltas applied to
+# the redis counters by the ingestion of the capture, so the counters can be
+# stored again without parsing the packets. It is a gzip compressed file of
+# json lines: the parameters of the ingestion, then for each key either the
+# values added to a set, or the increments of the values of a sorted set.
+# A key may appear several times, the counters being written by blocks.
+class CountersSidecar():
+    def __init__(self, rootdir, pcapfilename, header, shard=None):
+        self.filename = create_file(rootdir, pcapfilename, COUNTERS_SUFFIX)
+        if shard is not None:
+            self.filename = f"{self.filename}.{shard[0]}"
+        self._tmpname = f"{self.filename}.tmp"
+        self._file = gzip.open(self._tmpname, 'wt', encoding='utf-8', compresslevel=JSON_COMPRESSION_LEVEL)
+        self._file.write(f"{json.dumps(header)}\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._tmpname)
+
+    def write(self, to_add, to_incr, to_expire=None):
+        for key, values in to_add.items():
+            self._file.write(f"{json.dumps({'key': key, 'add': sorted(values)})}\n")
+        for key, values in to_incr.items():
+            self._file.write(f"{json.dumps({'key': key, 'incr': values})}\n")
+        for key, timestamp in (to_expire or {}).items():
+            self._file.write(f"{json.dumps({'key': key, 'expireat': timestamp})}\n")
+
+    def write_entry(self, entry):
+        self._file.write(f"{json.dumps(entry)}\n")
+
+    def close(self):
+        self._file.close()
+        os.replace(self._tmpname, self.filename)
+
+
+# Iterate over the header then the entries of a counters sidecar
+def read_counters_sidecar(filename):
+    with gzip.open(filename, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+# Name of the counters sidecar of a json document
+def get_counters_sidecar(jsonfilename):
+    return f"{jsonfilename[:-len(get_json_format(jsonfilename))]}{COUNTERS_SUFFIX}"
+
+
+def merge_counters_shards(rootdir, pcapfilename, shards):
+    partnames = shard_parts(rootdir, pcapfilename, shards, COUNTERS_SUFFIX)
+    entries = read_counters_sidecar(partnames[0])
+    with CountersSidecar(rootdir, pcapfilename, next(entries)) as sidecar:
+        for partname in partnames:
+            entries = read_counters_sidecar(partname)
+            next(entries)
+            for entry in entries:
+                sidecar.write_entry(entry)
+
+
+# Record the captures processed by shards once all their shards are done:
+# gather their json documents (and counters sidecars), then commit their
+# ingestion, adding them to the imported files.
+# The parts are only removed once the ingestion is committed: an import
+# interrupted before the commit merges them again when it is run again, and
+# the parts left by an import interrupted after the commit are removed.
+def complete_shards(red, sharded_files, rootdir=None, json_format=JSON_FORMAT, counters=False):
+    for inputfile, shards in sharded_files.items():
+        filename = os.path.basename(inputfile)
+        journal = journal_key(filename)
+        if not red.hexists(journal, 'committed'):
+            if rootdir is not None:
+                merge_json_shards(rootdir, filename, len(shards), json_format)
+                if counters:
+                    merge_counters_shards(rootdir, filename, len(shards))
+            p = red.pipeline()
+            commit_journal(p, journal, filename)
+            p.delete(*(journal_key(filename, shard) for shard in shards))
+            p.execute()
+        if rootdir is not None:
+            partnames = shard_parts(rootdir, filename, len(shards), json_format)
+            if counters:
+                partnames += shard_parts(rootdir, filename, len(shards), COUNTERS_SUFFIX)
+            for partname in partnames:
+                try:
+                    os.remove(partname)
+                except FileNotFoundError:
+                    pass
+
+
 # Create the output directory if is does not exist
 def create_dir(rootdir):
     d = os.path.dirname(rootdir)
@@ -184,8 +1179,8 @@ def create_dir(rootdir):
 
 
 # Create the output directory and file if it does not exist
-def create_file(rootdir, pcapfilename):
-    jsonfilename = get_file_struct(rootdir, pcapfilename)
+def create_file(rootdir, pcapfilename, suffix="json"):
+    jsonfilename = get_file_struct(rootdir, pcapfilename, suffix)
     d = os.path.dirname(jsonfilename)
     try:
         if not os.path.exists(d):
@@ -321,5 +1316,39 @@ def get_annotations(red, feature, name):
                 errormsg("Reverse keys not created?. No data for " + kd)
     return out
 
+
+# Returns the lists of annotations of several keys given as (feature, name),
+# probing all the dictionaries with a single script
+def get_many_annotations(red, features):
+    p = red.pipeline(transaction=False)
+    queue_annotations(p, features)
+    return read_annotations(features, p.execute()[-1])
+
+
+# Queue on a pipeline the script probing the dictionaries of several keys
+# given as (feature, name), to batch it with the other reads of a page. Its
+# result is the last one of the pipeline, read by read_annotations.
+def queue_annotations(p, features):
+    keys = []
+    for feature, name in features:
+        for i in range(DICT_LOWER_BOUNDARY, TYPE_UPPER_BOUNDARY):
+            keys.extend(("AR_{}_{}".format(i, feature), "TR_a_{}_{}".format(i, name)))
+    p.eval(_GET_ANNOTATIONS, len(keys), *keys)
+
+
+def read_annotations(features, result):
+    out = []
+    result = iter(result)
+    for _, name in features:
+        annotations = []
+        for i in range(DICT_LOWER_BOUNDARY, TYPE_UPPER_BOUNDARY):
+            value = next(result)
+            if value == 1:
+                errormsg("Reverse keys not created?. No data for TR_a_{}_{}".format(i, name))
+            elif value != 0:
+                annotations.append(decode(value))
+        out.append(annotations)
+    return out
+
 if __name__ == "__main__":
     print(get_file_struct("/tmp", "aaa"))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Indexing of the keys stored before the ingestion maintained the indexes of
+# the sensors, protocols, days and isn or layer2 hashes (see
+# potiron.index_days, potiron.add_days and potiron.index_hashes): the
+# keyspace is scanned once, and the keys found are indexed as the ingestion
+# would have done.
+
+from collections import defaultdict
+from potiron.potiron import add_days, index_days, index_hashes, SCAN_COUNT
+import re
+
+# Sorted sets of the days (sensorname[:protocol]:YYYYMMDD:field)
+_day_key = re.compile(r'^[^:]+(:[^:]+)?:\d{8}:[^:]+$')
+# Hashes of the isn (sensorname_src{sport}_dst{dport}_{day}_{time}) and
+# layer2 (sensorname_{ip}_{day}_{time}) formats, with their sensor
+_hash_keys = {'isn': re.compile(r'^(.+)_src\d*_dst\d*_\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:[\d.]+$'),
+              'layer2': re.compile(r'^(.+)_[^_]+_\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:[\d.]+$')}
+
+
+# Index the keys of the dataset, with at most batch_size keys indexed per
+# pipeline, and return the number of keys indexed
+def rebuild_indexes(red, batch_size=10000):
+    hash_key = _hash_keys.get(red.hget('PARAMETERS', 'format'))
+    indexed = 0
+    day_sets = []
+    day_keys, hash_keys, count = [], defaultdict(list), 0
+    for key in red.scan_iter(count=SCAN_COUNT):
+        key = key.decode() if isinstance(key, bytes) else key
+        if key.endswith('_DAYS'):
+            day_sets.append(key)
+            continue
+        if hash_key is None:
+            if _day_key.match(key) is None:
+                continue
+            day_keys.append(key)
+        else:
+            match = hash_key.match(key)
+            if match is None:
+                continue
+            hash_keys[match.group(1)].append(key)
+        count += 1
+        if count == batch_size:
+            _index_batch(red, day_keys, hash_keys)
+            indexed += count
+            day_keys, hash_keys, count = [], defaultdict(list), 0
+    _index_batch(red, day_keys, hash_keys)
+    p = red.pipeline(transaction=False)
+    for key in day_sets:
+        add_days(p, key[:-len('_DAYS')], *(day.decode() if isinstance(day, bytes) else day for day in red.smembers(key)))
+    p.execute()
+    return indexed + count + len(day_sets)
+
+
+def _index_batch(red, day_keys, hash_keys):
+    p = red.pipeline(transaction=False)
+    index_days(p, day_keys)
+    for sensorname, keys in hash_keys.items():
+        index_hashes(p, sensorname, keys)
+    p.execute()
@@ -19,44 +19,71 @@
 
 from collections import defaultdict
 from concurrent.futures import ProcessPoolExecutor
-from potiron.potiron_tshark import day_from_filename, _set_redis_timestamp, _set_json_timestamp
+from lib.helpers import get_redis_connection
+from potiron.potiron_time import LOCAL_TIMEZONE, TimestampConverter
+from potiron.potiron_tshark import day_from_filename
 import os
-import json
 import potiron.potiron as potiron
-import subprocess
+import potiron.potiron_pcap as potiron_pcap
 
 non_index = ['', 'timestamp', 'state', 'type', 'sport', 'dport']
 _to_process = {'False': '_process_file', 'True': '_process_file_and_save_json'}
 
 
-def isn_process(red, files, logconsole):
+def isn_process(redis_parameters, files, logconsole, workers=None):
+    red, to_process = isn_setup(redis_parameters, logconsole)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(redis_parameters,)) as executor:
+        layouts = potiron.get_shard_layouts(red, files)
+        files, shards, sharded_files = potiron_pcap.shard_captures(executor, files, _SHARDS if _ENGINE == 'native' else 0, _SHARD_MIN_SIZE, layouts)
+        potiron.set_shard_layouts(red, sharded_files)
+        for to_return in executor.map(to_process, files, shards):
+            potiron.infomsg(to_return)
+    potiron.complete_shards(red, sharded_files, _ROOTDIR if _ENABLE_JSON == 'True' else None, _JSON_FORMAT)
+
+
+# Load the parameters of the ingestion in the module, before the workers are
+# forked, and return the redis connection and the function processing a
+# capture file in the workers (initialized with _init_worker)
+def isn_setup(redis_parameters, logconsole):
+    red = get_redis_connection(**redis_parameters)
     potiron.logconsole = logconsole
     for key, value in red.hgetall('PARAMETERS').items():
         globals()[f"_{key.upper()}"] = value
     if _ENABLE_JSON:
         globals()["_FIRST_PACKET"] = {feature[1:].lower(): globals()[feature] for feature in ("_FORMAT", "_TSHARK_FILTER")}
-    globals()["_RED"] = red
-    with ProcessPoolExecutor() as executor:
-        for to_return in executor.map(globals()[_to_process[_ENABLE_JSON]], files):
-            potiron.infomsg(to_return)
+    globals()["_TSHARK_FIELDS"] = potiron.isn_tshark_fields
+    globals()["_TIMESTAMPS"] = TimestampConverter(globals().get('_TIMEZONE', LOCAL_TIMEZONE))
+    globals()["_TSHARK_TIMEOUT"] = int(globals().get("_TSHARK_TIMEOUT", potiron.TSHARK_TIMEOUT))
+    globals()["_DECOMPRESS"] = globals().get("_DECOMPRESS") == 'True'
+    globals()["_JSON_FORMAT"] = globals().get("_JSON_FORMAT", potiron.JSON_FORMAT)
+    for key, default in (("_SHARDS", potiron.SHARDS), ("_SHARD_MIN_SIZE", potiron.SHARD_MIN_SIZE)):
+        globals()[key] = int(globals().get(key, default))
+    return red, globals()[_to_process[_ENABLE_JSON]]
 
 
-def _process_file(inputfile):
+# Open the redis connection of each worker, after the fork
+def _init_worker(redis_parameters):
+    globals()["_RED"] = get_redis_connection(**redis_parameters)
+
+
+def _process_file(inputfile, shard=None, lines=None):
     to_set, filename, sensorname = _get_data_structures(inputfile)
     if _RED.sismember("FILES", filename):
         return f'Filename {inputfile} was already imported ... skip ...\n'
-    proc = subprocess.Popen(_CMD.format(inputfile), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    journal = potiron.journal_key(filename, shard)
+    if potiron.start_journal(_RED, journal)[0]:
+        return f'ISN Data from {filename} already parsed.'
 
     lastday = day_from_filename(filename)
-    _RED.sadd(f"{sensorname}_DAYS", lastday)
-    for line in proc.stdout.readlines():
+    potiron.add_days(_RED, sensorname, lastday)
+    for line in _read_capture(inputfile, shard, lines):
         packet = _create_packet(line)
-        timestamp = _set_json_timestamp(packet.pop('timestamp'))
+        timestamp = _TIMESTAMPS.json_timestamp(packet.pop('timestamp'))
         day, time = timestamp.split(' ')
         timestamp = f"{day}_{time}"
         day = day.replace('-', '')
         if day != lastday:
-            _RED.sadd(f"{sensorname}_DAYS", day)
+            potiron.add_days(_RED, sensorname, day)
             lastday = day
         ports = "_".join([f"{port}{packet.pop(value)}" for port, value in zip(('src', 'dst'), ('sport', 'dport'))])
         key = f"{sensorname}_{ports}_{timestamp}"
@@ -65,49 +92,61 @@ def _process_file(inputfile):
     p = _RED.pipeline()
     for key, item in to_set.items():
         p.hmset(key, item)
+    potiron.index_hashes(p, sensorname, to_set)
+    potiron.commit_journal(p, journal, filename if shard is None else None)
     p.execute()
-    proc.wait()
-    _RED.sadd("FILES", filename)
     return f'ISN Data from {filename} parsed.'
 
 
-def _process_file_and_save_json(inputfile):
+def _process_file_and_save_json(inputfile, shard=None, lines=None):
     to_set, filename, sensorname = _get_data_structures(inputfile)
     if _RED.sismember("FILES", filename):
         return f'Filename {inputfile} was already imported ... skip ...\n'
-    proc = subprocess.Popen(_CMD.format(inputfile), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    journal = potiron.journal_key(filename, shard)
+    if potiron.start_journal(_RED, journal)[0]:
+        return f'ISN Data from {filename} already parsed and stored in json format.'
     first_packet = {"type": potiron.TYPE_SOURCE, "sensorname": sensorname, "filename": filename}
     first_packet.update(_FIRST_PACKET)
-    allpackets = [first_packet]
 
     lastday = day_from_filename(filename)
-    _RED.sadd(f"{sensorname}_DAYS", lastday)
-    packet_id = 0
-    for line in proc.stdout.readlines():
-        packet = _create_packet(line)
-        packet['timestamp'] = _set_json_timestamp(packet['timestamp'])
-        allpackets.append(_create_json_packet(packet, packet_id))
-        day, time = packet.pop('timestamp').split(' ')
-        timestamp = f'{day}_{time}'
-        day = day.replace('-', '')
-        if day != lastday:
-            _RED.sadd(f"{sensorname}_DAYS", day)
-            lastday = day
-        ports = "_".join([f"{port}{packet.pop(value)}" for port, value in zip(('src', 'dst'), ('sport', 'dport'))])
-        key = f"{sensorname}_{ports}_{timestamp}"
-        to_set[key] = {isn_type: value for isn_type, value in packet.items()}
-        packet_id += 1
+    potiron.add_days(_RED, sensorname, lastday)
+    with potiron.JsonDocument(_ROOTDIR, filename, _JSON_FORMAT, shard) as document:
+        document.write(first_packet)
+        packet_id = 0
+        for line in _read_capture(inputfile, shard, lines):
+            packet = _create_packet(line)
+            packet['timestamp'] = _TIMESTAMPS.json_timestamp(packet['timestamp'])
+            document.write(_create_json_packet(packet, packet_id))
+            day, time = packet.pop('timestamp').split(' ')
+            timestamp = f'{day}_{time}'
+            day = day.replace('-', '')
+            if day != lastday:
+                potiron.add_days(_RED, sensorname, day)
+                lastday = day
+            ports = "_".join([f"{port}{packet.pop(value)}" for port, value in zip(('src', 'dst'), ('sport', 'dport'))])
+            key = f"{sensorname}_{ports}_{timestamp}"
+            to_set[key] = {isn_type: value for isn_type, value in packet.items()}
+            packet_id += 1
 
     p = _RED.pipeline()
     for key, item in to_set.items():
         p.hmset(key, item)
+    potiron.index_hashes(p, sensorname, to_set)
+    potiron.commit_journal(p, journal, filename if shard is None else None)
     p.execute()
-    proc.wait()
-    potiron.store_packet(_ROOTDIR, filename, json.dumps(allpackets))
-    _RED.sadd("FILES", filename)
     return f'ISN Data from {filename} parsed and stored in json format.'
 
 
+# The lines may have been read from the capture for several formats at once
+# (see potiron_multi_tshark), they are then used as they are
+def _read_capture(inputfile, shard=None, lines=None):
+    if lines is not None:
+        return lines
+    if _ENGINE == 'native':
+        return potiron_pcap.native_output(inputfile, _TSHARK_FIELDS, _FORMAT, shard, _DECOMPRESS)
+    return potiron.tshark_output(potiron_pcap.tshark_command(_CMD, inputfile, _DECOMPRESS), _TSHARK_TIMEOUT)
+
+
 def _create_packet(line):
     line = line.decode().strip('\n')
     return {key: value for key, value in zip(potiron.isn_json_fields, line.split(' '))}
@@ -19,46 +19,67 @@
 
 from collections import defaultdict
 from concurrent.futures import ProcessPoolExecutor
+from lib.helpers import get_redis_connection
 from potiron.potiron_isn_tshark import _create_json_packet
-from potiron.potiron_tshark import day_from_filename, _set_json_timestamp
-import json
+from potiron.potiron_time import LOCAL_TIMEZONE, TimestampConverter
+from potiron.potiron_tshark import day_from_filename
 import os
 import potiron.potiron as potiron
-import subprocess
+import potiron.potiron_pcap as potiron_pcap
 
 _to_process = {'False': '_process_file', 'True': '_process_file_and_save_json'}
 
 
-def layer2_process(red, files, logconsole):
+def layer2_process(redis_parameters, files, logconsole, workers=None):
+    red, to_process = layer2_setup(redis_parameters, logconsole)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(redis_parameters,)) as executor:
+        for to_return in executor.map(to_process, files):
+            potiron.infomsg(to_return)
+
+
+# Load the parameters of the ingestion in the module, before the workers are
+# forked, and return the redis connection and the function processing a
+# capture file in the workers (initialized with _init_worker)
+def layer2_setup(redis_parameters, logconsole):
+    red = get_redis_connection(**redis_parameters)
     potiron.logconsole = logconsole
     for key, value in red.hgetall('PARAMETERS').items():
         globals()[f"_{key.upper()}"] = value
     if _ENABLE_JSON:
         globals()["_FIRST_PACKET"] = {feature[1:].lower(): globals()[feature] for feature in ("_FORMAT", "_TSHARK_FILTER")}
-    globals()["_RED"] = red
-    with ProcessPoolExecutor() as executor:
-        for to_return in executor.map(globals()[_to_process[_ENABLE_JSON]], files):
-            potiron.infomsg(to_return)
+    globals()["_TSHARK_FIELDS"] = potiron.layer2_tshark_fields
+    globals()["_TIMESTAMPS"] = TimestampConverter(globals().get('_TIMEZONE', LOCAL_TIMEZONE))
+    globals()["_TSHARK_TIMEOUT"] = int(globals().get("_TSHARK_TIMEOUT", potiron.TSHARK_TIMEOUT))
+    globals()["_DECOMPRESS"] = globals().get("_DECOMPRESS") == 'True'
+    globals()["_JSON_FORMAT"] = globals().get("_JSON_FORMAT", potiron.JSON_FORMAT)
+    return red, globals()[_to_process[_ENABLE_JSON]]
 
 
-def _process_file(inputfile):
+# Open the redis connection of each worker, after the fork
+def _init_worker(redis_parameters):
+    globals()["_RED"] = get_redis_connection(**redis_parameters)
+
+
+def _process_file(inputfile, lines=None):
     to_set = {}
     to_incr, filename, sensorname = _get_data_structures(inputfile)
     if _RED.sismember("FILES", filename):
         return f'Filename {inputfile} was already imported ... skip ...\n'
-    proc = subprocess.Popen(_CMD.format(inputfile), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    journal = potiron.journal_key(filename)
+    if potiron.start_journal(_RED, journal)[0]:
+        return f'Layer2 data from {filename} already parsed.'
 
     lastday = day_from_filename(filename)
-    _RED.sadd(f"{sensorname}_DAYS", lastday)
+    potiron.add_days(_RED, sensorname, lastday)
     count_key = f"{sensorname}_{lastday}_count"
-    for line in proc.stdout.readlines():
+    for line in _read_capture(inputfile, lines):
         packet = _create_packet(line)
-        timestamp = _set_json_timestamp(packet.pop('timestamp'))
+        timestamp = _TIMESTAMPS.json_timestamp(packet.pop('timestamp'))
         day, time = timestamp.split(' ')
         timestamp = f"{day}_{time}"
         day = day.replace('-', '')
         if day != lastday:
-            _RED.sadd(f"{sensorname}_DAYS", day)
+            potiron.add_days(_RED, sensorname, day)
             count_key = f"{sensorname}_{day}_count"
             lastday = day
         if packet['opcode'] == '1':
@@ -77,68 +98,76 @@ def _process_file(inputfile):
     p = _RED.pipeline()
     for key, values in to_set.items():
         p.hmset(key, values)
-    for key, values in to_incr.items():
-        for value, amount in values.items():
-            p.zincrby(key, amount, value)
+    potiron.index_hashes(p, sensorname, to_set)
+    potiron.bulk_increment(p, to_incr)
+    potiron.commit_journal(p, journal, filename)
     p.execute()
-    proc.wait()
-    _RED.sadd("FILES", filename)
     return f"Layer2 data from {filename} parsed."
 
 
-def _process_file_and_save_json(inputfile):
+def _process_file_and_save_json(inputfile, lines=None):
     to_set = {}
     to_incr, filename, sensorname = _get_data_structures(inputfile)
     if _RED.sismember("FILES", filename):
         return f'Filename {inputfile} was already imported ... skip ...\n'
-    proc = subprocess.Popen(_CMD.format(inputfile), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    journal = potiron.journal_key(filename)
+    if potiron.start_journal(_RED, journal)[0]:
+        return f'Layer2 data from {filename} already parsed and stored in json format.'
     first_packet = {"type": potiron.TYPE_SOURCE, "sensorname": sensorname, "filename": filename}
     first_packet.update(_FIRST_PACKET)
-    allpackets = [first_packet]
 
     lastday = day_from_filename(filename)
-    _RED.sadd(f"{sensorname}_DAYS", lastday)
+    potiron.add_days(_RED, sensorname, lastday)
     count_key = f"{sensorname}_{lastday}_count"
-    packet_id = 0
-    for line in proc.stdout.readlines():
-        packet = _create_packet(line)
-        packet['timestamp'] = _set_json_timestamp(packet['timestamp'])
-        allpackets.append(_create_json_packet(packet, packet_id))
-        day, time = packet.pop('timestamp').split(' ')
-        timestamp = f"{day}_{time}"
-        day = day.replace('-', '')
-        if day != lastday:
-            _RED.sadd(f"{sensorname}_DAYS", day)
-            count_key = f"{sensorname}_{day}_count"
-            lastdady = day
-        if packet['opcode'] == '1':
-            keyname = f"{sensorname}_{packet['ipdst']}_{timestamp}"
-            values = [packet[value] for value in ('ethsrc', 'ipsrc', 'arpsrc')]
-            to_set[keyname] = {key: value for key, value in zip(('req_src_mac', 'req_src_ip', 'req_src_arp_mac'), values)}
-            to_incr[count_key]['request'] += 1
-            timestamp_key = timestamp
-        else:
-            keyname = f"{sensorname}_{packet['ipsrc']}_{timestamp_key}"
-            values = [packet[value] for value in ('ipdst', 'ethsrc', 'ethdst', 'arpsrc', 'arpdst')]
-            keys = ('rep_dst_ip', 'rep_src_mac', 'rep_dst_mac', 'rep_src_arp_mac', 'rep_dst_arp_mac')
-            to_set[keyname] = {key: value for key, value in zip(keys, values)}
-            to_set[keyname]['rep_timestamp'] = timestamp
-            to_incr[count_key]['reply'] += 1
-        packet_id += 1
+    with potiron.JsonDocument(_ROOTDIR, filename, _JSON_FORMAT) as document:
+        document.write(first_packet)
+        packet_id = 0
+        for line in _read_capture(inputfile, lines):
+            packet = _create_packet(line)
+            packet['timestamp'] = _TIMESTAMPS.json_timestamp(packet['timestamp'])
+            document.write(_create_json_packet(packet, packet_id))
+            day, time = packet.pop('timestamp').split(' ')
+            timestamp = f"{day}_{time}"
+            day = day.replace('-', '')
+            if day != lastday:
+                potiron.add_days(_RED, sensorname, day)
+                count_key = f"{sensorname}_{day}_count"
+                lastdady = day
+            if packet['opcode'] == '1':
+                keyname = f"{sensorname}_{packet['ipdst']}_{timestamp}"
+                values = [packet[value] for value in ('ethsrc', 'ipsrc', 'arpsrc')]
+                to_set[keyname] = {key: value for key, value in zip(('req_src_mac', 'req_src_ip', 'req_src_arp_mac'), values)}
+                to_incr[count_key]['request'] += 1
+                timestamp_key = timestamp
+            else:
+                keyname = f"{sensorname}_{packet['ipsrc']}_{timestamp_key}"
+                values = [packet[value] for value in ('ipdst', 'ethsrc', 'ethdst', 'arpsrc', 'arpdst')]
+                keys = ('rep_dst_ip', 'rep_src_mac', 'rep_dst_mac', 'rep_src_arp_mac', 'rep_dst_arp_mac')
+                to_set[keyname] = {key: value for key, value in zip(keys, values)}
+                to_set[keyname]['rep_timestamp'] = timestamp
+                to_incr[count_key]['reply'] += 1
+            packet_id += 1
 
     p = _RED.pipeline()
     for key, values in to_set.items():
         p.hmset(key, values)
-    for key, values in to_incr.items():
-        for value, amount in values.items():
-            p.zincrby(key, amount, value)
+    potiron.index_hashes(p, sensorname, to_set)
+    potiron.bulk_increment(p, to_incr)
+    potiron.commit_journal(p, journal, filename)
     p.execute()
-    proc.wait()
-    potiron.store_packet(_ROOTDIR, filename, json.dumps(allpackets))
-    _RED.sadd("FILES", filename)
     return f"Layer2 data from {filename} parsed and stored in json format."
 
 
+# The lines may have been read from the capture for several formats at once
+# (see potiron_multi_tshark), they are then used as they are
+def _read_capture(inputfile, lines=None):
+    if lines is not None:
+        return lines
+    if _ENGINE == 'native':
+        return potiron_pcap.native_output(inputfile, _TSHARK_FIELDS, _FORMAT, decompress=_DECOMPRESS)
+    return potiron.tshark_output(potiron_pcap.tshark_command(_CMD, inputfile, _DECOMPRESS), _TSHARK_TIMEOUT)
+
+
 def _create_packet(line):
     line = line.decode().strip('\n')
     return {key: value for key, value in zip(potiron.layer2_json_fields, line.split(' '))}
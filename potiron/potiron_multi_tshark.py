@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Ingestion of several formats at once, each in its own redis instance: the
+# packets of each capture are read only once (by tshark or the native
+# engine) with the union of the fields of the formats, and each packet is
+# routed to the formats whose default filter it matches, rendered as the
+# line tshark would output for the fields of the format.
+# The first format processes its lines as they are read, while the lines of
+# the other formats are written in temporary files, processed afterwards by
+# their own module, with its own journal.
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from lib.helpers import get_redis_connection
+from potiron.potiron_parameters import _predefine_cmd
+import os
+import potiron.potiron as potiron
+import potiron.potiron_isn_tshark as potiron_isn_tshark
+import potiron.potiron_layer2_tshark as potiron_layer2_tshark
+import potiron.potiron_pcap as potiron_pcap
+import potiron.potiron_tshark as potiron_tshark
+import tempfile
+
+_modules = {'standard': potiron_tshark, 'isn': potiron_isn_tshark, 'layer2': potiron_layer2_tshark}
+_default_filters = {'standard': potiron.tshark_filter, 'isn': potiron.isn_tshark_filter, 'layer2': potiron.layer2_tshark_filter}
+# Fields used to route the packets output by tshark to the formats
+_routing_fields = ('ip.dst', 'ip.proto', 'eth.type')
+
+
+def multi_process(backends, files, logconsole, workers=None, tshark_filter=''):
+    multi_setup(backends, logconsole, tshark_filter)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(backends,)) as executor:
+        for to_return in executor.map(_process_file, files):
+            potiron.infomsg(to_return)
+
+
+# Load the parameters of the ingestion of each format in its module, with the
+# parameters of the redis instance of each format given in backends, then
+# define the single command reading the captures for all the formats
+def multi_setup(backends, logconsole, tshark_filter=''):
+    processors = {}
+    for format in _modules:
+        if format in backends:
+            red, processors[format] = getattr(_modules[format], f"{format}_setup")(backends[format], logconsole)
+            if len(processors) == 1:
+                for key, value in red.hgetall('PARAMETERS').items():
+                    globals()[f"_{key.upper()}"] = value
+    globals()["_PROCESSORS"] = processors
+    globals()["_FORMAT_FIELDS"] = {format: _modules[format]._TSHARK_FIELDS for format in processors}
+    fields = [field for format_fields in _FORMAT_FIELDS.values() for field in format_fields]
+    globals()["_UNION_FIELDS"] = list(dict.fromkeys(fields + list(_routing_fields)))
+    union_filter = " || ".join(f"({_default_filters[format]})" for format in processors)
+    if tshark_filter:
+        union_filter = f"({union_filter}) && {tshark_filter}"
+    # All the occurrences are output, to route the packets as the filters of
+    # the formats would select them (see potiron_pcap._standard_filter)
+    globals()["_CMD"] = _predefine_cmd(union_filter, _UNION_FIELDS, occurrence='a')
+    globals()["_TSHARK_TIMEOUT"] = int(globals().get("_TSHARK_TIMEOUT", potiron.TSHARK_TIMEOUT))
+    globals()["_DECOMPRESS"] = globals().get("_DECOMPRESS") == 'True'
+
+
+# Open the redis connection of each format in each worker, after the fork
+def _init_worker(backends):
+    for format, redis_parameters in backends.items():
+        _modules[format]._init_worker(redis_parameters)
+
+
+def _process_file(inputfile):
+    filename = os.path.basename(inputfile)
+    formats = [format for format in _PROCESSORS if not _modules[format]._RED.sismember("FILES", filename)]
+    if not formats:
+        return f'Filename {inputfile} was already imported ... skip ...\n'
+    first, *others = formats
+    to_return = []
+    with ExitStack() as stack:
+        spools = {format: stack.enter_context(tempfile.TemporaryFile()) for format in others}
+        lines = _route_packets(_read_packets(inputfile), first, spools)
+        to_return.append(_PROCESSORS[first](inputfile, lines=lines))
+        # The lines already imported are not read when an import is resumed
+        deque(lines, maxlen=0)
+        for format, spool in spools.items():
+            spool.seek(0)
+            to_return.append(_PROCESSORS[format](inputfile, lines=spool))
+    return "\n".join(to_return)
+
+
+# Yield the lines of the packets of the first format, and write the lines of
+# the packets of the other formats in their temporary file
+def _route_packets(packets, first, spools):
+    keep_first, first_fields = potiron_pcap._filters[first], _FORMAT_FIELDS[first]
+    others = [(potiron_pcap._filters[format], _FORMAT_FIELDS[format], spool.write) for format, spool in spools.items()]
+    render_line = potiron_pcap.render_line
+    for values in packets:
+        for keep, fields, write in others:
+            if keep(values):
+                write(render_line(values, fields))
+        if keep_first(values):
+            yield render_line(values, first_fields)
+
+
+# Yield the values of the packets of a capture, as the native engine
+# dissects them (the fields tshark does not output are left out)
+def _read_packets(inputfile):
+    if _ENGINE == 'native':
+        return potiron_pcap.native_values(inputfile, decompress=_DECOMPRESS)
+    return _tshark_values(potiron.tshark_output(potiron_pcap.tshark_command(_CMD, inputfile, _DECOMPRESS), _TSHARK_TIMEOUT))
+
+
+def _tshark_values(lines):
+    for line in lines:
+        values = {}
+        for field, occurrences in zip(_UNION_FIELDS, line.decode().rstrip('\n').split(' ')):
+            if occurrences:
+                occurrences = occurrences.split(',')
+                values[field] = occurrences[0]
+                values[f"{field}:all"] = occurrences
+        if 'eth.type' in values:
+            values['eth.type'] = int(values['eth.type'], 16)
+        yield values
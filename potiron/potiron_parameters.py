@@ -23,11 +23,16 @@ import sys
 
 potiron_parameters = {'ip_score': '3', 'json_fields': potiron.json_fields,
                       'port_score': '15', 'to_call': '_parse_ips_parse_ports_parse_protocol'}
-_critical_redis_parameters = ('cmd', 'tshark_filter')
+_critical_redis_parameters = ('cmd', 'tshark_filter', 'timezone')
+# Parameters defining the counters of a flush and how they are split into
+# batches (see potiron.flush_data): an interrupted flush is completed by
+# skipping the batches already applied, so they can not change until it is
+# resumed
+_batch_redis_parameters = ('batch_size', 'chunk_size', 'vectorized', 'ck', 'buckets', 'hll', 'topk')
 
 
 def _check_parameters(red, parameters):
-    if red.keys('PARAMETERS'):
+    if red.exists('PARAMETERS'):
         _check_parameter_fields(red, parameters)
     else:
         red.hmset('PARAMETERS', parameters)
@@ -47,7 +52,7 @@ def _check_parameter_fields(red, parameters):
 
 def _check_standard_parameters(red, parameters):
     fields = parameters.pop('fields')
-    if red.keys('FIELDS') and red.keys('PARAMETERS'):
+    if red.exists('FIELDS') and red.exists('PARAMETERS'):
         red_fields = set(red.lrange('FIELDS', 0, -1))
         if red_fields != set(fields):
             sys.exit(f'[INFO] Fields you are trying to ingest are not the same as the ones currently used: {red_fields}\n')
@@ -61,18 +66,23 @@ def _check_standard_parameters(red, parameters):
 def _deeper_parameter_fields_check(red, red_params, current):
     error = ""
     change = ""
+    interrupted = None
     for key, value in red_params.items():
         try:
             current_value = current[key]
         except KeyError:
             continue
         if value != current_value:
-            if key in _critical_redis_parameters:
+            if key in _batch_redis_parameters and interrupted is None:
+                interrupted = potiron.interrupted_flushes(red)
+            if key in _critical_redis_parameters or (key in _batch_redis_parameters and interrupted):
                 error += f" - {key}:\n\t - current value: '{current_value}'\n\t - value saved in redis: '{value}'\n"
             else:
                 red.hset("PARAMETERS", key, current_value)
                 change += f" - {key}: {value} changed into {current_value}\n"
     if error:
+        if interrupted:
+            error += f"The import of {', '.join(interrupted)} was interrupted during a flush, it should be resumed with the same parameters.\n"
         sys.exit(f"[INFO] Error with some of the critical parameters:\n{error}")
     if change:
         print(f"[INFO] Some not critical parameters have changed, the execution is not compromised but notice the following changes:\n{change}")
@@ -119,13 +129,10 @@ def fetch_parameters(**parameters):
 
 def _fill_redis_parameters(red, red_parameters, parameters):
     for key, value in parameters.items():
-        if key in red_parameters:
-            if value != red_parameters[key]:
-                sys.exit(f"Error with a critical parameter: {key} \
-                should be {red_parameters[key]} but is currently {value}.")
-        else:
+        if key not in red_parameters:
             red.hset("PARAMETERS", key, value)
             print(f"Adding to parameters {key} value: {value}.")
+    _deeper_parameter_fields_check(red, red_parameters, parameters)
 
 
 def _get_current_fields(field_filter):
@@ -168,8 +175,11 @@ def _get_port_score(fields):
     return score
 
 
-def _predefine_cmd(tshark_filter, field_filter):
+# With occurrence='a', all the occurrences of the fields are output,
+# separated by commas
+def _predefine_cmd(tshark_filter, field_filter, occurrence='f'):
     filters = "-e {}".format(" -e ".join(field_filter))
-    setup = f"-E header=n -E separator=/s -E occurrence=f -Y '{tshark_filter}' -r"
+    aggregator = " -E aggregator=," if occurrence == 'a' else ""
+    setup = f"-E header=n -E separator=/s -E occurrence={occurrence}{aggregator} -Y '{tshark_filter}' -r"
     end = "{} -o tcp.relative_sequence_numbers:FALSE"
     return f"tshark -n -q -Tfields {filters} {setup} {end}"
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Native decoder of classic pcap files (plain or compressed), used as an
+# alternative to tshark when only the IPv4 / TCP / UDP / ICMP / ARP header
+# fields potiron stores are needed.
+# The decoded packets are rendered exactly as `tshark -Tfields -E separator=/s
+# -E occurrence=f` renders them, so the parsing done by the standard, ISN and
+# layer2 modules does not depend on the engine used.
+
+from itertools import repeat
+from lib.exceptions import UnsupportedCapture
+from socket import inet_ntoa
+import gzip
+import os
+import potiron.potiron as potiron
+import shlex
+import struct
+import subprocess
+
+# Magic number -> (byte order, factor to convert the fractional part of the
+# timestamps into nanoseconds)
+_pcap_magic = {b'\xd4\xc3\xb2\xa1': ('<', 1000), b'\xa1\xb2\xc3\xd4': ('>', 1000),
+               b'\x4d\x3c\xb2\xa1': ('<', 1), b'\xa1\xb2\x3c\x4d': ('>', 1)}
+_pcapng_magic = b'\x0a\x0d\x0d\x0a'
+# Magic number -> compression of the compressed captures, and the programs
+# able to decompress them in a separate process (the first installed is used)
+_compressions = {b'\x1f\x8b': 'gzip', b'\x28\xb5\x2f\xfd': 'zstd', b'\x04\x22\x4d\x18': 'lz4'}
+_decompressors = {'gzip': ('pigz', 'gzip'), 'zstd': ('zstd',), 'lz4': ('lz4',)}
+# Size of the buffer of the pipe reading the output of a decompression program
+_PIPE_BUFFER = 1024 * 1024
+# Granularity, in records, of the boundaries of the shards of a capture
+_SPLIT_STEP = 1024
+
+_LINKTYPE_NULL = 0
+_LINKTYPE_ETHERNET = 1
+_LINKTYPE_RAW = (12, 14, 101)
+_LINKTYPE_LOOP = 108
+_LINKTYPE_LINUX_SLL = 113
+_LINKTYPE_LINUX_SLL2 = 276
+
+_ETHERTYPE_IP = 0x0800
+_ETHERTYPE_ARP = 0x0806
+_ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+# ICMP types carrying the header of the packet which triggered them
+_icmp_errors = (3, 4, 5, 11, 12)
+
+_ipv4 = struct.Struct('!BBHHHBBH4s4s')
+_tcp = struct.Struct('!HHIIBB')
+_ports = struct.Struct('!HH')
+_arp = struct.Struct('!HHBBH')
+_ethertype = struct.Struct('!H')
+
+
+# Filters applied by default by tshark (see potiron.tshark_filter and co.),
+# reproduced for the native engine. They test all the occurrences of the
+# fields (the ':all' values, see _dissect_ipv4), as the headers embedded in
+# ICMP errors or IP in IP tunnels: `ip.proto eq 6` matches any occurrence,
+# and `ip.dst ne 255.255.255.255` only matches when all of them differ (as
+# with tshark 3.6 and later).
+def _standard_filter(values):
+    destinations = values.get('ip.dst:all')
+    return bool(destinations) and '255.255.255.255' not in destinations
+
+
+def _isn_filter(values):
+    return _standard_filter(values) and '6' in values['ip.proto:all']
+
+
+def _layer2_filter(values):
+    return values.get('eth.type') == _ETHERTYPE_ARP
+
+
+_filters = {'standard': _standard_filter, 'isn': _isn_filter, 'layer2': _layer2_filter}
+
+
+# Yield the lines tshark would output for the given fields of the packets
+# of a pcap file, already filtered with the default filter of the format.
+# With a shard (see split_capture), only the records of the shard are read.
+def native_output(inputfile, fields, format, shard=None, decompress=False):
+    keep = _filters[format]
+    for values in native_values(inputfile, shard, decompress):
+        if keep(values):
+            yield render_line(values, fields)
+
+
+# Yield the values of all the packets of a pcap file which can be decoded,
+# without filtering them, so they can be filtered and rendered afterwards
+# for several formats
+def native_values(inputfile, shard=None, decompress=False):
+    offset, count = shard[1:] if shard is not None else (None, None)
+    for seconds, nanoseconds, linktype, data in read_pcap(inputfile, offset, count, decompress):
+        values = dissect(linktype, data)
+        if values is None:
+            continue
+        values['frame.time_epoch'] = f"{seconds}.{nanoseconds:09d}"
+        yield values
+
+
+# Render the values of a packet as the line output by tshark for the fields
+def render_line(values, fields):
+    return f"{' '.join(values.get(field, '') for field in fields)}\n".encode()
+
+
+# Iterate over the records of a pcap file:
+# (timestamp seconds, timestamp nanoseconds, link type, captured bytes)
+# starting from the record at `offset` in the (decompressed) file, and
+# stopping after `count` records if it is defined
+def read_pcap(inputfile, offset=None, count=None, decompress=False):
+    with open_capture(inputfile, decompress) as f:
+        endianness, factor, linktype = _read_header(f, inputfile)
+        if offset is not None:
+            f.seek(offset)
+        record = struct.Struct(f'{endianness}IIII')
+        read = f.read
+        for _ in repeat(None) if count is None else repeat(None, count):
+            record_header = read(16)
+            if len(record_header) < 16:
+                break
+            seconds, fraction, caplen, _ = record.unpack(record_header)
+            data = read(caplen)
+            if len(data) < caplen:
+                break
+            yield seconds, fraction * factor, linktype, data
+
+
+# Split a pcap file into (at most) `shards` parts of contiguous records,
+# without copying anything: each part is defined by its index, the offset of
+# its first record in the (decompressed) file, and its number of records.
+# Only the record headers are read, and the boundaries of the parts are
+# aligned on _SPLIT_STEP records to keep the list of candidate offsets small.
+def split_capture(inputfile, shards):
+    offsets = []
+    records = 0
+    with open_capture(inputfile) as f:
+        endianness, _, _ = _read_header(f, inputfile)
+        caplen_struct = struct.Struct(f'{endianness}8xI4x')
+        read, seek = f.read, f.seek
+        offset = 24
+        while True:
+            record_header = read(16)
+            if len(record_header) < 16:
+                break
+            if not records % _SPLIT_STEP:
+                offsets.append(offset)
+            caplen = caplen_struct.unpack(record_header)[0]
+            offset = seek(caplen, 1)
+            records += 1
+    if not offsets:
+        return [(0, None, None)]
+    steps = len(offsets)
+    bounds = sorted({steps * index // shards for index in range(shards)})
+    parts = []
+    for index, (start, end) in enumerate(zip(bounds, bounds[1:] + [None])):
+        count = (end * _SPLIT_STEP if end is not None else records) - start * _SPLIT_STEP
+        parts.append((index, offsets[start], count))
+    return parts
+
+
+# Split the captures of at least min_size MB into shards processed by the
+# workers of the executor. The captures whose ingestion already started keep
+# the shards they were started with (layouts, an empty list if not split).
+# With shards set to 0, when the captures can not be split, the captures
+# started with shards are skipped.
+# Returns the files and shards (None for the captures processed at once) to
+# map the workers on, and the shards of each split capture.
+def shard_captures(executor, files, shards, min_size, layouts={}):
+    if not shards:
+        for inputfile, parts in layouts.items():
+            if parts:
+                potiron.errormsg(f"The import of {inputfile} was started in shards with the native engine, it can only be resumed with the native engine.")
+        files = [inputfile for inputfile in files if not layouts.get(inputfile)]
+    to_split = [inputfile for inputfile in files if inputfile not in layouts and shards > 1 and os.path.getsize(inputfile) >= min_size * 1024 * 1024]
+    splits = dict(zip(to_split, executor.map(split_capture, to_split, repeat(shards))))
+    splits.update((inputfile, parts) for inputfile, parts in layouts.items() if inputfile in files)
+    tasks, task_shards = [], []
+    for inputfile in files:
+        parts = splits.get(inputfile, ())
+        if len(parts) < 2:
+            splits.pop(inputfile, None)
+            parts = (None,)
+        for part in parts:
+            tasks.append(inputfile)
+            task_shards.append(part)
+    return tasks, task_shards, splits
+
+
+def _read_header(f, inputfile):
+    header = f.read(24)
+    magic = header[:4]
+    if magic not in _pcap_magic:
+        if magic == _pcapng_magic:
+            raise UnsupportedCapture(f"{inputfile} is a pcapng file, only classic pcap files are supported by the native engine.")
+        raise UnsupportedCapture(f"{inputfile} is not a pcap file.")
+    endianness, factor = _pcap_magic[magic]
+    # The upper bits of the link type field may contain FCS information
+    linktype = struct.unpack(f'{endianness}I', header[20:24])[0] & 0x0FFFFFFF
+    return endianness, factor, linktype
+
+
+# Open a capture for reading its decompressed content. gzip captures are
+# decompressed in-process, unless `decompress` is set; the captures
+# compressed with zstd or lz4 are always decompressed by a separate process.
+def open_capture(inputfile, decompress=False):
+    compression = capture_compression(inputfile)
+    if compression is None:
+        return open(inputfile, 'rb')
+    if compression == 'gzip' and not decompress:
+        return gzip.open(inputfile, 'rb')
+    return DecompressedCapture(decompress_command(inputfile, compression))
+
+
+def capture_compression(inputfile):
+    with open(inputfile, 'rb') as f:
+        magic = f.read(4)
+    for prefix, compression in _compressions.items():
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def decompress_command(inputfile, compression):
+    for program in _decompressors[compression]:
+        if potiron.check_program(program):
+            return [program, '-dc', inputfile]
+    raise UnsupportedCapture(f"{inputfile} is compressed with {compression}, but {' or '.join(_decompressors[compression])} is not installed.")
+
+
+# Return the tshark command reading a capture. With `decompress`, or when
+# tshark may not support its compression, a compressed capture is decompressed
+# by a separate process whose output is piped into tshark, so the decompression
+# and the dissection of the packets run at the same time on different cores.
+def tshark_command(cmd, inputfile, decompress=False):
+    compression = capture_compression(inputfile)
+    if compression is None or (compression == 'gzip' and not decompress):
+        return cmd.format(inputfile)
+    command = ' '.join(shlex.quote(argument) for argument in decompress_command(inputfile, compression))
+    return f"{command} | {cmd.format('-')}"
+
+
+# Decompressed content of a capture, read from the output of a decompression
+# program running in a separate process, which decompresses the next blocks
+# while the packets already read are decoded. Only forward seeks are possible.
+class DecompressedCapture():
+    def __init__(self, command):
+        self.command = command
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=_PIPE_BUFFER)
+        self._stream = self._process.stdout
+        self._position = 0
+        self._exhausted = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._position += len(data)
+        if size < 0 or len(data) < size:
+            self._exhausted = True
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            offset -= self._position
+        elif whence != 1:
+            raise OSError("Only forward seeks are possible in the output of a decompression program.")
+        if offset < 0:
+            raise OSError("Only forward seeks are possible in the output of a decompression program.")
+        while offset and not self._exhausted:
+            offset -= len(self.read(min(offset, _PIPE_BUFFER)))
+        return self._position
+
+    def close(self):
+        self._stream.close()
+        returncode = self._process.wait()
+        # A program stopped before the end of its output exits because of the
+        # closed pipe, only its failures while the whole output is read matter
+        if self._exhausted and returncode:
+            potiron.errormsg(f"{self.command[0]} exited with status {returncode} while decompressing {self.command[-1]}")
+
+
+# Decode the headers of a packet into a dictionary of tshark field names and
+# values, keeping only the first occurrence of each field as tshark does with
+# `-E occurrence=f`, and all the occurrences of the fields tested by the
+# default filters in 'field:all'. Returns None for link types that are not
+# supported.
+def dissect(linktype, data):
+    values = {}
+    if linktype == _LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return values
+        values['eth.dst'] = _mac(data[0:6])
+        values['eth.src'] = _mac(data[6:12])
+        ethertype = _ethertype.unpack_from(data, 12)[0]
+        values['eth.type'] = ethertype
+        offset = 14
+        while ethertype in _ETHERTYPE_VLAN and len(data) >= offset + 4:
+            ethertype = _ethertype.unpack_from(data, offset + 2)[0]
+            offset += 4
+    elif linktype in _LINKTYPE_RAW:
+        ethertype, offset = _ETHERTYPE_IP if data[:1] and data[0] >> 4 == 4 else None, 0
+    elif linktype == _LINKTYPE_LINUX_SLL:
+        if len(data) < 16:
+            return values
+        ethertype, offset = _ethertype.unpack_from(data, 14)[0], 16
+    elif linktype == _LINKTYPE_LINUX_SLL2:
+        if len(data) < 20:
+            return values
+        ethertype, offset = _ethertype.unpack_from(data, 0)[0], 20
+    elif linktype in (_LINKTYPE_NULL, _LINKTYPE_LOOP):
+        if len(data) < 4:
+            return values
+        family = data[:4]
+        ethertype, offset = _ETHERTYPE_IP if family in (b'\x02\x00\x00\x00', b'\x00\x00\x00\x02') else None, 4
+    else:
+        return None
+    if ethertype == _ETHERTYPE_IP:
+        _dissect_ipv4(values, data, offset)
+    elif ethertype == _ETHERTYPE_ARP:
+        _dissect_arp(values, data, offset)
+    return values
+
+
+def _dissect_ipv4(values, data, offset):
+    if len(data) < offset + 20:
+        return
+    version_ihl, tos, length, _, fragment, ttl, protocol, _, src, dst = _ipv4.unpack_from(data, offset)
+    if version_ihl >> 4 != 4:
+        return
+    for field, value in zip(('ip.len', 'ip.dsfield', 'ip.ttl', 'ip.proto', 'ip.src', 'ip.dst'),
+                            (str(length), f'0x{tos:02x}', str(ttl), str(protocol), inet_ntoa(src), inet_ntoa(dst))):
+        values.setdefault(field, value)
+    # All the occurrences of the fields tested by the default filters
+    values.setdefault('ip.proto:all', []).append(str(protocol))
+    values.setdefault('ip.dst:all', []).append(inet_ntoa(dst))
+    # Only the first fragment of a datagram carries the transport header
+    if fragment & 0x1FFF:
+        return
+    offset += (version_ihl & 0x0F) * 4
+    if protocol == 6:
+        _dissect_tcp(values, data, offset)
+    elif protocol == 17:
+        _dissect_udp(values, data, offset)
+    elif protocol == 1:
+        _dissect_icmp(values, data, offset)
+    elif protocol == 4:
+        _dissect_ipv4(values, data, offset)
+
+
+def _dissect_tcp(values, data, offset):
+    if len(data) < offset + 4:
+        return
+    sport, dport = _ports.unpack_from(data, offset)
+    values.setdefault('tcp.srcport', str(sport))
+    values.setdefault('tcp.dstport', str(dport))
+    if len(data) < offset + 8:
+        return
+    values.setdefault('tcp.seq', str(struct.unpack_from('!I', data, offset + 4)[0]))
+    if len(data) < offset + 14:
+        return
+    _, _, _, ack, _, flags = _tcp.unpack_from(data, offset)
+    # tshark only shows the acknowledgment number when the ACK flag is set
+    if flags & 0x10:
+        values.setdefault('tcp.ack', str(ack))
+
+
+def _dissect_udp(values, data, offset):
+    if len(data) < offset + 4:
+        return
+    sport, dport = _ports.unpack_from(data, offset)
+    values.setdefault('udp.srcport', str(sport))
+    values.setdefault('udp.dstport', str(dport))
+
+
+def _dissect_icmp(values, data, offset):
+    if len(data) < offset + 2:
+        return
+    icmp_type, icmp_code = data[offset], data[offset + 1]
+    values.setdefault('icmp.type', str(icmp_type))
+    values.setdefault('icmp.code', str(icmp_code))
+    # As tshark, decode the header of the packet embedded in ICMP errors
+    if icmp_type in _icmp_errors:
+        _dissect_ipv4(values, data, offset + 8)
+
+
+def _dissect_arp(values, data, offset):
+    if len(data) < offset + 8:
+        return
+    hardware_type, protocol_type, hardware_size, protocol_size, opcode = _arp.unpack_from(data, offset)
+    values['arp.opcode'] = str(opcode)
+    offset += 8
+    addresses = []
+    for size in (hardware_size, protocol_size, hardware_size, protocol_size):
+        addresses.append(data[offset:offset + size])
+        offset += size
+    if len(data) < offset:
+        return
+    src_hw, src_proto, dst_hw, dst_proto = addresses
+    if hardware_type == 1 and hardware_size == 6:
+        values['arp.src.hw_mac'] = _mac(src_hw)
+        values['arp.dst.hw_mac'] = _mac(dst_hw)
+    if protocol_type == _ETHERTYPE_IP and protocol_size == 4:
+        values['arp.src.proto_ipv4'] = inet_ntoa(src_proto)
+        values['arp.dst.proto_ipv4'] = inet_ntoa(dst_proto)
+
+
+def _mac(address):
+    return address.hex(':')
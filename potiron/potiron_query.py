@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Batched reads of the sorted sets of the standard format: the scores of all
+# the cells of a query are read with a single pipeline, with one ZMSCORE per
+# sorted set for all the values (or one ZSCORE per value before redis 6.2).
+# The reads can also be queued on a pipeline shared with other reads (see
+# queue_matrices). Without a protocol given, the sorted sets of all the
+# protocols of the sensor are summed when the combined keys are used.
+# The months and years are read from their roll-up keys when they are up to
+# date (see potiron_rollup).
+
+from collections import defaultdict
+from itertools import islice
+import numpy as np
+import os
+import redis
+import uuid
+
+if __package__:
+    from potiron.potiron import covering_keys, day_keys, decode, fresh_rollups, period_days, sensor_protocols
+    from potiron.potiron_time import day_buckets
+else:
+    # The scripts of the potiron directory import its modules directly
+    from potiron import covering_keys, day_keys, decode, fresh_rollups, period_days, sensor_protocols
+    from potiron_time import day_buckets
+
+# Prefix of the temporary keys of the unions of sorted sets read by topn, each
+# with a unique name and an expiry in seconds, in case the deletion is missed
+_TOPN_PREFIX = 'QUERY:topn'
+_TOPN_EXPIRY = 60
+# Set to False once the server rejected ZMSCORE
+_ZMSCORE = True
+
+
+# Scores of values of a field for each day between start and end (YYYYMMDD,
+# both included) having a sorted set. Returns the days, and the scores as an
+# array with one row per value and one column per day.
+def series(red, sensorname, field, values, start, end, protocol=None):
+    keys = defaultdict(list)
+    date = os.path.commonprefix([start, end])
+    for prefix in _prefixes(red, sensorname, protocol):
+        for key in day_keys(red, prefix, field, date):
+            day = key.rsplit(':', 2)[1]
+            if start <= day <= end:
+                keys[day].append(key)
+    days = sorted(keys)
+    return days, _sum_scores(red, [[keys[day] for day in days]], [values])[0]
+
+
+# Scores of values of a field for each sub-day bucket of the given width (ex:
+# '1h', see potiron_time.day_buckets) of the days between start and end
+# (YYYYMMDD, both included) having a sorted set. Returns the starts of the
+# buckets (YYYYMMDDHHMM), and the scores as an array with one row per value
+# and one column per bucket, 0 for the buckets expired or not counted.
+def bucket_series(red, sensorname, field, values, width, start, end, protocol=None):
+    prefixes = _prefixes(red, sensorname, protocol)
+    date = os.path.commonprefix([start, end])
+    days = sorted({day for prefix in prefixes for day in (key.rsplit(':', 2)[1] for key in day_keys(red, prefix, field, date)) if start <= day <= end})
+    buckets = [bucket for day in days for bucket in day_buckets(day, width)]
+    columns = [[f"{prefix}:{bucket}:{field}" for prefix in prefixes] for bucket in buckets]
+    return [bucket.split(':')[1] for bucket in buckets], _sum_scores(red, [columns], [values])[0]
+
+
+# Scores of values of a field for each period given (YYYYMMDD, YYYYMM or
+# YYYY), as an array with one row per value and one column per period
+def matrix(red, sensorname, field, values, periods, protocol=None):
+    return matrices(red, sensorname, [(field, values, periods)], protocol)[0]
+
+
+# Scores of several queries (field, values, periods) read with a single
+# pipeline, as one array per query (see matrix)
+def matrices(red, sensorname, queries, protocol=None):
+    prefixes = _prefixes(red, sensorname, protocol)
+    fresh = fresh_rollups(red) if any(len(period) < 8 for _, _, periods in queries for period in periods) else set()
+    p = red.pipeline(transaction=False)
+    pending = queue_matrices(p, prefixes, queries, fresh)
+    return read_matrices(red, pending, p.execute(raise_on_error=False))
+
+
+# Queue on the pipeline p the reads of the scores of several queries in the
+# sorted sets of the prefixes given (sensorname or sensorname:protocol), to
+# batch them with the other reads of a page. Returns the pending reads,
+# whose scores are summed by read_matrices from the results of p.
+def queue_matrices(p, prefixes, queries, fresh=()):
+    columns = [[[key for prefix in prefixes for key in covering_keys(prefix, field, *period_days(period), fresh)] for period in periods] for field, _, periods in queries]
+    return _queue_scores(p, columns, [values for _, values, _ in queries])
+
+
+# Scores of the queries of pending reads (see queue_matrices), from the
+# results of the pipeline executed with raise_on_error=False
+def read_matrices(red, pending, results):
+    return _read_sums(red, pending, results)
+
+
+# The n values of a field with the highest scores during a period (YYYYMMDD,
+# YYYYMM or YYYY) or between two days given as (start, end), the values in
+# skip left out. Returns the values, and their scores as an array, both
+# empty when the period has no keys.
+def topn(red, sensorname, field, period, n, skip=(), protocol=None):
+    start, end = period_days(period) if isinstance(period, str) else period
+    fresh = fresh_rollups(red) if start != end else set()
+    keys = [key for prefix in _prefixes(red, sensorname, protocol) for key in covering_keys(prefix, field, start, end, fresh)]
+    last = n + len(skip) - 1
+    if not keys:
+        top = []
+    elif len(keys) == 1:
+        top = red.zrevrange(keys[0], 0, last, withscores=True)
+    else:
+        union = f"{_TOPN_PREFIX}:{uuid.uuid4().hex}"
+        p = red.pipeline()
+        p.zunionstore(union, keys)
+        p.expire(union, _TOPN_EXPIRY)
+        p.zrevrange(union, 0, last, withscores=True)
+        p.delete(union)
+        top = p.execute()[2]
+    top = [(value, score) for value, score in ((decode(value), score) for value, score in top) if value not in skip][:n]
+    return np.array([value for value, _ in top], dtype=object), np.array([score for _, score in top], dtype=float)
+
+
+# Sorted sets of a field of a sensor: the sorted sets of a protocol, of all
+# the protocols with combined keys, or of the sensor
+def _prefixes(red, sensorname, protocol=None):
+    if protocol is not None:
+        return [f"{sensorname}:{protocol}"]
+    if decode(red.hget('PARAMETERS', 'ck')) == 'True':
+        return [f"{sensorname}:{protocol}" for protocol in sensor_protocols(red, sensorname)]
+    return [sensorname]
+
+
+# Sum the scores of the values in the sorted sets of each column, for each
+# query given as its columns and its values, read with a single pipeline
+def _sum_scores(red, queries_columns, queries_values):
+    p = red.pipeline(transaction=False)
+    pending = _queue_scores(p, queries_columns, queries_values)
+    return _read_sums(red, pending, p.execute(raise_on_error=False))
+
+
+# Queue the reads of the scores with one ZMSCORE per sorted set, or one
+# ZSCORE per value once the server rejected ZMSCORE. The pending reads keep
+# the position of their results in the pipeline.
+def _queue_scores(p, queries_columns, queries_values):
+    queries_values = [list(values) for values in queries_values]
+    reads = [(key, values) for columns, values in zip(queries_columns, queries_values) if values for keys in columns for key in keys]
+    start = len(p)
+    _queue_reads(p, reads, _ZMSCORE)
+    return start, len(p), _ZMSCORE, reads, queries_columns, queries_values
+
+
+def _queue_reads(p, reads, zmscore):
+    for key, values in reads:
+        if zmscore:
+            p.zmscore(key, values)
+        else:
+            for value in values:
+                p.zscore(key, value)
+
+
+def _read_sums(red, pending, results):
+    start, end, zmscore, reads, queries_columns, queries_values = pending
+    results = results[start:end]
+    if zmscore and any(isinstance(result, redis.ResponseError) for result in results):
+        globals()["_ZMSCORE"] = False
+        p = red.pipeline(transaction=False)
+        _queue_reads(p, reads, False)
+        results, zmscore = p.execute(), False
+    if not zmscore:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        scores = iter(results)
+        results = [list(islice(scores, len(values))) for _, values in reads]
+    results = iter(results)
+    to_return = []
+    for columns, values in zip(queries_columns, queries_values):
+        scores = np.zeros((len(values), len(columns)))
+        if values:
+            for column, keys in enumerate(columns):
+                for key_scores in islice(results, len(keys)):
+                    scores[:, column] += np.nan_to_num(np.array(key_scores, dtype=float))
+        to_return.append(scores)
+    return to_return
@@ -19,57 +19,84 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import defaultdict
+from collections import Counter, defaultdict
 from concurrent.futures import ProcessPoolExecutor
-from lib.helpers import get_homedir
+from functools import lru_cache
+from lib.helpers import get_homedir, get_redis_connection
+from potiron.potiron_time import bucket_expiry, bucket_names, get_timezone, parse_buckets
 from potiron.potiron_tshark import day_from_filename
-import json
+import os
 import potiron.potiron as potiron
 import sys
+import time
 
 _ck_mapping = {"False": "_get_redis_key", "True": "_get_redis_key_with_ck"}
 _storage_mapping = {format: f"_store_{format}_data" for format in ('standard', 'isn', 'layer2')}
 _isn_fields = ('tcpseq', 'tcpack')
 
 
-def process_storage(red, files, ck, logconsole):
+def process_storage(redis_parameters, files, ck, logconsole, workers=None):
+    red = get_redis_connection(**redis_parameters)
     potiron.logconsole = logconsole
     for key, value in red.hgetall('PARAMETERS').items():
         globals()[f"_{key.upper()}"] = value
-    globals()['_RED'] = red
     if _FORMAT == 'standard':
         _check_ck(red, ck)
         globals()['_JSON_FIELDS'] = red.lrange("JSON_FIELDS", 0, -1)
         if ck == 'True':
             globals()['_PROTOCOLS'] = potiron.define_protocols(get_homedir() / "doc/protocols")
         globals()['_KEY_FUNCTION'] = globals()[_ck_mapping[str(ck)]]
-    with ProcessPoolExecutor() as executor:
+        globals()['_BUCKETS'] = parse_buckets(red.hget('PARAMETERS', 'buckets') or '')
+        globals()['_TZ'] = get_timezone(globals().get('_TIMEZONE'))
+        globals()['_HLL'] = set((red.hget('PARAMETERS', 'hll') or '').split())
+        globals()['_TOPK'] = potiron.parse_topk(red.hget('PARAMETERS', 'topk') or '')
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(redis_parameters,)) as executor:
         for to_return in executor.map(_store_file, files):
             potiron.infomsg(to_return)
 
 
+# Open the redis connection of each worker, after the fork
+def _init_worker(redis_parameters):
+    globals()["_RED"] = get_redis_connection(**redis_parameters)
+
+
+# The packets of the json document are read as they are stored, the
+# newline-delimited documents are thus never entirely loaded in memory. The
+# standard data of the columnar documents is counted column by column, and
+# the counters sidecar of a standard document is replayed instead of the
+# document when it exists.
 def _store_file(inputfile):
-    with open(inputfile, 'rt', encoding='utf-8') as f:
-        allpackets = json.loads(f.read())
-    status = _check_parameters(allpackets.pop(0))
+    if _FORMAT == 'standard' and not inputfile.endswith(potiron.COUNTERS_SUFFIX):
+        _set_now(time.time())
+        sidecar = potiron.get_counters_sidecar(inputfile)
+        if os.path.exists(sidecar):
+            inputfile = sidecar
+    if inputfile.endswith(potiron.COUNTERS_SUFFIX):
+        return _replay_counters(inputfile)
+    columnar = _FORMAT == 'standard' and potiron.get_json_format(inputfile) == 'npz'
+    data = potiron.read_json_columns(inputfile) if columnar else potiron.read_json_document(inputfile)
+    first_packet = next(data)
+    status = _check_parameters(first_packet)
     if isinstance(status, str):
         return status
     sensorname, filename = status
     if _RED.sismember("FILES", filename):
         return f'Filename {filename} was already imported ... skip ...\n'
-    return globals()[_storage_mapping[_FORMAT]](allpackets, sensorname, filename)
+    if columnar:
+        return _store_standard_columns(data, sensorname, filename)
+    return globals()[_storage_mapping[_FORMAT]](data, sensorname, filename)
 
 
 def _store_isn_data(allpackets, sensorname, filename):
     to_set = {}
     lastday = day_from_filename(filename)
-    _RED.sadd(f"{sensorname}_DAYS", lastday)
+    potiron.add_days(_RED, sensorname, lastday)
     for packet in allpackets:
         day, time = packet.pop('timestamp').split(' ')
         timestamp = f"{day}_{time}"
         day = day.replace('-', '')
         if day != lastday:
-            _RED.sadd(f"{sensorname}_DAYS", day)
+            potiron.add_days(_RED, sensorname, day)
             lastday = day
         ports = "_".join([f"{port}{packet.pop(value)}" for port, value in zip(('src', 'dst'), ('sport', 'dport'))])
         key = f"{sensorname}_{ports}_{timestamp}"
@@ -77,6 +104,7 @@ def _store_isn_data(allpackets, sensorname, filename):
     p = _RED.pipeline()
     for key, item in to_set.items():
         p.hmset(key, item)
+    potiron.index_hashes(p, sensorname, to_set)
     p.execute()
     _RED.sadd("FILES", filename)
     return f"ISN data from {filename} parsed from JSON file."
@@ -86,14 +114,14 @@ def _store_layer2_data(allpackets, sensorname, filename):
     to_set = {}
     to_incr = defaultdict(lambda: defaultdict(int))
     lastday = day_from_filename(filename)
-    _RED.sadd(f"{sensorname}_DAYS", lastday)
+    potiron.add_days(_RED, sensorname, lastday)
     count_key = f"{sensorname}_{lastday}_count"
     for packet in allpackets:
         day, time = packet.pop('timestamp').split(' ')
         timestamp = f"{day}_{time}"
         day = day.replace('-', '')
         if day != lastday:
-            _RED.sadd(f"{sensorname}_DAYS", day)
+            potiron.add_days(_RED, sensorname, day)
             count_key = f"{sensorname}_{day}_count"
             lastday = day
         if packet['opcode'] == '1':
@@ -112,9 +140,8 @@ def _store_layer2_data(allpackets, sensorname, filename):
     p = _RED.pipeline()
     for key, values in to_set.items():
         p.hmset(key, values)
-    for key, values in to_incr.items():
-        for value, amount in values.items():
-            p.zincrby(key, amount, value)
+    potiron.index_hashes(p, sensorname, to_set)
+    potiron.bulk_increment(p, to_incr)
     p.execute()
     _RED.sadd("FILES", filename)
     return f"Layer2 data from {filename} parsed from JSON file."
@@ -123,23 +150,122 @@ def _store_layer2_data(allpackets, sensorname, filename):
 def _store_standard_data(allpackets, sensorname, filename):
     to_incr = defaultdict(lambda: defaultdict(int))
     lastday = day_from_filename(filename)
-    _RED.sadd(f"{sensorname}_DAYS", lastday)
+    potiron.add_days(_RED, sensorname, lastday)
+    protocols = set()
+    buckets = {}
     for packet in allpackets:
-        redis_key, day = _KEY_FUNCTION(packet, sensorname)
+        redis_keys, period = _KEY_FUNCTION(packet, sensorname)
+        day = period[0]
         if day != lastday:
-            _RED.sadd(f"{sensorname}_DAYS", day)
+            potiron.add_days(_RED, sensorname, day)
             lastday = day
-        for field in _JSON_FIELDS:
-            to_incr[f"{redis_key}:{field}"][packet[field]] += 1
+        if _CK == 'True':
+            protocols.add(packet['protocol'])
+        if len(period) > 1:
+            buckets.update(zip(redis_keys[1:], period[1:]))
+        for redis_key in redis_keys:
+            for field in _JSON_FIELDS:
+                to_incr[f"{redis_key}:{field}"][packet[field]] += 1
     p = _RED.pipeline()
-    for key, values in to_incr.items():
-        for value, amount in values.items():
-            p.zincrby(key, amount, value)
+    if protocols:
+        p.sadd("PROTOCOLS", *(_PROTOCOLS[str(protocol)] for protocol in protocols))
+    potiron.bulk_increment(p, to_incr, topk=_TOPK)
+    _count_distinct(p, to_incr)
+    potiron.mark_rollups(p, potiron.touched_rollups(to_incr))
+    potiron.index_days(p, to_incr)
+    _expire_buckets(p, buckets)
     p.execute()
     _RED.sadd("FILES", filename)
     return f"Data from {filename} parsed from JSON file."
 
 
+# Same as _store_standard_data, with the values of each field of the packets
+# in a list, counted at once for all the packets of each chunk of the
+# document (see potiron.read_json_columns)
+def _store_standard_columns(chunks, sensorname, filename):
+    potiron.add_days(_RED, sensorname, day_from_filename(filename))
+    for columns in chunks:
+        _store_columns(columns, sensorname)
+    _RED.sadd("FILES", filename)
+    return f"Data from {filename} parsed from JSON file."
+
+
+# The values of a packet are counted once for its day and once for each of
+# its sub-day buckets, if any
+def _store_columns(columns, sensorname):
+    periods = [_get_period(timestamp[:16]) for timestamp in columns['timestamp']]
+    potiron.add_days(_RED, sensorname, *set(period[0] for period in periods))
+    p = _RED.pipeline()
+    if _CK == 'True':
+        protocols = {protocol: _PROTOCOLS[str(protocol)] for protocol in set(columns['protocol'])}
+        p.sadd("PROTOCOLS", *protocols.values())
+        prefixes = [f"{sensorname}:{protocols[protocol]}" for protocol in columns['protocol']]
+    else:
+        prefixes = [sensorname] * len(periods)
+    period_keys = {}
+    redis_keys = [period_keys.setdefault((prefix, part), f"{prefix}:{part}") for prefix, period in zip(prefixes, periods) for part in period]
+    to_incr = defaultdict(dict)
+    for field in _JSON_FIELDS:
+        column = [value for value, period in zip(columns[field], periods) for _ in period] if _BUCKETS else columns[field]
+        for (redis_key, value), amount in Counter(zip(redis_keys, column)).items():
+            to_incr[f"{redis_key}:{field}"][value] = amount
+    potiron.bulk_increment(p, to_incr, topk=_TOPK)
+    _count_distinct(p, to_incr)
+    potiron.mark_rollups(p, potiron.touched_rollups(to_incr))
+    potiron.index_days(p, to_incr)
+    _expire_buckets(p, {redis_key: part for (_, part), redis_key in period_keys.items() if ':' in part})
+    p.execute()
+
+
+# The counters of the sidecar are already aggregated, they are pushed as they
+# are read, by blocks of potiron.FLUSH_KEYS keys
+def _replay_counters(inputfile):
+    entries = potiron.read_counters_sidecar(inputfile)
+    header = next(entries)
+    if header['ck'] != (_CK == 'True'):
+        return f"CK parameter error: the counters of {inputfile} were computed with ck set to {header['ck']}, but it is set to {_CK} in this redis instance."
+    status = _check_parameters(header)
+    if isinstance(status, str):
+        return status
+    sensorname, filename = status
+    if _RED.sismember("FILES", filename):
+        return f'Filename {filename} was already imported ... skip ...\n'
+    to_incr = {}
+    to_expire = {}
+    for entry in entries:
+        if 'add' in entry:
+            potiron.add_to_set(_RED, entry['key'], *entry['add'])
+            continue
+        if 'expireat' in entry:
+            to_expire[entry['key']] = entry['expireat']
+            continue
+        try:
+            counter = to_incr[entry['key']]
+        except KeyError:
+            counter = to_incr[entry['key']] = defaultdict(int)
+        for value, amount in entry['incr'].items():
+            counter[value] += amount
+        if len(to_incr) >= potiron.FLUSH_KEYS:
+            _push_increments(to_incr)
+    _push_increments(to_incr)
+    p = _RED.pipeline()
+    for key, timestamp in to_expire.items():
+        p.expireat(key, timestamp)
+    p.execute()
+    _RED.sadd("FILES", filename)
+    return f"Data from {filename} replayed from its counters sidecar."
+
+
+def _push_increments(to_incr):
+    p = _RED.pipeline()
+    potiron.bulk_increment(p, to_incr, topk=_TOPK)
+    _count_distinct(p, to_incr)
+    potiron.mark_rollups(p, potiron.touched_rollups(to_incr))
+    potiron.index_days(p, to_incr)
+    p.execute()
+    to_incr.clear()
+
+
 def _check_ck(red, ck):
     redis_ck = red.hget("PARAMETERS", 'ck')
     if redis_ck != str(ck):
@@ -159,11 +285,42 @@ def _check_parameters(packet):
     return [packet[feature] for feature in ('sensorname', 'filename')]
 
 
+# Return the keys of the day and sub-day buckets of a packet, with its period
 def _get_redis_key(packet, sensorname):
-    day = packet.pop('timestamp').split(' ')[0].replace('-', '')
-    return f"{sensorname}:{day}", day
+    period = _get_period(packet.pop('timestamp')[:16])
+    return [f"{sensorname}:{part}" for part in period], period
+
+
+def _get_redis_key_with_ck(packet, sensorname):
+    period = _get_period(packet.pop('timestamp')[:16])
+    protocol = _PROTOCOLS[str(packet['protocol'])]
+    return [f"{sensorname}:{protocol}:{part}" for part in period], period
+
+
+# Day and sub-day buckets (those not expired at the start of the import of
+# the document, see _set_now) of a minute of the json timestamps
+# (YYYY-MM-DD HH:MM), as defined by the TimestampConverter
+@lru_cache(maxsize=4096)
+def _get_period(minute):
+    return (minute[:10].replace('-', ''), *bucket_names(minute, _BUCKETS, _TZ, _NOW))
+
+
+def _set_now(now):
+    globals()['_NOW'] = now
+    _get_period.cache_clear()
+
+
+# Add the values counted for the days to the HyperLogLog keys of the fields
+# whose distinct values are counted
+def _count_distinct(p, to_incr):
+    if _HLL:
+        potiron.bulk_distinct(p, potiron.distinct_values(to_incr, _HLL))
 
 
-def _get_redis_key_with_ck(pacekt, sensorname):
-    day = packet.pop('timestamp').split(' ')[0].replace('-', '')
-    return f"{sensorname}:{_PROTOCOLS[packet['protocol']]}:{day}", day
+# Set the expiry of the keys of each field of the buckets
+def _expire_buckets(p, buckets):
+    for redis_key, bucket in buckets.items():
+        expiry = bucket_expiry(bucket, _BUCKETS, _TZ)
+        if expiry is not None:
+            for field in _JSON_FIELDS:
+                p.expireat(f"{redis_key}:{field}", expiry)
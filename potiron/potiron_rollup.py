@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compaction of the month and year roll-up keys (see potiron.rollup_key):
+# the ingestion marks the months and years whose days changed as pending,
+# and each pending month is computed again with a ZUNIONSTORE of its days,
+# then each pending year with a ZUNIONSTORE of its months. Only the months
+# and years touched since the last compaction are thus computed. The months
+# without a computed roll-up are read from their days. The HyperLogLog keys
+# of the fields whose distinct values are counted (see potiron.distinct_keys)
+# are merged the same way with PFMERGE.
+
+from potiron.potiron import HLL_SUFFIX, mark_rollups, rollup_key, sensor_days, sensor_names, ROLLUPS_DONE, ROLLUPS_PENDING
+
+# Remove the pending roll-ups whose version did not change since they were
+# read, the others being computed again at the next compaction
+_REMOVE_COMPUTED = """
+local removed = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        removed = removed + redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+
+# Compute the pending roll-ups, and return the number of roll-ups computed
+def compact_rollups(red):
+    pending = red.hgetall(ROLLUPS_PENDING)
+    if not pending:
+        return 0
+    fields = red.lrange('JSON_FIELDS', 0, -1)
+    counted = (red.hget('PARAMETERS', 'hll') or '').split()
+    days = {}
+    rollups = [rollup.rsplit(':', 1) for rollup in pending]
+    p = red.pipeline(transaction=False)
+    for prefix, month in (rollup for rollup in rollups if len(rollup[1]) == 6):
+        month_days = [day for day in _sensor_days(red, prefix, days) if day.startswith(month)]
+        for field in fields:
+            sources = [f"{prefix}:{day}:{field}" for day in month_days]
+            _store_union(p, rollup_key(prefix, month, field), sources)
+            if field in counted:
+                _store_distinct(p, rollup_key(prefix, month, field), sources)
+    p.execute()
+    # The months whose roll-up is not computed, stored before the roll-ups
+    # were maintained, are read from their days
+    computed = red.smembers(ROLLUPS_DONE) | {f"{prefix}:{month}" for prefix, month in rollups if len(month) == 6}
+    for prefix, year in (rollup for rollup in rollups if len(rollup[1]) == 4):
+        year_days = [day for day in _sensor_days(red, prefix, days) if day.startswith(year)]
+        for field in fields:
+            sources = {rollup_key(prefix, day[:6], field) if f"{prefix}:{day[:6]}" in computed else f"{prefix}:{day}:{field}" for day in year_days}
+            _store_union(p, rollup_key(prefix, year, field), sorted(sources))
+            if field in counted:
+                _store_distinct(p, rollup_key(prefix, year, field), sorted(sources))
+    p.sadd(ROLLUPS_DONE, *pending)
+    p.eval(_REMOVE_COMPUTED, 1, ROLLUPS_PENDING, *(arg for item in pending.items() for arg in item))
+    p.execute()
+    return len(pending)
+
+
+# Mark as pending the months and years of all the days already stored, to
+# compute the roll-ups of the data stored before they were maintained
+def mark_all_rollups(red):
+    prefixes = {}
+    protocols = red.smembers('PROTOCOLS') if red.hget('PARAMETERS', 'ck') == 'True' else None
+    for sensorname in sensor_names(red):
+        prefixes[sensorname] = [f"{sensorname}:{protocol}" for protocol in protocols] if protocols else [sensorname]
+    p = red.pipeline(transaction=False)
+    for sensorname, sensor_prefixes in prefixes.items():
+        periods = {period for day in sensor_days(red, sensorname) for period in (day[:6], day[:4])}
+        mark_rollups(p, (f"{prefix}:{period}" for prefix in sensor_prefixes for period in periods))
+    p.execute()
+
+
+def _sensor_days(red, prefix, days):
+    sensorname = prefix.split(':')[0]
+    if sensorname not in days:
+        days[sensorname] = sensor_days(red, sensorname)
+    return days[sensorname]
+
+
+def _store_union(p, key, sources):
+    if sources:
+        p.zunionstore(key, sources)
+    else:
+        p.delete(key)
+
+
+def _store_distinct(p, key, sources):
+    key = f"{key}:{HLL_SUFFIX}"
+    p.delete(key)
+    if sources:
+        p.pfmerge(key, *(f"{source}:{HLL_SUFFIX}" for source in sources))
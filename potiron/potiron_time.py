@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import os
+import time
+
+LOCAL_TIMEZONE = 'local'
+# Units of the width (in minutes) and of the retention (in seconds) of the
+# sub-day buckets
+_width_units = {'m': 1, 'h': 60}
+_retention_units = {'m': 60, 'h': 3600, 'd': 86400}
+
+
+# Convert the epoch timestamps given by tshark ('seconds.nanoseconds') into
+# the day used in the redis keys and the date used in the json documents.
+# As the packets of a capture are mostly sorted, both results are cached: the
+# day is only derived again when a timestamp leaves the boundaries of the
+# current day, and the json date when the second changes.
+# The timezone is explicit ('local' for the timezone of the host), so that
+# the same captures give the same days whatever the host ingesting them.
+# With sub-day buckets (see parse_buckets), the period of a timestamp is its
+# day followed by the buckets containing it, cached until the minute changes.
+# The buckets expired at the reference time given with set_now (the current
+# time otherwise) are left out.
+class TimestampConverter():
+    def __init__(self, timezone=LOCAL_TIMEZONE, buckets=None):
+        self.timezone = get_timezone(timezone)
+        self.buckets = buckets or {}
+        self._day = None
+        self._start = 0
+        self._end = 0
+        self._period = None
+        self._period_start = 0
+        self._period_end = 0
+        self._second = None
+        self._date = None
+        self._now = None
+
+    def set_now(self, now):
+        self._now = now
+        self._period_end = 0
+
+    def redis_day(self, timestamp):
+        seconds = int(timestamp.partition('.')[0])
+        if not self._start <= seconds < self._end:
+            self._day, self._start, self._end = self.day_range(seconds)
+        return self._day
+
+    def redis_period(self, timestamp):
+        return self.second_period(int(timestamp.partition('.')[0]))
+
+    def second_period(self, seconds):
+        if not self._period_start <= seconds < self._period_end:
+            self._period, self._period_start, self._period_end = self.period_range(seconds)
+        return self._period
+
+    def json_timestamp(self, timestamp):
+        int_part, dec_part = timestamp.split('.')
+        if int_part != self._second:
+            self._second = int_part
+            self._date = datetime.datetime.fromtimestamp(int(int_part), self.timezone).strftime("%Y-%m-%d %H:%M:%S")
+        return f'{self._date}.{dec_part[:-3]}'
+
+    # Return the day containing an epoch timestamp, with the epoch timestamps
+    # of its first second and of the first second of the next day
+    def day_range(self, seconds):
+        date = datetime.datetime.fromtimestamp(seconds, self.timezone).date()
+        return date.strftime("%Y%m%d"), self._midnight(date), self._midnight(date + datetime.timedelta(days=1))
+
+    # Return the period containing an epoch timestamp, with the boundaries of
+    # the time range sharing the same period. The buckets already expired are
+    # left out.
+    def period_range(self, seconds):
+        day, start, end = self.day_range(seconds)
+        if not self.buckets:
+            return (day,), start, end
+        date = datetime.datetime.fromtimestamp(seconds, self.timezone)
+        start = seconds - date.second
+        now = time.time() if self._now is None else self._now
+        period = (day, *bucket_names(date.strftime("%Y-%m-%d %H:%M"), self.buckets, self.timezone, now))
+        return period, start, min(start + 60, end)
+
+    def _midnight(self, date):
+        return int(datetime.datetime.combine(date, datetime.time(), tzinfo=self.timezone).timestamp())
+
+
+# Name of the timezone of the host in the tz database, from TZ, then
+# /etc/timezone, then the target of /etc/localtime (None if it can not be
+# found). 'local' is resolved to that name before being stored in PARAMETERS,
+# so that the ingestions from hosts in different timezones are not mixed in
+# the same redis instance. Without it, 'local' is kept and the naive local
+# time of the host is used.
+def local_timezone():
+    from zoneinfo import ZoneInfo
+    candidates = [os.environ.get('TZ', '').lstrip(':')]
+    try:
+        with open('/etc/timezone', 'rt') as f:
+            candidates.append(f.read().strip())
+    except OSError:
+        pass
+    if os.path.islink('/etc/localtime'):
+        candidates.append(os.path.realpath('/etc/localtime').partition('/zoneinfo/')[2])
+    for name in candidates:
+        if not name:
+            continue
+        try:
+            ZoneInfo(name)
+        except (KeyError, ValueError, OSError):
+            continue
+        return name
+    return None
+
+
+def timezone_name(timezone):
+    if timezone in (None, LOCAL_TIMEZONE):
+        return local_timezone() or LOCAL_TIMEZONE
+    return timezone
+
+
+def get_timezone(timezone):
+    if timezone in (None, LOCAL_TIMEZONE):
+        return None
+    if timezone.upper() == 'UTC':
+        return datetime.timezone.utc
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(timezone)
+
+
+# Parse the sub-day buckets given as 'width[:retention]' (ex: '5m:2d', '1h'),
+# with the width in minutes (m) or hours (h) dividing a day, and the retention
+# in minutes (m), hours (h) or days (d) after the end of a bucket (no expiry
+# by default). Returns the width in minutes and retention in seconds of each
+# bucket.
+def parse_buckets(buckets):
+    to_return = {}
+    for bucket in buckets.split():
+        name, _, retention = bucket.partition(':')
+        try:
+            width = int(name[:-1]) * _width_units[name[-1]]
+            retention = int(retention[:-1]) * _retention_units[retention[-1]] if retention else 0
+        except (IndexError, KeyError, ValueError):
+            raise ValueError(f"Invalid bucket {bucket}, it should be defined as 'width[:retention]' (ex: '5m:2d').")
+        if width <= 0 or 1440 % width or retention < 0:
+            raise ValueError(f"Invalid bucket {bucket}, its width should divide a day.")
+        to_return[name] = (width, retention)
+    return to_return
+
+
+# Names of the buckets containing a date ('YYYY-MM-DD HH:MM', possibly
+# followed by the seconds), as 'width:YYYYMMDDHHMM' with the start of the
+# bucket. With now, the buckets expired at that time are left out.
+def bucket_names(date, buckets, timezone=None, now=None):
+    day = date[:10].replace('-', '')
+    minutes = int(date[11:13]) * 60 + int(date[14:16])
+    names = []
+    for name, (width, retention) in buckets.items():
+        start = minutes - minutes % width
+        bucket = f"{name}:{day}{start // 60:02d}{start % 60:02d}"
+        if now is not None and retention and bucket_expiry(bucket, buckets, timezone) <= now:
+            continue
+        names.append(bucket)
+    return tuple(names)
+
+
+# Epoch timestamp at which the keys of a bucket expire (None without retention)
+def bucket_expiry(bucket, buckets, timezone=None):
+    name, start = bucket.split(':')
+    width, retention = buckets[name]
+    if not retention:
+        return None
+    start = datetime.datetime.strptime(start, "%Y%m%d%H%M").replace(tzinfo=timezone)
+    return int(start.timestamp()) + width * 60 + retention
+
+
+# Names of all the buckets of a day (YYYYMMDD) for a width (ex: '5m')
+def day_buckets(day, name):
+    width = parse_buckets(name)[name][0]
+    return [f"{name}:{day}{start // 60:02d}{start % 60:02d}" for start in range(0, 1440, width)]
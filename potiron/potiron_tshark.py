@@ -17,39 +17,55 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from concurrent.futures import ProcessPoolExecutor
-from lib.helpers import get_homedir
+from contextlib import nullcontext
+from lib.helpers import get_homedir, get_redis_connection
+from itertools import islice
 from potiron.potiron_parameters import extract_json_fields
-import datetime
-import json
+from potiron.potiron_time import bucket_expiry, LOCAL_TIMEZONE, parse_buckets, TimestampConverter
+import numpy as np
 import os
 import potiron.potiron as potiron
-import subprocess
+import potiron.potiron_pcap as potiron_pcap
 import sys
+import time
 
 
-_port_mapping = {'1': '_check_udport', '2': '_check_tdport',
-                '3': '_check_dst_ports', '4': '_check_usport',
-                '5': '_check_udp_ports', '6': '_check_us_td_ports',
-                '7': '_check_us_dst_ports', '8': '_check_tsport',
-                '9': '_check_ts_ud_ports', '10': '_check_tcp_ports',
-                '11': '_check_ts_dst_ports', '12': '_check_src_ports',
-                '13': '_check_src_ud_ports', '14': '_check_src_td_ports',
-                '15': '_check_all_ports'}
 _ck_mapping = {'True': '_combined_redis_key', 'False': '_simple_redis_key'}
-_ip_mapping = {'1': ('ipdst'), '2': ('ipsrc'), '3': ('ipsrc', 'ipdst')}
 _to_process = {'False': '_process_file', 'True': '_process_file_and_save_json'}
+_flush_parameters = {'chunk_size': potiron.CHUNK_SIZE, 'flush_packets': potiron.FLUSH_PACKETS, 'flush_keys': potiron.FLUSH_KEYS,
+                     'flush_seconds': potiron.FLUSH_SECONDS, 'batch_size': potiron.DEFAULTBULKBUFFER}
+
+# Expiry of the keys of the sub-day buckets counted since the last flush
+_EXPIRY = {}
 
 non_index = ['', 'filename', 'sensorname', 'timestamp', 'packet_id']
 special_fields = {'length': -1, 'ipttl': -1, 'iptos': 0, 'tcpseq': -1,
                   'tcpack': -1, 'icmpcode': 255, 'icmptype': 255}
+_port_fields = {'sport': ('tsport', 'usport'), 'dport': ('tdport', 'udport')}
+
 
+def standard_process(redis_parameters, files, logconsole, workers=None):
+    red, to_process = standard_setup(redis_parameters, logconsole)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(redis_parameters,)) as executor:
+        layouts = potiron.get_shard_layouts(red, files)
+        files, shards, sharded_files = potiron_pcap.shard_captures(executor, files, _SHARDS if _ENGINE == 'native' else 0, _SHARD_MIN_SIZE, layouts)
+        potiron.set_shard_layouts(red, sharded_files)
+        for to_return in executor.map(to_process, files, shards):
+            potiron.infomsg(to_return)
+    potiron.complete_shards(red, sharded_files, _ROOTDIR if _ENABLE_JSON == 'True' else None, _JSON_FORMAT, _COUNTERS)
 
-def standard_process(red, files, logconsole):
+
+# Load the parameters of the ingestion in the module, before the workers are
+# forked, and return the redis connection and the function processing a
+# capture file in the workers (initialized with _init_worker)
+def standard_setup(redis_parameters, logconsole):
+    red = get_redis_connection(**redis_parameters)
     potiron.logconsole = logconsole
     globals()["_FIELDS"] = red.lrange('FIELDS', 0, -1)
     globals()["_JSON_FIELDS"] = extract_json_fields(_FIELDS)
+    globals()["_TSHARK_FIELDS"] = [potiron.tshark_fields[potiron.json_fields.index(field)] for field in _FIELDS]
     for key, value in red.hgetall('PARAMETERS').items():
         globals()[f"_{key.upper()}"] = value
     if _ENABLE_JSON:
@@ -57,13 +73,33 @@ def standard_process(red, files, logconsole):
     if _CK:
         globals()["_PROTOCOLS"] = potiron.define_protocols(get_homedir() / "doc/protocols")
     globals()["_KEY_FUNCTION"] = globals()[_ck_mapping[_CK]]
-    globals()["_RED"] = red
-    with ProcessPoolExecutor() as executor:
-        for to_return in executor.map(globals()[_to_process[_ENABLE_JSON]], files):
-            potiron.infomsg(to_return)
-
-
-def _process_file(inputfile):
+    globals()["_DECODE"] = _build_decoder(text=_ENABLE_JSON == 'True')
+    globals()["_PROTOCOL_INDEX"] = _JSON_FIELDS.index('protocol')
+    globals()["_BUCKETS"] = parse_buckets(red.hget("PARAMETERS", "buckets") or "")
+    # The values of a packet are counted for its day, then for each bucket
+    globals()["_PERIODS"] = 1 + len(_BUCKETS)
+    # Fields whose distinct values of each day are counted in HyperLogLog keys
+    globals()["_HLL"] = set((red.hget("PARAMETERS", "hll") or "").split())
+    # Fields whose sorted sets only keep their values with the highest counts
+    globals()["_TOPK"] = potiron.parse_topk(red.hget("PARAMETERS", "topk") or "")
+    globals()["_TIMESTAMPS"] = TimestampConverter(globals().get('_TIMEZONE', LOCAL_TIMEZONE), _BUCKETS)
+    _set_flush_policy()
+    globals()["_TSHARK_TIMEOUT"] = int(globals().get("_TSHARK_TIMEOUT", potiron.TSHARK_TIMEOUT))
+    globals()["_DECOMPRESS"] = globals().get("_DECOMPRESS") == 'True'
+    globals()["_JSON_FORMAT"] = globals().get("_JSON_FORMAT", potiron.JSON_FORMAT)
+    globals()["_COUNTERS"] = globals().get("_COUNTERS") == 'True' and _ENABLE_JSON == 'True'
+    for key, default in (("_SHARDS", potiron.SHARDS), ("_SHARD_MIN_SIZE", potiron.SHARD_MIN_SIZE)):
+        globals()[key] = int(globals().get(key, default))
+    to_process = '_process_file_vectorized' if globals().get('_VECTORIZED') == 'True' and _ENABLE_JSON == 'False' else _to_process[_ENABLE_JSON]
+    return red, globals()[to_process]
+
+
+# Open the redis connection of each worker, after the fork
+def _init_worker(redis_parameters):
+    globals()["_RED"] = get_redis_connection(**redis_parameters)
+
+
+def _process_file(inputfile, shard=None, lines=None):
     to_add, to_incr, filename, sensorname = _get_data_structures(inputfile)
     if _RED.sismember("FILES", filename):
         return f'Filename {inputfile} was already imported ... skip ...\n'
@@ -72,33 +108,49 @@ def _process_file(inputfile):
 
     # List of fields that are included in the json documents that should not be ranked
     # FIXME Put this as argument to the program as this list depends on the documents that is introduced
-    proc = subprocess.Popen(_CMD.format(inputfile), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    to_add["FILES"].add(filename)
-
-    lastday = day_from_filename(filename)
-    _RED.sadd(f"{sensorname}_DAYS", lastday)
-    for line in proc.stdout.readlines():
-        packet = _create_packet(line)
-        packet['timestamp'] = _set_redis_timestamp(packet['timestamp'])
-        timestamp = packet['timestamp']
-        rKey = _KEY_FUNCTION(packet, sensorname, to_add)
-        if timestamp != lastday:
-            to_add[f"{sensorname}_DAYS"].add(timestamp)
-            lastday = timestamp
-        for field in _JSON_FIELDS:
-            to_incr[f"{rKey}:{field}"][packet[field]] += 1
-    p = _RED.pipeline()
-    for key, values in to_add.items():
-        p.sadd(key, *list(values))
-    for redis_key, values in to_incr.items():
-        for value, amount in values.items():
-            p.zincrby(redis_key, amount, value)
-    p.execute()
-    proc.wait()
+    journal, position, flush_end, batches = _start_journal(filename, shard)
+    if journal is None:
+        return f'Data from {filename} already parsed.'
+    potiron.add_days(_RED, sensorname, day_from_filename(filename))
+    lines = _read_capture(inputfile, shard, lines)
+    # The data of the lines before position is already in redis
+    deque(islice(lines, position), maxlen=0)
+    if flush_end is not None:
+        _count_lines(islice(lines, flush_end - position), to_add, to_incr, sensorname)
+        position = flush_end
+        _flush(to_add, to_incr, journal, position, batches)
+    position = _count_lines(lines, to_add, to_incr, sensorname, journal, position)
+    _flush(to_add, to_incr, journal, position, commit=True, filename=filename if shard is None else None)
     return f'Data from {filename} parsed.'
 
 
-def _process_file_and_save_json(inputfile):
+# Count the values of the packets, flushing the counters to redis according
+# to the flush policy when a journal is given. Returns the position in the
+# capture after the last line.
+def _count_lines(lines, to_add, to_incr, sensorname, journal=None, position=0):
+    counters = {}
+    pending = 0
+    last_flush = time.monotonic()
+    for line in lines:
+        timestamp, values = _DECODE(line)
+        key = (_TIMESTAMPS.redis_period(timestamp), values[_PROTOCOL_INDEX])
+        try:
+            period_counters = counters[key]
+        except KeyError:
+            period_counters = counters[key] = _get_counters(to_add, to_incr, sensorname, *key)
+        for counter, value in zip(period_counters, values * _PERIODS):
+            counter[value] += 1
+        pending += 1
+        if not pending % _FLUSH_CHECK and journal is not None and _flush_needed(to_incr, pending, last_flush):
+            position += pending
+            _flush(to_add, to_incr, journal, position)
+            counters.clear()
+            pending = 0
+            last_flush = time.monotonic()
+    return position + pending
+
+
+def _process_file_and_save_json(inputfile, shard=None, lines=None):
     to_add, to_incr, filename, sensorname = _get_data_structures(inputfile)
     if _RED.sismember("FILES", filename):
         return f'Filename {inputfile} was already imported ... skip ...\n'
@@ -107,51 +159,263 @@ def _process_file_and_save_json(inputfile):
 
     # List of fields that are included in the json documents that should not be ranked
     # FIXME Put this as argument to the program as this list depends on the documents that is introduced
-    proc = subprocess.Popen(_CMD.format(inputfile), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    to_add["FILES"].add(filename)
+    journal, position, flush_end, batches = _start_journal(filename, shard)
+    if journal is None:
+        return f'Data from {filename} already parsed and stored in json format.'
     first_packet = {"type": potiron.TYPE_SOURCE, "sensorname": sensorname, "filename": filename}
     first_packet.update(_FIRST_PACKET)
-    allpackets = [first_packet]
-    lastday = day_from_filename(filename)
-    _RED.sadd(f"{sensorname}_DAYS", lastday)
-    packet_id = 0
-    for line in proc.stdout.readlines():
-        packet = _create_packet(line)
-        timestamp = packet['timestamp']
-        packet['timestamp'] = _set_redis_timestamp(packet['timestamp'])
-        rKey = _KEY_FUNCTION(packet, sensorname, to_add)
-        if packet['timestamp'] != lastday:
-            day = packet['timestamp']
-            to_add[f"{sensorname}_DAYS"].add(day)
-            lastday = day
-        for field in _JSON_FIELDS:
-            to_incr[f"{rKey}:{field}"][packet[field]] += 1
-        packet['timestamp'] = _set_json_timestamp(timestamp)
-        packet['packet_id'] = packet_id
+    day = day_from_filename(filename)
+    potiron.add_days(_RED, sensorname, day)
+    lines = _read_capture(inputfile, shard, lines)
+    with potiron.JsonDocument(_ROOTDIR, filename, _JSON_FORMAT, shard) as document, _open_sidecar(first_packet, shard) as sidecar:
+        document.write(first_packet)
+        if sidecar is not None:
+            sidecar.write({f"{sensorname}_DAYS": {day}}, {})
+        # The json document and the sidecar are written again from the start,
+        # so all the packets are read again, but the values of the lines
+        # before position are already counted in redis
+        skipped_add, skipped_incr = _get_data_structures(inputfile)[:2]
+        _count_and_store_lines(islice(lines, position), skipped_add, skipped_incr, sensorname, document, count=False, sidecar=sidecar)
+        if flush_end is not None:
+            _count_and_store_lines(islice(lines, flush_end - position), to_add, to_incr, sensorname, document)
+            position = flush_end
+            _flush(to_add, to_incr, journal, position, batches, sidecar=sidecar)
+        position = _count_and_store_lines(lines, to_add, to_incr, sensorname, document, journal, position, sidecar=sidecar)
+        if sidecar is not None:
+            sidecar.write(to_add, to_incr, {key: _EXPIRY[key] for key in to_incr if key in _EXPIRY})
+    _flush(to_add, to_incr, journal, position, commit=True, filename=filename if shard is None else None)
+    return f'Data from {filename} parsed and stored in json format.'
+
+
+# Sidecar of the json document holding the counters of the capture, if
+# requested (a null context otherwise)
+def _open_sidecar(first_packet, shard):
+    if not _COUNTERS:
+        return nullcontext()
+    header = dict(first_packet, ck=_CK == 'True')
+    return potiron.CountersSidecar(_ROOTDIR, first_packet['filename'], header, shard)
+
+
+# Same as _count_lines, also writing the packets in the json document, and
+# the flushed counters in the sidecar. Without count, the values are only
+# counted for the sidecar, if any.
+def _count_and_store_lines(lines, to_add, to_incr, sensorname, document, journal=None, position=0, count=True, sidecar=None):
+    counters = {}
+    pending = 0
+    last_flush = time.monotonic()
+    counting = count or sidecar is not None
+    for line in lines:
+        timestamp, values = _DECODE(line)
+        if counting:
+            key = (_TIMESTAMPS.redis_period(timestamp), values[_PROTOCOL_INDEX])
+            try:
+                period_counters = counters[key]
+            except KeyError:
+                period_counters = counters[key] = _get_counters(to_add, to_incr, sensorname, *key)
+            for counter, value in zip(period_counters, values * _PERIODS):
+                counter[value] += 1
+        packet = dict(zip(_JSON_FIELDS, values))
+        packet['timestamp'] = _TIMESTAMPS.json_timestamp(timestamp)
+        packet['packet_id'] = document.packets - 1
         packet['type'] = potiron.TYPE_PACKET
         packet['state'] = potiron.STATE_NOT_ANNOTATE
-        allpackets.append(packet)
-        packet_id += 1
-    p = _RED.pipeline()
-    for key, values in to_add.items():
-        p.sadd(key, *list(values))
-    for redis_key, values in to_incr.items():
-        for value, amount in values.items():
-            p.zincrby(redis_key, amount, value)
-    p.execute()
-    potiron.store_packet(_ROOTDIR, filename, json.dumps(allpackets))
-    proc.wait()
-    return f'Data from {filename} parsed and stored in json format.'
+        document.write(packet)
+        pending += 1
+        if not pending % _FLUSH_CHECK and (journal is not None or not count) and counting and _flush_needed(to_incr, pending, last_flush):
+            position += pending
+            _flush(to_add, to_incr, journal, position, sidecar=sidecar)
+            counters.clear()
+            pending = 0
+            last_flush = time.monotonic()
+    if not count and sidecar is not None:
+        _flush(to_add, to_incr, None, position, sidecar=sidecar)
+    return position + pending
+
+
+# Same as _process_file, but the tshark lines are read by chunks of
+# _CHUNK_SIZE lines, split into one NumPy array per field, and counted
+# with np.unique instead of updating the counters packet by packet
+def _process_file_vectorized(inputfile, shard=None, lines=None):
+    to_add, to_incr, filename, sensorname = _get_data_structures(inputfile)
+    if _RED.sismember("FILES", filename):
+        return f'Filename {inputfile} was already imported ... skip ...\n'
+    journal, position, flush_end, batches = _start_journal(filename, shard)
+    if journal is None:
+        return f'Data from {filename} already parsed.'
+    potiron.add_days(_RED, sensorname, day_from_filename(filename))
+    lines = _read_capture(inputfile, shard, lines)
+    deque(islice(lines, position), maxlen=0)
+    if flush_end is not None:
+        _count_chunks(islice(lines, flush_end - position), to_add, to_incr, sensorname)
+        position = flush_end
+        _flush(to_add, to_incr, journal, position, batches)
+    position = _count_chunks(lines, to_add, to_incr, sensorname, journal, position)
+    _flush(to_add, to_incr, journal, position, commit=True, filename=filename if shard is None else None)
+    return f'Data from {filename} parsed.'
 
 
-def _create_packet(line):
-    line = line.decode().strip('\n')
-    packet = {key: value for key, value in zip(_FIELDS, line.split(' '))}
-    for special_field, value in special_fields.items():
-        if special_field in packet and not packet[special_field]:
-            packet[special_field] = value
-    packet = globals()[_TO_CALL](packet)
-    return packet
+def _count_chunks(lines, to_add, to_incr, sensorname, journal=None, position=0):
+    pending = 0
+    last_flush = time.monotonic()
+    while True:
+        chunk = list(islice(lines, _CHUNK_SIZE))
+        if not chunk:
+            break
+        _count_chunk(chunk, to_add, to_incr, sensorname)
+        pending += len(chunk)
+        if journal is not None and _flush_needed(to_incr, pending, last_flush):
+            position += pending
+            _flush(to_add, to_incr, journal, position)
+            pending = 0
+            last_flush = time.monotonic()
+    return position + pending
+
+
+def _count_chunk(chunk, to_add, to_incr, sensorname):
+    n_fields = len(_FIELDS)
+    # Every line has exactly one value per field, so all the values of the
+    # chunk can be split at once and sliced per field
+    values = b''.join(chunk).replace(b'\n', b' ').split(b' ')
+    columns = {field: np.array(values[position:-1:n_fields]) for position, field in enumerate(_FIELDS)}
+    periods, period_index = _get_periods(columns['timestamp'])
+    protocols, protocol_index = np.unique(_get_column('protocol', columns), return_inverse=True)
+    groups = period_index * len(protocols) + protocol_index
+    counters = [_get_counters(to_add, to_incr, sensorname, period, _handle_protocol(protocol))
+                for period in periods for protocol in protocols.tolist()]
+    n_fields = len(_JSON_FIELDS)
+    for position, field in enumerate(_JSON_FIELDS):
+        field_values, value_index = np.unique(_get_column(field, columns), return_inverse=True)
+        keys, counts = np.unique(groups * len(field_values) + value_index, return_counts=True)
+        group_keys, value_keys = np.divmod(keys, len(field_values))
+        field_values = field_values.tolist()
+        for group, value, count in zip(group_keys.tolist(), value_keys.tolist(), counts.tolist()):
+            for counter in counters[group][position::n_fields]:
+                counter[field_values[value]] += count
+
+
+# Vectorized equivalent of the values returned by the decoder
+def _get_column(field, columns):
+    if field in _port_fields:
+        ports = [columns[port] for port in _port_fields[field] if port in columns]
+        column = ports.pop()
+        for port in reversed(ports):
+            column = np.where(port != b'', port, column)
+        return np.where(column != b'', column, b'-1')
+    column = columns[field]
+    if field == 'protocol':
+        return np.where(np.char.isdigit(column), column, b'-1')
+    if field in ('ipsrc', 'ipdst'):
+        return np.where((column == b'') | (column == b'-'), b'-1', column)
+    if field in special_fields:
+        return np.where(column == b'', str(special_fields[field]).encode(), column)
+    return column
+
+
+# Return the periods (see TimestampConverter) covered by the timestamps, and
+# the index of the period of each timestamp. The sub-day buckets are defined
+# for each distinct second.
+def _get_periods(timestamps):
+    seconds = np.char.partition(timestamps, b'.')[:, 0].astype(np.int64)
+    if not _BUCKETS:
+        days, day_index = _get_days(seconds)
+        return [(day,) for day in days], day_index
+    seconds, second_index = np.unique(seconds, return_inverse=True)
+    periods = {}
+    index = [periods.setdefault(_TIMESTAMPS.second_period(second), len(periods)) for second in seconds.tolist()]
+    return list(periods), np.array(index)[second_index]
+
+
+# Return the days covered by the timestamps, and the index of the day of each timestamp
+def _get_days(seconds):
+    last = int(seconds.max())
+    day, _, boundary = _TIMESTAMPS.day_range(int(seconds.min()))
+    days, boundaries = [day], []
+    while boundary <= last:
+        day, _, end = _TIMESTAMPS.day_range(boundary)
+        days.append(day)
+        boundaries.append(boundary)
+        boundary = end
+    return days, np.searchsorted(boundaries, seconds, side='right')
+
+
+# Return the counters of each field for the packets of a period (and protocol,
+# with combined keys), registering the day and protocol at the same time: the
+# counters of the day, followed by the counters of each sub-day bucket, whose
+# expiry is kept in _EXPIRY until the next flush.
+# They are cached by the processing loop until the next flush.
+def _get_counters(to_add, to_incr, sensorname, period, protocol):
+    day, *buckets = period
+    rKey = _KEY_FUNCTION(sensorname, day, protocol, to_add)
+    to_add[f"{sensorname}_DAYS"].add(day)
+    counters = [to_incr[f"{rKey}:{field}"] for field in _JSON_FIELDS]
+    for bucket in buckets:
+        rKey = _KEY_FUNCTION(sensorname, bucket, protocol, to_add)
+        expiry = bucket_expiry(bucket, _BUCKETS, _TIMESTAMPS.timezone)
+        for field in _JSON_FIELDS:
+            key = f"{rKey}:{field}"
+            counters.append(to_incr[key])
+            if expiry is not None:
+                _EXPIRY[key] = expiry
+    return counters
+
+
+# Push the counters to redis (with a journal), and write them in the sidecar.
+# The distinct values and the roll-ups of the days are not written in the
+# sidecar, they are derived again from the increments when it is replayed.
+def _flush(to_add, to_incr, journal, position, skip=0, commit=False, filename=None, sidecar=None):
+    to_expire = {key: _EXPIRY.pop(key) for key in to_incr if key in _EXPIRY}
+    if sidecar is not None:
+        sidecar.write(to_add, to_incr, to_expire)
+    if journal is not None:
+        to_count = potiron.distinct_values(to_incr, _HLL) if _HLL else None
+        potiron.flush_data(_RED, to_add, to_incr, _BATCH_SIZE, journal, position, skip, commit, filename, to_expire, to_count, _TOPK, potiron.touched_rollups(to_incr))
+    to_add.clear()
+    to_incr.clear()
+
+
+# Start or resume the journal of the ingestion of a capture or shard. Returns
+# the journal key (None if the ingestion is already committed), the number of
+# lines already flushed, and the state of an interrupted flush.
+# The expiry of the buckets is checked against the time the ingestion first
+# started, so that the lines of an interrupted flush give the same buckets,
+# and thus the same batches, when they are counted again.
+def _start_journal(filename, shard):
+    journal = potiron.journal_key(filename, shard)
+    committed, position, flush_end, batches, started = potiron.start_journal(_RED, journal)
+    if committed:
+        return None, position, None, 0
+    _TIMESTAMPS.set_now(started)
+    if position or flush_end is not None:
+        potiron.infomsg(f"Resuming the import of {filename} after {position} packets.")
+    return journal, position, flush_end, batches
+
+
+# Tell if the partial counters have to be pushed to redis, according to the
+# number of packets, the number of distinct values or the time since the last flush
+def _flush_needed(to_incr, pending, last_flush):
+    if _FLUSH_PACKETS and pending >= _FLUSH_PACKETS:
+        return True
+    if _FLUSH_SECONDS and time.monotonic() - last_flush >= _FLUSH_SECONDS:
+        return True
+    return bool(_FLUSH_KEYS) and sum(len(values) for values in to_incr.values()) >= _FLUSH_KEYS
+
+
+def _set_flush_policy():
+    for parameter, default in _flush_parameters.items():
+        key = f"_{parameter.upper()}"
+        globals()[key] = int(globals().get(key, default))
+    # The flush criteria are checked every _FLUSH_CHECK packets only
+    globals()["_FLUSH_CHECK"] = min(_FLUSH_PACKETS, potiron.DEFAULTBULKBUFFER) if _FLUSH_PACKETS else potiron.DEFAULTBULKBUFFER
+
+
+# The lines may have been read from the capture for several formats at once
+# (see potiron_multi_tshark), they are then used as they are
+def _read_capture(inputfile, shard=None, lines=None):
+    if lines is not None:
+        return lines
+    if _ENGINE == 'native':
+        return potiron_pcap.native_output(inputfile, _TSHARK_FIELDS, _FORMAT, shard, _DECOMPRESS)
+    return potiron.tshark_output(potiron_pcap.tshark_command(_CMD, inputfile, _DECOMPRESS), _TSHARK_TIMEOUT)
 
 
 def day_from_filename(filename):
@@ -172,187 +436,57 @@ def _get_data_structures(inputfile):
 ################################################################################
 
 
-def _cannot_be_int(protocol):
+# Build the decoder of the tshark lines for the current fields configuration.
+# Instead of creating a dictionary for each packet and dispatching the handling
+# of its special fields at each packet, the decoder is compiled once with the
+# position of each field in the lines and the handling of the special fields
+# inlined. It returns the timestamp of the packet and the tuple of its values,
+# in the order of _JSON_FIELDS.
+# With text set, the values are decoded and have the types used in the json
+# documents, otherwise they are kept as bytes, which redis stores the same way.
+def _build_decoder(text=False):
+    positions = {field: f"fields[{position}]" for position, field in enumerate(_FIELDS)}
+    values = ', '.join(_value_expression(field, positions, text) for field in _JSON_FIELDS)
+    split = "line.decode().rstrip('\\n').split(' ')" if text else "line.rstrip(b'\\n').split(b' ')"
+    timestamp = positions['timestamp'] if text else f"{positions['timestamp']}.decode()"
+    namespace = {'_handle_protocol': _handle_protocol}
+    exec(f"def _decode(line):\n    fields = {split}\n    return {timestamp}, ({values},)\n", namespace)
+    return namespace['_decode']
+
+
+def _value_expression(field, positions, text):
+    if field in _port_fields:
+        ports = [positions[port] for port in _port_fields[field] if port in positions]
+        return f"({' or '.join(ports)} or {_literal(-1, text)})"
+    value = positions[field]
+    if field == 'protocol':
+        return f"_handle_protocol({value})"
+    if field in ('ipsrc', 'ipdst'):
+        return f"({value} if {value} and {value} != {_literal('-', text)} else {_literal(-1, text)})"
+    if field in special_fields:
+        return f"({value} or {_literal(special_fields[field], text)})"
+    return value
+
+
+def _literal(value, text):
+    return repr(value) if text else repr(str(value).encode())
+
+
+def _handle_protocol(protocol):
     try:
-        int(protocol)
-        is_int = False
-    except Exception:
-        is_int = True
-    return is_int
-
-
-def _check_udport(packet):
-    packet['dport'] = _handle_port(packet['udport'])
-    del packet['udport']
-
-
-def _check_tdport(packet):
-    packet['dport'] = _handle_port(packet['tdport'])
-    del packet['tdport']
-
-
-def _check_dst_ports(packet):
-    port = 'dport'
-    tport = _get_port_from_packet(packet, f't{port}')
-    uport = _get_port_from_packet(packet, f'u{port}')
-    packet[port] = tport if tport != -1 else uport
-
-
-def _check_usport(packet):
-    packet['sport'] = _handle_port(packet['usport'])
-    del packet['usport']
-
-
-def _check_udp_ports(packet):
-    _check_usport(packet)
-    _check_udport(packet)
-
-
-def _check_us_td_ports(packet):
-    _check_usport(packet)
-    _check_tdport(packet)
-
-
-def _check_us_dst_ports(packet):
-    _check_usport(packet)
-    _check_dst_ports(packet)
-
-
-def _check_tsport(packet):
-    packet['sport'] = _handle_port(packet['tsport'])
-    del packet['tsport']
-
-
-def _check_ts_ud_ports(packet):
-    _check_tsport(packet)
-    _check_udport(packet)
-
-
-def _check_tcp_ports(packet):
-    _check_tsport(packet)
-    _check_tdport(packet)
-
-
-def _check_ts_dst_ports(packet):
-    _check_tsport(packet)
-    _check_dst_ports(packet)
-
-
-def _check_src_ports(packet):
-    port = 'sport'
-    tport = _get_port_from_packet(packet, f't{port}')
-    uport = _get_port_from_packet(packet, f'u{port}')
-    packet[port] = tport if tport != -1 else uport
-
-
-def _check_src_ud_ports(packet):
-    _check_src_ports(packet)
-    _check_udport(packet)
-
-
-def _check_src_td_ports(packet):
-    _check_src_ports(packet)
-    _check_tdport(packet)
-
-
-def _check_all_ports(packet):
-    _check_src_ports(packet)
-    _check_dst_ports(packet)
-
-
-def _get_port_from_packet(packet, port):
-    if port in packet:
-        to_return = _handle_port(packet[port])
-        del(packet[port])
-    else:
+        return int(protocol)
+    except ValueError:
         return -1
-    return to_return
-
-
-def _handle_ips(packet):
-    for ip in _ip_mapping[_IP_SCORE]:
-        if ip not in packet or any((not packet[ip], packet[ip] == '-')):
-            packet[ip] = -1
-
-
-def _handle_port(port):
-    if port:
-        return port
-    return -1
-
-
-def _handle_protocol(packet):
-    if 'protocol' not in packet or any((not packet['protocol'], _cannot_be_int(packet['protocol']))):
-        packet['protocol'] = -1
-    else:
-        packet['protocol'] = int(packet['protocol'])
-
 
-def _dont_parse_ips_dont_parse_ports_dont_parse_protocol(packet):
-    return packet
 
-
-def _dont_parse_ips_dont_parse_ports_parse_protocol(packet):
-    _handle_protocol(packet)
-    return packet
-
-
-def _dont_parse_ips_parse_ports_dont_parse_protocol(packet):
-    globals()[_port_mapping[_PORT_SCORE]](packet)
-    return packet
-
-
-def _dont_parse_ips_parse_ports_parse_protocol(packet):
-    _handle_protocol(packet)
-    globals()[_port_mapping[_PORT_SCORE]](packet)
-    return packet
-
-
-def _parse_ips_dont_parse_ports_dont_parse_protocol(packet):
-    _handle_ips(packet)
-    return packet
-
-
-def _parse_ips_dont_parse_ports_parse_protocol(packet):
-    _handle_protocol(packet)
-    _handle_ips(packet)
-    return packet
-
-
-def _parse_ips_parse_ports_dont_parse_protocol(packet):
-    globals()[_port_mapping[_PORT_SCORE]](packet)
-    _handle_ips(packet)
-    return packet
-
-
-def _parse_ips_parse_ports_parse_protocol(packet):
-    _handle_protocol(packet)
-    globals()[_port_mapping[_PORT_SCORE]](packet)
-    _handle_ips(packet)
-    return packet
-
-
-def _combined_redis_key(packet, sensorname, to_add):
-    protocol = _PROTOCOLS[str(packet['protocol'])]
-    rKey = f"{sensorname}:{protocol}:{packet['timestamp']}"
+def _combined_redis_key(sensorname, day, protocol, to_add):
+    protocol = _PROTOCOLS[str(protocol)]
     to_add["PROTOCOLS"].add(protocol)
-    return rKey
-
-
-def _simple_redis_key(packet, sensorname, _):
-    return f"{sensorname}:{packet['timestamp']}"
-
-
-def _set_json_timestamp(timestamp):
-    int_part, dec_part = timestamp.split('.')
-    intobj = datetime.datetime.fromtimestamp(float(int_part))
-    return f'{intobj.strftime("%Y-%m-%d %H:%M:%S")}.{dec_part[:-3]}'
+    return f"{sensorname}:{protocol}:{day}"
 
 
-def _set_redis_timestamp(timestamp):
-    int_part, _ = timestamp.split('.')
-    intobj = datetime.datetime.fromtimestamp(float(int_part))
-    return intobj.strftime("%Y%m%d")
+def _simple_redis_key(sensorname, day, *_):
+    return f"{sensorname}:{day}"
 
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    Potiron -  Normalize, Index, Enrich and Visualize Network Capture
+#    Copyright (C) 2019 Christian Studer
+#    Copyright (C) 2019 CIRCL Computer Incident Response Center Luxembourg (smile gie)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Check that the native engine (potiron_pcap) outputs the same lines as
+# tshark for the crafted captures of tests/pcap: for each capture and format,
+# capture.format.txt holds the lines output by the tshark command of the
+# format (`tshark -Tfields -E separator=/s -E occurrence=f`, with the default
+# filter of the format, as rendered by tshark 3.0 and later).
+# The captures are also read gzip compressed.
+# With --tshark, the expected lines are checked against the installed tshark
+# as well, and written again with --update, recording the version of tshark
+# in tshark-version.txt.
+
+from pathlib import Path
+import sys
+
+# The check runs from the repository, without installing the package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from potiron.potiron_parameters import _predefine_cmd
+from potiron.potiron_pcap import native_output
+import argparse
+import gzip
+import potiron.potiron as potiron
+import shutil
+import subprocess
+import tempfile
+
+_directory = Path(__file__).resolve().parent / 'pcap'
+_version = _directory / 'tshark-version.txt'
+_formats = {'standard': (potiron.tshark_fields, potiron.tshark_filter),
+            'isn': (potiron.isn_tshark_fields, potiron.isn_tshark_filter),
+            'layer2': (potiron.layer2_tshark_fields, potiron.layer2_tshark_filter)}
+
+
+def _native_lines(capture, fields, format):
+    return [line.decode() for line in native_output(str(capture), fields, format)]
+
+
+def _tshark_lines(capture, fields, tshark_filter):
+    return [line.decode() for line in potiron.tshark_output(_predefine_cmd(tshark_filter, fields).format(capture))]
+
+
+def _compare(name, expected, lines):
+    if lines == expected:
+        return True
+    print(f"[FAIL] {name}")
+    for position in range(max(len(expected), len(lines))):
+        expected_line = expected[position] if position < len(expected) else None
+        line = lines[position] if position < len(lines) else None
+        if expected_line != line:
+            print(f"  line {position + 1}:\n    expected: {expected_line!r}\n    got:      {line!r}")
+    return False
+
+
+def _tshark_version():
+    return subprocess.run(['tshark', '--version'], stdout=subprocess.PIPE, check=True).stdout.decode().splitlines()[0]
+
+
+def check_parity(tshark=False, update=False):
+    success = True
+    if update:
+        _version.write_text(f"{_tshark_version()}\n")
+    if _version.exists():
+        print(f"Expected lines output by {_version.read_text().strip()}")
+    else:
+        print("[WARNING] The expected lines were not generated by tshark, run the check with --tshark --update")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for capture in sorted(_directory.glob('*.pcap')):
+            compressed = Path(tmpdir) / f"{capture.name}.gz"
+            with open(capture, 'rb') as source, gzip.open(compressed, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            for format, (fields, tshark_filter) in _formats.items():
+                reference = capture.with_suffix(f".{format}.txt")
+                name = f"{capture.name} ({format})"
+                if tshark:
+                    lines = _tshark_lines(capture, fields, tshark_filter)
+                    if update:
+                        reference.write_text(''.join(lines))
+                expected = reference.read_text().splitlines(keepends=True)
+                if tshark:
+                    success &= _compare(f"{name} with tshark", expected, lines)
+                success &= _compare(name, expected, _native_lines(capture, fields, format))
+                success &= _compare(f"{name} compressed", expected, _native_lines(compressed, fields, format))
+    return success
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the native engine outputs the same lines as tshark for the captures of tests/pcap.')
+    parser.add_argument('--tshark', action='store_true', help='Also check the expected lines against the output of the installed tshark')
+    parser.add_argument('--update', action='store_true', help='With --tshark, write the expected lines again from the output of tshark')
+    args = parser.parse_args()
+    if args.update and not args.tshark:
+        sys.exit("The expected lines are only updated from the output of tshark, please use --tshark.")
+    if args.tshark and shutil.which('tshark') is None:
+        sys.exit("The program tshark is not installed")
+    if not check_parity(args.tshark, args.update):
+        sys.exit(1)
+    print("The native engine outputs the expected lines.")
@@ -29,12 +29,16 @@ import configparser
 import json
 import random
 from lib.helpers import get_homedir
-from potiron.potiron import get_annotations, errormsg
+from potiron.potiron import distinct_keys, errormsg, latest_day, parse_topk, queue_annotations, read_annotations, sensor_days_index, ROLLUPS_DONE, ROLLUPS_PENDING
+from potiron.potiron_query import matrix, queue_matrices, read_matrices
+from potiron.potiron_time import day_buckets, parse_buckets
 app = Flask(__name__, static_folder='static', static_url_path='/static')
 
 _MISSING_FIELDS = "Mandatory fields are missing in the redis database."
 _MISCONFIGURATION = "Please check in the configuration file if you specified a valid sensorname for this redis instance. \
                      Otherwise there is simply no data related to this sensorname."
+# Number of days of the sensor and latest day, see get_latest_day
+_latest_day = (None, None)
 
 
 # returns true if all the mandatory fields are set
@@ -63,17 +67,18 @@ def check_database():
     # all checks are fine
     return None
 
-# FIXME to slow to compute at each time?
-
 
+# The latest day is cached with the number of days of the sensor, read in
+# O(1) from their sorted index: the ingestion only adds days, so the cache
+# is invalidated as soon as a day is added
 def get_latest_day():
-    if not red.exists(f"{sensorname}_DAYS"):
-        return None
-    days = []
-    for day in red.smembers(f"{sensorname}_DAYS"):
-        days.append(day)
-    days.sort()
-    return days[-1]
+    version = red.zcard(sensor_days_index(sensorname))
+    if version == 0:
+        # Days stored before they were indexed (see bin/rebuild_indexes.py)
+        return latest_day(red, sensorname)
+    if _latest_day[0] != version:
+        globals()["_latest_day"] = (version, latest_day(red, sensorname))
+    return _latest_day[1]
 
 
 def enum_last_days(today, period):
@@ -89,22 +94,6 @@ def enum_last_days(today, period):
     return days
 
 
-def get_description(name):
-    k = "DS_" + name
-    desc = red.get(k)
-    if desc is not None:
-        return desc
-    return ""
-
-
-def translate_key_human(name, key):
-    k = "TR_" + name
-    disp_key = red.hget(k, key)
-    if disp_key is not None:
-        return disp_key
-    return key
-
-
 def translate_human_to_redis(name, key):
     k = "RT_" + name
     disp_key = red.hget(k, key)
@@ -115,63 +104,85 @@ def translate_human_to_redis(name, key):
 # TODO verify manually if the scores belong to the right keys
 
 
-def get_recent_evolution(day, field, keys, period):
+# Evolution of the top 3 keys of a field, with one column of scores per day
+# in the order of the legend
+def get_recent_evolution(days, evolution):
     out = []
-    # Build the legend of the graph
-    # lines.append("\"Date,"+",".join(keys)+"\\n\" +\n")
-    for day in enum_last_days(day, period):
-        # Initialize fixed size array to ensure that the
-        # legend order matches the order of scores
-        scores = []
-        for i in range(0, len(keys)):
-            scores.append("0")
+    for i, day in enumerate(days):
         entry = dict()
-        i = 0
-        for i in range(0, len(keys)):
-            ky = keys[i]
-            k = sensorname + ":" + day + ":" + field
-            score = red.zscore(k, ky)
-            if score is not None:
-                scores[i] = str(score)
-            i = i + 1
         entry['day'] = day
-        entry['scores'] = ",".join(scores)
+        entry['scores'] = ",".join(str(score) if score else "0" for score in evolution[:, i])
         out.append(entry)
     return out
 
 
-def create_legend(field, top3):
-    htop3 = []
-    for key in top3:
-        htop3.append(translate_key_human(field, key))
+def create_legend(htop3):
     return "Date," + ",".join(htop3)
 
 
+# The page is read with two pipelines: the top keys and the descriptions of
+# all the fields with the parameters, then the evolution of their top 3
+# keys, their translations, their distinct counts and their annotations
 def get_top_10_per_day(day, fields):
-    topdata = []
+    p = red.pipeline(transaction=False)
     for field in fields:
+        p.zrevrange(sensorname + ":" + day + ":" + field, 0, 10, withscores=True)
+        p.get("DS_" + field)
+    p.hmget("PARAMETERS", "topk", "hll")
+    p.smembers(ROLLUPS_DONE)
+    p.hkeys(ROLLUPS_PENDING)
+    results = p.execute()
+    tops, descs = results[:-3:2], results[1:-3:2]
+    topk, hll = results[-3]
+    approximate = parse_topk(topk or "")
+    # Approximate number of distinct values of the fields counted at
+    # ingestion (see parse_pcap_files --hll), from the roll-ups up to date
+    # (see fresh_rollups)
+    distinct_fields = [field for field in fields if field in (hll or "").split()]
+    fresh = results[-2] - set(results[-1])
+    keys = [(field, key) for field, top in zip(fields, tops) for key, _ in top]
+    days = enum_last_days(day, shortcoverage)
+
+    p = red.pipeline(transaction=False)
+    # The top keys come from the sorted sets of the sensor, and so do their
+    # evolutions
+    evolutions = queue_matrices(p, [sensorname], [(field, [key for key, _ in top[:3]], days) for field, top in zip(fields, tops)])
+    start = len(p)
+    for field, key in keys:
+        p.hget("TR_" + field, key)
+    for field in distinct_fields:
+        for period in (day, day[:6], day[:4]):
+            p.pfcount(*distinct_keys(sensorname, period, field, fresh=fresh))
+    queue_annotations(p, [(key, field) for field, key in keys])
+    results = p.execute(raise_on_error=False)
+    for result in results[start:]:
+        if isinstance(result, Exception):
+            raise result
+    evolutions = iter(read_matrices(red, evolutions, results))
+    hkeys = iter(key if disp_key is None else disp_key for (_, key), disp_key in zip(keys, results[start:]))
+    counts = iter(results[start + len(keys):-1])
+    annotations = iter(read_annotations([(key, field) for field, key in keys], results[-1]))
+
+    topdata = []
+    for field, top, desc, evolution in zip(fields, tops, descs, evolutions):
         d = dict()
         d['name'] = field
         d['data'] = []
-        d['desc'] = get_description(field)
-        k = sensorname + ":" + day + ":" + field
-        top3 = []
-        # topdata.name
-        # topdata.data
-        for (key, score) in red.zrevrange(k, 0, 10, 'withscores'):
-            if len(top3) < 3:
-                top3.append(key)
+        d['desc'] = desc if desc is not None else ""
+        for (key, score) in top:
             entry = dict()
-            entry['key'] = translate_key_human(field, key)
+            entry['key'] = next(hkeys)
             entry['score'] = score
-            annotations = get_annotations(red, key, field)
-            n = len(annotations)
+            key_annotations = next(annotations)
+            n = len(key_annotations)
             if n > 0:
-                entry['annot'] = ",".join(annotations)
+                entry['annot'] = ",".join(key_annotations)
                 entry['anum'] = n
             d['data'].append(entry)
-        d['evol'] = get_recent_evolution(day, field, top3, shortcoverage)
-        d['legend'] = create_legend(field, top3)
+        d['evol'] = get_recent_evolution(days, evolution)
+        d['distinct'] = {period: next(counts) for period in ('day', 'month', 'year')} if field in distinct_fields else None
+        d['approximate'] = field in approximate
+        d['legend'] = create_legend([entry['key'] for entry in d['data'][:3]])
         topdata.append(d)
     return topdata
 
@@ -298,13 +309,11 @@ def deliver_evolution(date, field, key):
         data = []
         daterange = enum_last_days(date, coverage)
         rkey = translate_human_to_redis(field, key)
-        for date in daterange:
+        for date, score in zip(daterange, matrix(red, sensorname, field, [rkey], daterange)[0]):
             entry = dict()
-            k = sensorname + ":" + date + ":" + field
-            score = red.zscore(k, rkey)
-            if (score is not None):
+            if score:
                 entry['date'] = date
-                entry['score'] = score
+                entry['score'] = float(score)
                 data.append(entry)
 
         # Convert date
@@ -317,6 +326,38 @@ def deliver_evolution(date, field, key):
         return render_template('offline.html', prefix=prefix)
 
 
+# Evolution of a key during a day, over the sub-day buckets of the given width
+# (ex: 5m) counted at ingestion
+@app.route('/buckets/<width>/<date>/<field>/<key>/')
+@app.route('/buckets/<width>/<date>/<field>/<key>')
+def deliver_buckets(width, date, field, key):
+    try:
+        desc = create_program_meta()
+        params = build_params()
+        if check_date(date) is False or width not in parse_buckets(red.hget("PARAMETERS", "buckets") or ""):
+            emsg = "Invalid date or buckets specified"
+            return render_template('content.html', desc=desc, params=params,
+                                   emsg=emsg)
+        rkey = translate_human_to_redis(field, key)
+        buckets = day_buckets(date, width)
+        p = red.pipeline(transaction=False)
+        for bucket in buckets:
+            p.zscore(sensorname + ":" + bucket + ":" + field, rkey)
+        data = []
+        for bucket, score in zip(buckets, p.execute()):
+            if score is not None:
+                start = datetime.datetime.strptime(bucket.split(':')[1], "%Y%m%d%H%M")
+                data.append({'date': start.strftime("%Y/%m/%d %H:%M"), 'score': score})
+
+        d = datetime.datetime.strptime(date, "%Y%m%d")
+        showdate = d.strftime("%Y-%m-%d")
+        return render_template("evol.html", desc=desc, date=showdate, field=field,
+                               key=key, data=data, params=params)
+    except redis.ConnectionError as err:
+        errormsg("Cannot connect to redis " + str(err))
+        return render_template('offline.html', prefix=prefix)
+
+
 @app.route('/custom/', methods=['POST'])
 @app.route('/custom', methods=['POST'])
 def deliver_custom():